@@ -1,13 +1,37 @@
-import copy
-import inspect
+import _thread
+import functools
+import linecache
 import os
 import sys
-from collections.abc import Callable
-from dataclasses import dataclass
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, field
 from enum import Enum, auto
-from pprint import pprint
 from types import CodeType, FrameType, ModuleType, TracebackType
-from typing import Any, NamedTuple, TextIO, TypeAlias
+from typing import IO, TYPE_CHECKING, Any, NamedTuple, TextIO, TypeAlias
+
+from .snapshot import (
+    COPY_STATS,
+    SKIP,
+    Changes,
+    Copier,
+    Limits,
+    Memo,
+    Skipped,
+    Symbols,
+    capped,
+    copy_repr,
+    copy_value,
+    snapshot,
+    snapshot_changes,
+)
+
+if TYPE_CHECKING:
+    from .interpreter import History, InterpretedTrace
+    from .trace_file import TraceWriter
 
 """
 Everything regarding:
@@ -16,6 +40,8 @@ Everything regarding:
 
 The basic mechanism of python tracing is explained here:
     https://docs.python.org/3/library/sys.html#sys.settrace
+
+On python 3.12+ the same events are captured with sys.monitoring, which is faster.
 """
 
 try:
@@ -31,6 +57,8 @@ except ImportError:
 
 
 # Set `DEBUG` in the environment to enable debug logs (extremely verbose)
+# On the paths taken for every event, the calls are guarded with `if DEBUG:`, so
+# that nothing gets formatted nor called when it's off.
 DEBUG = "DEBUG" in os.environ
 
 
@@ -48,6 +76,8 @@ def debug(*args, **kwargs):
 def debug_pprint(o):
     """Output a pretty printed object if DEBUG is enabled."""
     if DEBUG:
+        from pprint import pprint
+
         pprint(o, stream=sys.stderr)
 
 
@@ -60,6 +90,8 @@ def debug_frame(frame):
     frame_info = {a: getattr(frame, a) for a in attrs if hasattr(frame, a)}
 
     debug(f"<frame at {id(frame):#x}>: ")
+    from pprint import pprint
+
     pprint(frame_info, sort_dicts=False, stream=sys.stderr)
 
 
@@ -68,6 +100,9 @@ def debug_stack_frame():
     if not DEBUG:
         return
     debug("stack frame:")
+    import inspect
+    from pprint import pprint
+
     pprint(inspect.stack(), stream=sys.stderr)
 
 
@@ -76,8 +111,6 @@ def debug_stack_frame():
 ###############################################################################
 """ The models and classes that collect the trace. """
 
-Symbols: TypeAlias = dict[str, Any]
-
 
 class TLine(NamedTuple):
     """
@@ -87,6 +120,8 @@ class TLine(NamedTuple):
 
     globals: Symbols
     locals: Symbols
+    # When the event happened, see CaptureOptions.timestamps
+    time: int | None = None
 
 
 class TCall(NamedTuple):
@@ -97,6 +132,7 @@ class TCall(NamedTuple):
     globals: Symbols
     locals: Symbols
     function_name: str
+    time: int | None = None
 
 
 class TReturn(NamedTuple):
@@ -107,6 +143,7 @@ class TReturn(NamedTuple):
     globals: Symbols
     locals: Symbols
     return_value: Any
+    time: int | None = None
 
 
 class TException(NamedTuple):
@@ -118,7 +155,9 @@ class TException(NamedTuple):
     locals: Symbols
     type: type
     value: Exception
-    traceback: TracebackType
+    # None when the trace was read from a file
+    traceback: TracebackType | None
+    time: int | None = None
 
 
 class TOutput(NamedTuple):
@@ -129,76 +168,564 @@ class TOutput(NamedTuple):
     text: str
 
 
-TEvent: TypeAlias = TLine | TCall | TReturn | TException | TOutput
+class TGap(NamedTuple):
+    """
+    Some events were not retained
+    """
+
+    dropped: int
+    # The functions active after the dropped events, the outermost first
+    call_stack: list[str]
+    # The last line executed at module level, then in each function of the stack
+    line_numbers: list[int]
+    # The thread of the events that follow, None for the thread that started tracing
+    thread: str | None = None
 
-Trace: TypeAlias = list[tuple[int, TEvent]]
+
+class TElided(NamedTuple):
+    """
+    The iterations of a loop past the first ones were not captured
+    """
+
+    iterations: int
+    # The loop spans from the line of this event to this one
+    last_line: int
+    # How many times each line was executed (or each function called) during the
+    # elided iterations
+    line_counts: dict[int, int]
+
+
+class TThread(NamedTuple):
+    """
+    The events that follow happen in another thread
+    """
+
+    # None for the thread that started tracing
+    name: str | None
+
+
+class TProcess(NamedTuple):
+    """
+    The events that follow happened in a child process, they were captured there
+    and merged in at the end (see `Tracer.merge_processes`)
+    """
+
+    pid: int
+
+
+TEvent: TypeAlias = (
+    TLine | TCall | TReturn | TException | TOutput | TGap | TElided | TThread | TProcess
+)
+
+TraceItem: TypeAlias = tuple[int, TEvent]
+
+Trace: TypeAlias = Sequence[TraceItem]
 
 DoneCallback = Callable[[Trace], None]
 
+HistoryCallback = Callable[["History"], None]
+
+
+class RetainedTrace:
+    """
+    Keeps the first and the last events of a trace, and drops the ones in between,
+    so that the memory used stays bounded however long the program runs.
 
-def ignore_variable(name: str, value: Any) -> bool:
-    return name.startswith("__") or isinstance(value, ModuleType)
+    The calls, lines and returns of the events that are not part of the last events
+    are replayed to know the call stack at the start of the last events.
+    """
 
+    def __init__(self, keep_first: int, keep_last: int):
+        self.keep_first = keep_first
+        self.keep_last = keep_last
+        self.first: list[TraceItem] = []
+        self.last: deque[TraceItem] = deque()
+        self.dropped = 0
+        self.call_stack: list[str] = []
+        self.line_numbers: list[int] = [-1]
+        # Each thread has its own stack
+        self.thread: str | None = None
+        self.thread_stacks: dict[str | None, tuple[list[str], list[int]]] = {}
+        # The newest event, even if it got dropped right away
+        self.newest: TraceItem | None = None
+
+    def append(self, item: TraceItem) -> None:
+        self.newest = item
+        if len(self.first) < self.keep_first:
+            self.first.append(item)
+            self.replay(item)
+            return
 
-def filtered_variables(variables: dict[str, Any]) -> dict[str, Any]:
-    return {
-        name: value
-        for name, value in variables.items()
-        if not ignore_variable(name, value)
-    }
+        self.last.append(item)
+        if len(self.last) > self.keep_last:
+            self.replay(self.last.popleft())
+            self.dropped += 1
+
+    def replay(self, item: TraceItem) -> None:
+        match item:
+            case _, TCall(_, _, function_name):
+                self.call_stack.append(function_name)
+                self.line_numbers.append(-1)
+            case lineno, TLine():
+                self.line_numbers[-1] = lineno
+            case _, TReturn() if self.call_stack:
+                self.call_stack.pop()
+                self.line_numbers.pop()
+            case _, TThread(name):
+                self.thread_stacks[self.thread] = self.call_stack, self.line_numbers
+                self.thread = name
+                self.call_stack, self.line_numbers = self.thread_stacks.pop(
+                    name, ([], [-1])
+                )
+            case _, TProcess():
+                self.thread = None
+                self.thread_stacks = {}
+                self.call_stack, self.line_numbers = [], [-1]
+
+    def to_trace(self) -> list[TraceItem]:
+        if not self.dropped:
+            return self.first + list(self.last)
+        assert self.newest
+        lineno = self.last[0][0] if self.last else self.newest[0]
+        gap = (
+            lineno,
+            TGap(
+                self.dropped,
+                self.call_stack.copy(),
+                self.line_numbers.copy(),
+                self.thread,
+            ),
+        )
+        return [*self.first, gap, *self.last]
 
 
-def ignore_function(name: str) -> bool:
-    return name.startswith("__")
+class ConsumedTrace(ABC):
+    """Hands the events over to `consume` as they arrive, instead of collecting them."""
+
+    @abstractmethod
+    def consume(self, item: TraceItem) -> None: ...
+
+    def append(self, item: TraceItem) -> None:
+        self.consume(item)
 
 
-def copy_carefully(symbols: Symbols) -> Symbols:
+# Where the Tracer puts the events
+TraceSink: TypeAlias = list[TraceItem] | RetainedTrace | ConsumedTrace
+
+# When an event happened, to order the events of different threads
+Stamp: TypeAlias = int
+
+
+class WorkerTrace:
     """
-    In order to capture mutations to values, we try to deepcopy them at each step.
-    If we cannot deepcopy an item, we revert to just referencing it:
-    - The program doesn't break
-    - We may not be able to see some mutations.
+    The events of one of the threads started by the traced program.
+
+    Only that thread appends events, and only the thread that started tracing takes
+    them out, so no lock is needed (even without the GIL, deques support this).
     """
-    res = {}
-    for k, v in symbols.items():
-        try:
-            v_copy = copy.deepcopy(v)
-        except (copy.Error, TypeError):
-            v_copy = v
-        res[k] = v_copy
-    return res
+
+    def __init__(self, name: str):
+        self.name = name
+        self.events: deque[tuple[Stamp, TraceItem]] = deque()
+
+    def append(self, item: TraceItem) -> None:
+        self.events.append((time.perf_counter_ns(), item))
+
+
+class OutputStore:
+    """
+    Decides how much of the output gets stored in the trace.
+
+    A row of output keeps at most max_row characters, and the whole trace at most
+    max_total. The text past these gets spooled to a temporary file instead, and
+    the row ends with where to find it.
+    """
+
+    def __init__(self, max_row: int | None, max_total: int | None):
+        self.max_row = max_row
+        self.max_total = max_total
+        self.stored = 0
+        self.spooled = 0
+        self.spool: IO[str] | None = None
+
+    def text(self, chunks: list[str]) -> str:
+        text = "".join(chunks)
+        kept = len(text)
+        if self.max_row is not None:
+            kept = min(kept, self.max_row)
+        if self.max_total is not None:
+            kept = min(kept, max(self.max_total - self.stored, 0))
+        self.stored += kept
+        if kept == len(text):
+            return text
+
+        if self.spool is None:
+            # Import only here, it's not needed until the output gets spooled
+            import tempfile
+
+            self.spool = tempfile.NamedTemporaryFile(
+                "w", prefix="atrace-output-", suffix=".txt", delete=False
+            )
+        cut = len(text) - kept
+        self.spool.write(text[kept:])
+        self.spooled += cut
+        more = f"{cut:,}".replace(",", " ")
+        return f"{text[:kept]}… {more} more characters in {self.spool.name}\n"
+
+    def close(self) -> None:
+        if self.spool is not None:
+            self.spool.close()
+
+
+class ThreadedTrace:
+    """
+    Gives each thread its own place to put its events.
+
+    The events of the thread that started tracing go straight to the trace. The
+    other threads put theirs in a WorkerTrace, with a timestamp. Before each event
+    of the tracing thread, the earlier events of the other threads get moved to the
+    trace, with TThread events marking the switches from one thread to another.
+
+    The output of a thread gets collected in pieces, and only joined into a TOutput
+    event when the thread has another event, so that print(*range(100_000)) costs
+    no more than printing a single string of the same length.
+    """
+
+    def __init__(self, sink: TraceSink, output: OutputStore):
+        self.sink = sink
+        self.output = output
+        self.tracing_thread = _thread.get_ident()
+        self.workers: dict[int, WorkerTrace] = {}
+        # The thread of the last event moved to the trace
+        self.current_thread: str | None = None
+        # The output written by each thread since its last event, and the line
+        # that wrote it first
+        self.outputs: dict[int, tuple[int, list[str]]] = {}
+
+    def local(self, thread: int) -> TraceSink | WorkerTrace:
+        if thread == self.tracing_thread:
+            return self.sink
+        worker = self.workers.get(thread)
+        if worker is None:
+            # Imported here, startup is faster without it
+            import threading
+
+            worker = self.workers[thread] = WorkerTrace(threading.current_thread().name)
+        return worker
+
+    def write(self, text: str, lineno: Callable[[], int]) -> None:
+        """Only the first write since the last event of the thread needs the
+        line."""
+        thread = _thread.get_ident()
+        pending = self.outputs.get(thread)
+        if pending is None:
+            self.outputs[thread] = lineno(), [text]
+        else:
+            pending[1].append(text)
+
+    def append(self, item: TraceItem) -> None:
+        thread = _thread.get_ident()
+        if self.outputs:
+            self.settle_output(thread)
+        self.put(thread, item)
+
+    def settle_output(self, thread: int) -> None:
+        pending = self.outputs.pop(thread, None)
+        if pending is not None:
+            lineno, chunks = pending
+            self.put(thread, (lineno, TOutput(self.output.text(chunks))))
+
+    def put(self, thread: int, item: TraceItem) -> None:
+        local = self.local(thread)
+        if local is not self.sink:
+            local.append(item)
+            return
+        if self.workers:
+            self.move_worker_events(until=time.perf_counter_ns())
+            self.switch_to(None, item[0])
+        self.sink.append(item)
+
+    def move_worker_events(self, until: Stamp | None = None) -> None:
+        earlier: list[tuple[Stamp, str, TraceItem]] = []
+        # Copy the workers, new threads can start meanwhile
+        for worker in [*self.workers.values()]:
+            events = worker.events
+            while events and (until is None or events[0][0] < until):
+                stamp, item = events.popleft()
+                earlier.append((stamp, worker.name, item))
+        earlier.sort(key=lambda stamped: stamped[0])
+        for _, name, item in earlier:
+            self.switch_to(name, item[0])
+            self.sink.append(item)
+
+    def switch_to(self, thread: str | None, lineno: int) -> None:
+        if thread != self.current_thread:
+            self.sink.append((lineno, TThread(thread)))
+            self.current_thread = thread
+
+    def flush(self) -> None:
+        """Move all the output and all the events of the other threads to the
+        trace."""
+        for thread in [*self.outputs]:
+            self.settle_output(thread)
+        self.move_worker_events()
+
+    def continue_in_child(self, sink: TraceSink) -> None:
+        """After a fork only the thread that forked is left, its events go to the
+        sink of the child process."""
+        self.sink = sink
+        self.tracing_thread = _thread.get_ident()
+        self.workers = {}
+        self.outputs = {}
+        self.current_thread = None
+
+
+@dataclass
+class Loop:
+    first_line: int
+    last_line: int
+    iterations: int = 0
+
+
+def changes_between(before: Symbols, after: Symbols) -> Changes:
+    """Both hold copies already."""
+    return snapshot_changes(after, dict(before), {}, lambda value, memo: value)
+
+
+@dataclass
+class BufferedIteration:
+    """The events of a loop iteration, until we know whether it is the last one."""
+
+    events: list[TraceItem] = field(default_factory=list)
+    # How many times each line was executed (or each function called)
+    line_counts: Counter[int] = field(default_factory=Counter)
+    # The output written since the last event, and the line that wrote it first
+    output: tuple[int, list[str]] | None = None
+    # With delta snapshots: the globals and the locals once the first event is
+    # captured
+    start_state: tuple[Symbols, Symbols] | None = None
+
+    def settle_output(self) -> None:
+        if self.output is not None:
+            lineno, chunks = self.output
+            self.events.append((lineno, TOutput("".join(chunks))))
+            self.output = None
+
+
+class LoopSampler:
+    """
+    Detects loops, to elide their iterations past the first ones.
+
+    A loop shows up as a line event going back to an earlier line (or to the same
+    line) of the same frame. Once a loop has run enough iterations, the events of
+    its thread go to a buffer instead of the trace, until the frame executes a line
+    outside of the loop, or returns. The buffer holds the iteration going on and
+    the one before it, the earlier ones are only counted. When the loop ends, an
+    event marking the elided iterations gets added to the trace, followed by the
+    last iterations: the last complete one, and the start of the next one (where
+    a loop finds out that it is done).
+
+    So the trace doesn't grow with the iterations, but their snapshots still get
+    taken: we only know which iteration is the last one once it is over.
+
+    With delta snapshots, the changes of the first event of the iterations that
+    remain are relative to the state before, which may have been elided. They get
+    replaced by the changes since the last event of the trace.
+    """
+
+    def __init__(self, trace: ThreadedTrace, iterations: int, stats: "Stats"):
+        self.trace = trace
+        self.iterations = iterations
+        self.stats = stats
+        self.last_lines: dict[FrameType, int] = {}
+        # The loops that each frame is in, by first line
+        self.loops: dict[FrameType, dict[int, Loop]] = {}
+        # One loop gets elided at a time, the other threads go on being captured
+        self.eliding: tuple[FrameType, Loop] | None = None
+        self.eliding_thread: int | None = None
+        self.elided_iterations = 0
+        self.line_counts: Counter[int] = Counter()
+        self.previous = BufferedIteration()
+        self.current = BufferedIteration()
+        # Whether the event is the first one of an iteration
+        self.starts_iteration = False
+        # With delta snapshots: the globals and the locals of the loop at the last
+        # event of the trace
+        self.base_state: tuple[Symbols, Symbols] | None = None
+
+    def elides(self, frame: FrameType, event: str) -> bool:
+        """Returns True if the event goes to the buffer, rather than to the
+        trace."""
+        self.starts_iteration = False
+        if self.eliding and _thread.get_ident() == self.eliding_thread:
+            return self.elides_while_eliding(frame, event)
+
+        if event == "line":
+            self.follow_loops(frame, frame.f_lineno)
+        elif event == "return":
+            self.last_lines.pop(frame, None)
+            self.loops.pop(frame, None)
+        return False
+
+    def follow_loops(self, frame: FrameType, lineno: int) -> None:
+        last_line = self.last_lines.get(frame)
+        self.last_lines[frame] = lineno
+        loops = self.loops.setdefault(frame, {})
+        for loop in [*loops.values()]:
+            if not loop.first_line <= lineno <= loop.last_line:
+                del loops[loop.first_line]
+
+        if last_line is None or lineno > last_line:
+            return
+        loop = loops.setdefault(lineno, Loop(lineno, last_line))
+        loop.last_line = max(loop.last_line, last_line)
+        loop.iterations += 1
+        if loop.iterations >= self.iterations and self.eliding is None:
+            debug_heading("ELIDING LOOP ITERATIONS")
+            debug(loop)
+            self.eliding = frame, loop
+            self.eliding_thread = _thread.get_ident()
+            # This event still goes to the trace, the next ones to the buffer
+            self.start_iteration()
+
+    def elides_while_eliding(self, frame: FrameType, event: str) -> bool:
+        assert self.eliding
+        loop_frame, loop = self.eliding
+        lineno = frame.f_lineno
+        if frame is loop_frame:
+            left_loop = event == "return" or (
+                event == "line" and not loop.first_line <= lineno <= loop.last_line
+            )
+            if left_loop:
+                self.end_elision(loop_frame, loop)
+                return self.elides(frame, event)
+            if event == "line" and lineno == loop.first_line:
+                self.start_iteration()
+
+        if event in ("line", "call"):
+            self.current.line_counts[lineno] += 1
+        return True
+
+    def start_iteration(self) -> None:
+        """The iteration before the previous one is not the last one, it gets
+        elided."""
+        self.current.settle_output()
+        elided = self.previous
+        if elided.events:
+            self.elided_iterations += 1
+            self.line_counts.update(elided.line_counts)
+            self.stats.captured -= len(elided.events)
+            self.stats.elided += len(elided.events)
+        self.previous, self.current = self.current, BufferedIteration()
+        self.starts_iteration = True
+
+    def keep_state(self, globs: Symbols, locs: Symbols, buffered: bool) -> None:
+        """The state of the loop once the first event of an iteration is captured,
+        or once the last event before the buffered ones is."""
+        state = dict(globs), dict(locs)
+        if buffered:
+            self.current.start_state = state
+        else:
+            self.base_state = state
+
+    def append(self, item: TraceItem) -> None:
+        self.current.settle_output()
+        self.current.events.append(item)
+
+    def write(self, text: str, lineno: Callable[[], int]) -> None:
+        """Like ThreadedTrace.write, for the thread of the loop."""
+        if self.current.output is None:
+            self.current.output = lineno(), [text]
+        else:
+            self.current.output[1].append(text)
+
+    def end_elision(self, frame: FrameType, loop: Loop) -> None:
+        debug_heading("END OF ELIDED LOOP ITERATIONS")
+        if self.elided_iterations:
+            elided = TElided(
+                self.elided_iterations, loop.last_line, dict(self.line_counts)
+            )
+            self.trace.append((loop.first_line, elided))
+            self.rebase(self.previous)
+        for iteration in (self.previous, self.current):
+            iteration.settle_output()
+            for lineno, event in iteration.events:
+                if isinstance(event, TOutput):
+                    # Within the limits of the output stored
+                    event = TOutput(self.trace.output.text([event.text]))
+                self.trace.append((lineno, event))
+        del self.loops[frame][loop.first_line]
+        self.eliding = None
+        self.eliding_thread = None
+        self.elided_iterations = 0
+        self.line_counts = Counter()
+        self.previous = BufferedIteration()
+        self.current = BufferedIteration()
+        self.base_state = None
+
+    def rebase(self, iteration: BufferedIteration) -> None:
+        """Make the changes of the first event of the iteration relative to the
+        last event of the trace."""
+        if self.base_state is None or iteration.start_state is None:
+            return
+        base_globals, base_locals = self.base_state
+        globs, locs = iteration.start_state
+        lineno, event = iteration.events[0]
+        assert isinstance(event, TLine)
+        iteration.events[0] = (
+            lineno,
+            event._replace(
+                globals=changes_between(base_globals, globs),
+                locals=changes_between(base_locals, locs),
+            ),
+        )
+
+    def finish(self) -> None:
+        """The traced code stopped in the middle of the loop."""
+        if self.eliding:
+            self.end_elision(*self.eliding)
+
+
+def ignore_function(name: str) -> bool:
+    return name.startswith("__")
 
 
 class OutputLogger:
     """
-    OutputLogger wraps stdout. It passes down writes and flushes to it,
+    OutputLogger wraps stdout (or stderr). It passes down writes and flushes to it,
     while simultaneously capturing the text to the trace.
 
-    Coalesces consecutive outputs. Because for instance print("hello", "world")
-    becomes 4 writes ("hello", " ", "world", "\n")
+    The trace coalesces consecutive outputs. Because for instance
+    print("hello", "world") becomes 4 writes ("hello", " ", "world", "\n")
     """
 
-    def __init__(self, trace: Trace, stdout: TextIO):
+    def __init__(
+        self,
+        trace: ThreadedTrace,
+        stdout: TextIO,
+        loop_sampler: LoopSampler | None = None,
+    ):
         self.trace = trace
         self.stdout = stdout
+        self.loop_sampler = loop_sampler
+        # The text that this thread writes goes to the loop sampler
+        self.buffered_thread: int | None = None
 
     def write(self, text: str) -> None:
         """
         Write to stdout and also record the text in the trace
         """
         self.stdout.write(text)
+        if self.loop_sampler and self.buffered_thread == _thread.get_ident():
+            self.loop_sampler.write(text, self.writer_lineno)
+        else:
+            self.trace.write(text, self.writer_lineno)
 
-        frame = sys._getframe(1)
-        lineno = frame.f_lineno
-
-        if not self.trace:
-            debug_heading("OUTPUT WITH EMPTY TRACE")
-            return
-        prev_lineno, prev_event = self.trace[-1]
-        if prev_lineno == lineno and isinstance(prev_event, TOutput):
-            self.trace[-1] = lineno, TOutput(prev_event.text + text)
-            return
-        self.trace.append((lineno, TOutput(text)))
+    @staticmethod
+    def writer_lineno() -> int:
+        # The frames of write and of ThreadedTrace.write (or LoopSampler.write)
+        # come first
+        return sys._getframe(3).f_lineno
 
     def flush(self):
         self.stdout.flush()
@@ -206,6 +733,10 @@ class OutputLogger:
 
 BOUNDARY_CONAMES = ("<module>", "<string>")
 
+# In a child process, the most events that get lost if it exits without notice
+# in the middle of a function
+CHILD_SAVE_EVENTS = 100
+
 
 class TracerState(Enum):
     WAITING = auto()
@@ -218,64 +749,452 @@ TraceFunc: TypeAlias = Callable[[FrameType, str, Any], Any | None]
 
 @dataclass
 class Stats:
+    """
+    Where the time went, and how much got copied.
+
+    Pass one in the CaptureOptions to get it filled, the times are in nanoseconds.
+    """
+
     start_checks: int = 0
     ignored: int = 0
     captured: int = 0
+    elided: int = 0
+
+    # From the start of the tracer to the end of the traced code
+    run_ns: int = 0
+    # Spent handling the events, snapshots included (and the interpretation, when
+    # it happens while capturing)
+    capture_ns: int = 0
+    snapshot_ns: int = 0
+    # Building the history from the events
+    interpret_ns: int = 0
+    # Spent by the tools, see `timed`
+    table_ns: int = 0
+    render_ns: int = 0
+
+    copied_objects: int = 0
+    # As reported by sys.getsizeof
+    copied_bytes: int = 0
+    # The values that could not be copied, and got referenced instead
+    deepcopy_fallbacks: int = 0
+    # The most events held in memory at once
+    peak_events: int = 0
+    # The characters of output stored in the trace, and the ones past the limits
+    stored_output: int = 0
+    spooled_output: int = 0
+
+    @property
+    def slowdown(self) -> float:
+        """An estimate of how much slower the traced code ran, because of the
+        tracing: the time it ran compared to the time it would have taken without
+        handling the events."""
+        untraced_ns = self.run_ns - self.capture_ns
+        return self.run_ns / untraced_ns if untraced_ns > 0 else 1.0
+
+    @contextmanager
+    def timed(self, phase: str) -> Iterator[None]:
+        """Adds the time spent in the block to the `<phase>_ns` field."""
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            field_name = f"{phase}_ns"
+            elapsed = time.perf_counter_ns() - start
+            setattr(self, field_name, getattr(self, field_name) + elapsed)
+
+    def report(self) -> str:
+        def ms(ns: int) -> str:
+            return f"{ns / 1e6:10.1f} ms"
+
+        return "\n".join(
+            [
+                f"run       {ms(self.run_ns)}",
+                f"capture   {ms(self.capture_ns)}",
+                f"snapshots {ms(self.snapshot_ns)}",
+                f"interpret {ms(self.interpret_ns)}",
+                f"table     {ms(self.table_ns)}",
+                f"render    {ms(self.render_ns)}",
+                f"events: {self.captured} captured, {self.ignored} ignored, "
+                f"{self.elided} elided",
+                f"copies: {self.copied_objects} objects, "
+                f"{self.copied_bytes / 1000:.1f} kB, "
+                f"{self.deepcopy_fallbacks} deepcopy fallbacks",
+                f"peak trace: {self.peak_events} events",
+                f"output: {self.stored_output} characters stored, "
+                f"{self.spooled_output} spooled",
+                f"slowdown: ×{self.slowdown:.1f} (estimated)",
+            ]
+        )
+
+
+@dataclass
+class CaptureOptions:
+    # Only record the bindings that changed since the previous event of the frame.
+    # The trace is then much smaller, the history is the same.
+    delta: bool = False
+
+    # Only retain the first events and/or the last events of the trace
+    keep_first: int | None = None
+    keep_last: int | None = None
+
+    # Only report the trace if the program ends with an uncaught exception
+    only_on_exception: bool = False
+
+    # Write the trace to this file while the program runs, see trace_file
+    record_to: str | None = None
+
+    # Only keep this many iterations of each loop, the following ones are only
+    # counted, except for the last one. See LoopSampler.
+    loop_iterations: int | None = None
+
+    # Only keep the representation of the values (see snapshot.Repr), instead of
+    # copies. Taking them costs less, and they hold on to less memory.
+    repr_only: bool = False
+
+    # The values bigger than this get a summary instead of a copy (see
+    # snapshot.Limits): how many items, how deeply nested, how many bytes
+    max_items: int | None = None
+    max_depth: int | None = None
+    max_bytes: int | None = None
+
+    # The output stored per row and in the whole trace, in characters. The rest
+    # gets spooled to a temporary file (see OutputStore)
+    max_row_output: int | None = 10_000
+    max_output: int | None = 1_000_000
+
+    # Also capture what gets written to stderr
+    capture_stderr: bool = False
+
+    # Give the line, call, return and exception events the time they happened, in
+    # nanoseconds. The clock only runs while the traced code does: the time spent
+    # handling the events is left out (the threads share the clock though).
+    timestamps: bool = False
+
+    # Gets filled while tracing
+    stats: Stats | None = field(default=None, compare=False, repr=False)
+
+    def __post_init__(self):
+        if self.delta and self.keep_last is not None:
+            raise ValueError("The last events of a delta trace cannot be retained")
+        if self.record_to is not None and not self.retains_everything():
+            raise ValueError("A recorded trace retains all the events")
+
+    def retains_everything(self) -> bool:
+        return self.keep_first is None and self.keep_last is None
+
+    def limits(self) -> Limits | None:
+        if self.max_items is None and self.max_depth is None and self.max_bytes is None:
+            return None
+        return Limits(self.max_items, self.max_depth, self.max_bytes)
+
+
+class Engine(Enum):
+    SETTRACE = auto()
+    MONITORING = auto()
+
+
+# PyPy and CPython < 3.12 don't have sys.monitoring
+_monitoring: Any = getattr(sys, "monitoring", None)
+
+
+def default_engine() -> Engine:
+    return Engine.MONITORING if _monitoring else Engine.SETTRACE
+
+
+class CodePlan(NamedTuple):
+    """What the tracer decided about a code object, the first time it saw it."""
+
+    # Keeps the code alive, so that its id doesn't get reused
+    code: CodeType
+    of_interest: bool
+    # The code of atrace itself
+    in_atrace: bool
+    # The locals left out of the snapshots, for the calls of this code
+    skipped_locals: Skipped
 
 
 class Tracer:
+    """
+    The state machine that waits for the start of the traced code, captures its
+    events and hands the trace over once the traced code is done.
+
+    The events themselves are delivered by a capture engine, which translates
+    what the interpreter reports into settrace style (frame, event, arg) calls
+    to `handle_event`.
+
+    With a scope, only the calls of that code (and of the code defined inside it)
+    get traced, starting with its next call. Otherwise the traced code is the
+    next module that runs, or the frame given to `attach`.
+    """
+
     def __init__(
-        self, done_callback: DoneCallback, attached_to_frame: FrameType | None
+        self,
+        done_callback: DoneCallback | None,
+        attached_to_frame: FrameType | None,
+        engine: Engine | None = None,
+        options: CaptureOptions | None = None,
+        source: str | None = None,
+        history_callback: HistoryCallback | None = None,
+        scope: CodeType | None = None,
     ):
+        """
+        The done callback gets the trace once the traced code is done.
+        With a history callback instead, the events get interpreted while they are
+        captured, and the callback gets the history.
+        """
         debug_heading("TRACER __INIT__")
         debug("param attached_to_frame:", attached_to_frame)
         debug_stack_frame()
 
-        self.stats = Stats()
+        if (done_callback is None) == (history_callback is None):
+            raise ValueError("Pass either a done callback or a history callback")
+        self.options = options or CaptureOptions()
+        self.stats = self.options.stats if self.options.stats is not None else Stats()
+        self.fallbacks_at_start = COPY_STATS.deepcopy_fallbacks
         self.done_callback = done_callback
+        self.history_callback = history_callback
         self.attached_to_frame = attached_to_frame
         self.state = TracerState.WAITING
-        self.trace: Trace = []
+        self.trace: TraceSink
+        self.writer: TraceWriter | None = None
+        self.interpreted: InterpretedTrace | None = None
+        if history_callback is not None:
+            if self.options.record_to or not self.options.retains_everything():
+                raise ValueError("A history is built from all the events")
+            # Import only here, to avoid circular import problems
+            from . import interpreter  # noqa: E402
+
+            self.trace = self.interpreted = interpreter.InterpretedTrace(self.stats)
+        elif self.options.record_to is not None:
+            # Import only here, to avoid circular import problems
+            from . import trace_file  # noqa: E402
+
+            self.trace = self.writer = trace_file.TraceWriter(
+                self.options.record_to, source
+            )
+        elif self.options.retains_everything():
+            self.trace = []
+        else:
+            self.trace = RetainedTrace(
+                self.options.keep_first or 0, self.options.keep_last or 0
+            )
+        # The events of all the threads go through here
+        self.output = OutputStore(self.options.max_row_output, self.options.max_output)
+        self.threaded = ThreadedTrace(self.trace, self.output)
+        self.loop_sampler = (
+            None
+            if self.options.loop_iterations is None
+            else LoopSampler(self.threaded, self.options.loop_iterations, self.stats)
+        )
+        self.output_loggers: list[OutputLogger] = []
+        # The exception raised in the traced module, until it gets handled
+        self.pending_exception: BaseException | None = None
         self.original_stdout = sys.stdout
+        self.original_stderr = sys.stderr
         self.target_codeobj: CodeType | None = None
+        # The frame whose return ends the tracing
+        self.target_frame: FrameType | None = None
+        self.scope = scope
+        self.scope_codes = None if scope is None else nested_codes(scope)
+        # The name of the temporary directory where the child processes save their
+        # trace, see merge_processes
+        self.processes_dir: str | None = None
+        self.owns_processes_dir = False
+        # Tracing in a child process, until it exits
+        self.in_child = False
+        # The events of the child process that are not saved yet
+        self.unsaved_events = 0
+        self.copier: Copier = copy_repr if self.options.repr_only else copy_value
+        limits = self.options.limits()
+        if limits is not None and not self.options.repr_only:
+            # Representations are bounded already
+            self.copier = capped(self.copier, limits)
+        # Code objects hash their whole content, they are looked up by id
+        self.code_plans: dict[int, CodePlan] = {}
+        # The globals left out of the snapshots, by id of the module dict. The
+        # skipped values are compared by identity, so a reused id is harmless.
+        self.skipped_globals: dict[int, Skipped] = {}
+        # The state that the changes are computed against, in delta mode
+        self.previous_globals: Symbols = {}
+        self.previous_locals: dict[FrameType, Symbols] = {}
+
+        self.started_ns = self.event_start = time.perf_counter_ns()
+        self.capture_engine = start_capture_engine(
+            engine or default_engine(), self, attached_to_frame
+        )
 
-        sys.settrace(self.trace_vars)
-        if attached_to_frame:
-            attached_to_frame.f_trace = self.trace_vars
-
-    def trace_vars(self, frame: FrameType, event: str, arg: Any) -> TraceFunc | None:
+    def handle_event(self, frame: FrameType, event: str, arg: Any) -> bool:
+        """
+        Process one event. Returns True if the events of this frame are of interest.
+        """
+        start = self.event_start = time.perf_counter_ns()
+        of_interest = False
         match self.state:
             case TracerState.WAITING:
                 self.stats.start_checks += 1
                 if self.is_start(frame, event, arg):
-                    sys.stdout = OutputLogger(
-                        trace=self.trace, stdout=self.original_stdout
-                    )
-                    self.target_codeobj = frame.f_code
-                    self.state = TracerState.TRACING
+                    self.start(frame)
+                    if self.scope is not None:
+                        # The program ran before, its globals are where the
+                        # history starts from
+                        self.threaded.append((frame.f_lineno, TGap(0, [], [-1])))
                     # We start tracing right away
-                    self.handle_tracing(frame, event, arg)
+                    of_interest = self.handle_tracing(frame, event, arg)
 
             case TracerState.TRACING:
-                self.handle_tracing(frame, event, arg)
+                of_interest = self.handle_tracing(frame, event, arg)
 
             case TracerState.DONE:
-                debug_heading("RECEIVING EVENTS AFTER DONE")
-                debug_frame(frame)
+                if DEBUG:
+                    debug_heading("RECEIVING EVENTS AFTER DONE")
+                    debug_frame(frame)
 
         if self.is_end(frame, event, arg):
+            self.stats.capture_ns += time.perf_counter_ns() - start
             self.unload()
             self.state = TracerState.DONE
+            return False
 
-        if self.state == TracerState.TRACING and self.is_of_interest(frame, event, arg):
-            return self.trace_vars
+        self.stats.capture_ns += time.perf_counter_ns() - start
+        return self.state == TracerState.TRACING and of_interest
+
+    def start(self, frame: FrameType) -> None:
+        self.start_output_capture()
+        self.target_codeobj = frame.f_code
+        self.target_frame = None if self.in_child else frame
+        self.state = TracerState.TRACING
+        self.share_processes_dir()
+        _tracing_tracers.add(self)
+        if self.writer is not None:
+            self.writer.write_source(
+                "".join(linecache.getlines(frame.f_code.co_filename))
+            )
+
+    def attach(self, frame: FrameType) -> None:
+        """
+        Start tracing a frame that is already running, from its next line.
+        The trace starts with a gap, the values that the frame holds already are
+        where the history starts from.
+        """
+        self.start(frame)
+        call_stack = [frame.f_code.co_name]
+        self.threaded.append(
+            (frame.f_lineno, TGap(0, call_stack, [-1, frame.f_lineno]))
+        )
+
+    def finish(self) -> None:
+        """End the tracing before the traced code is done."""
+        if self.state == TracerState.TRACING:
+            self.unload()
+        elif self.state == TracerState.WAITING:
+            self.capture_engine.stop()
+        self.state = TracerState.DONE
+
+    def cancel(self) -> None:
+        """End the tracing and discard what was captured."""
+        self.done_callback = self.history_callback = None
+        self.finish()
+
+    def share_processes_dir(self) -> None:
+        """The child processes find where to save their trace in the environment,
+        the directory only gets created by the first one."""
+        self.processes_dir = os.environ.get(PROCESSES_DIR_VARIABLE)
+        if self.processes_dir is None:
+            self.processes_dir = f"atrace-processes-{os.getpid()}-{self.started_ns}"
+            os.environ[PROCESSES_DIR_VARIABLE] = self.processes_dir
+            self.owns_processes_dir = True
+
+    def processes_path(self) -> str:
+        # Only the name gets shared, finding the temporary directory takes some
+        # imports and a write, it waits until there are children
+        import tempfile
+
+        assert self.processes_dir
+        return os.path.join(tempfile.gettempdir(), self.processes_dir)
+
+    def continue_in_process(self) -> None:
+        """
+        Called in a child process: its events go to a trace file of its own, that
+        the parent merges once it's done. The tracing goes on until the child exits.
+        """
+        # Import only here, to avoid circular import problems
+        from . import trace_file  # noqa: E402
+
+        processes_path = self.processes_path()
+        os.makedirs(processes_path, exist_ok=True)
+        path = os.path.join(
+            processes_path, f"{time.perf_counter_ns()}-{os.getpid()}.atrace"
+        )
+        self.trace = self.writer = trace_file.TraceWriter(path)
+        self.threaded.continue_in_child(self.writer)
+        self.interpreted = None
+        self.done_callback = self.history_callback = None
+        self.owns_processes_dir = False
+        self.in_child = True
+        self.unsaved_events = 0
+        self.target_frame = None
+        # The values from before the child started are where its history starts
+        self.threaded.append((0, TGap(0, [], [-1])))
+
+    def save_child_trace(self, frame: FrameType, event: str) -> None:
+        """
+        A child process can exit without notice (multiprocessing ends them with
+        os._exit, a forked child can call it anywhere), so its trace gets saved:
+        - each time the traced code returns to code that is not traced
+        - at each line of the module
+        - every CHILD_SAVE_EVENTS events
+        """
+        self.unsaved_events += 1
+        if event == "line":
+            save = frame.f_code is self.target_codeobj
+        elif event == "return":
+            caller = frame.f_back
+            save = caller is None or not self.code_plan(caller.f_code).of_interest
         else:
-            return None
+            save = False
+        if save or self.unsaved_events >= CHILD_SAVE_EVENTS:
+            self.threaded.flush()
+            assert self.writer
+            self.writer.flush()
+            self.unsaved_events = 0
+
+    def merge_processes(self) -> None:
+        """Append the traces of the child processes, in the order they started,
+        each one after a TProcess event."""
+        processes_path = self.processes_path()
+        if not os.path.isdir(processes_path):
+            return
+        # Import only here, to avoid circular import problems
+        from .trace_file import TraceReader  # noqa: E402
+
+        started_and_pids = sorted(
+            tuple(int(part) for part in name.removesuffix(".atrace").split("-"))
+            for name in os.listdir(processes_path)
+        )
+        for started, pid in started_and_pids:
+            path = os.path.join(processes_path, f"{started}-{pid}.atrace")
+            try:
+                reader = TraceReader(path)
+            except ValueError:
+                reader = None  # The child exited before saving anything
+            if reader is not None:
+                self.trace.append((0, TProcess(pid)))
+                for item in reader:
+                    self.trace.append(item)
+                reader.close()
+            os.remove(path)
+        # A child that is still running could be writing its trace
+        with suppress(OSError):
+            os.rmdir(processes_path)
 
     def is_start(self, frame: FrameType, event: str, arg: Any) -> bool:
-        debug_heading("LOOKING FOR START")
-        debug(f"event: {event}")
-        debug_frame(frame)
+        if DEBUG:
+            debug_heading("LOOKING FOR START")
+            debug(f"event: {event}")
+            debug_frame(frame)
+
+        if self.scope is not None:
+            return event == "call" and frame.f_code is self.scope
 
         if frame.f_code.co_name in BOUNDARY_CONAMES:
             debug_heading("FOUND START")
@@ -284,57 +1203,199 @@ class Tracer:
         else:
             return False
 
-    def handle_tracing(self, frame: FrameType, event: str, arg: Any) -> None:
-        if self.is_of_interest(frame, event, arg):
+    def handle_tracing(self, frame: FrameType, event: str, arg: Any) -> bool:
+        """Returns True if the events of this frame are of interest."""
+        if not self.is_of_interest(frame, event, arg):
+            if DEBUG:
+                debug_heading("IGNORING EVENT")
+                debug(f"event: {event}")
+                debug_frame(frame)
+            self.stats.ignored += 1
+            return False
+        if DEBUG:
             debug_heading("CAPTURING EVENT")
             debug(f"event: {event}")
             debug_frame(frame)
-            self.capture(frame, event, arg)
-            self.stats.captured += 1
-        else:
-            debug_heading("IGNORING EVENT")
-            debug(f"event: {event}")
-            debug_frame(frame)
-            self.stats.ignored += 1
+        self.capture(frame, event, arg, self.elides(frame, event))
+        self.stats.captured += 1
+        return True
 
-    def capture(self, frame: FrameType, event: str, arg: Any) -> None:
-        globs = copy_carefully(filtered_variables(frame.f_globals))
-        locs = (
-            {}
-            if frame.f_locals is frame.f_globals
-            else copy_carefully(filtered_variables(frame.f_locals))
+    def elides(self, frame: FrameType, event: str) -> bool:
+        """Returns True if the event goes to the loop sampler, it may get elided."""
+        if self.loop_sampler is None:
+            return False
+        elides = self.loop_sampler.elides(frame, event)
+        for output_logger in self.output_loggers:
+            output_logger.buffered_thread = self.loop_sampler.eliding_thread
+        return elides
+
+    def start_output_capture(self) -> None:
+        sys.stdout = stdout = OutputLogger(
+            self.threaded, self.original_stdout, self.loop_sampler
         )
+        self.output_loggers.append(stdout)
+        if self.options.capture_stderr:
+            sys.stderr = stderr = OutputLogger(
+                self.threaded, self.original_stderr, self.loop_sampler
+            )
+            self.output_loggers.append(stderr)
+
+    def capture(
+        self, frame: FrameType, event: str, arg: Any, buffered: bool = False
+    ) -> None:
+        globs: Symbols
+        locs: Symbols
+        # The handling of this event and of the earlier ones is left out
+        stamp = (
+            self.event_start - self.stats.capture_ns
+            if self.options.timestamps
+            else None
+        )
+        start = time.perf_counter_ns()
+        # Globals and locals share the memo, values they share get copied once
+        memo: Memo = {}
+        if self.options.delta:
+            globs, locs = self.capture_changes(frame, event, memo)
+            if self.loop_sampler and self.loop_sampler.starts_iteration:
+                self.loop_sampler.keep_state(
+                    self.previous_globals, self.previous_locals[frame], buffered
+                )
+        else:
+            skipped_globals, skipped_locals = self.skipped_names(frame)
+            globs = snapshot(frame.f_globals, memo, self.copier, skipped_globals)
+            locs = (
+                {}
+                if frame.f_locals is frame.f_globals
+                else snapshot(frame.f_locals, memo, self.copier, skipped_locals)
+            )
+        self.stats.snapshot_ns += time.perf_counter_ns() - start
+        if memo:
+            self.count_copies(memo)
 
         trace_event: TEvent | None = None
         match event:
             case "line":
-                trace_event = TLine(globals=globs, locals=locs)
+                trace_event = TLine(globals=globs, locals=locs, time=stamp)
             case "call":
                 trace_event = TCall(
-                    globals=globs, locals=locs, function_name=frame.f_code.co_name
+                    globals=globs,
+                    locals=locs,
+                    function_name=frame.f_code.co_name,
+                    time=stamp,
                 )
             case "return":
-                trace_event = TReturn(globals=globs, locals=locs, return_value=arg)
+                # The table shows nothing for None
+                if self.options.repr_only and arg is not None:
+                    return_value = copy_repr(arg, {})
+                    arg = arg if return_value is SKIP else return_value
+                trace_event = TReturn(
+                    globals=globs, locals=locs, return_value=arg, time=stamp
+                )
             case "exception":
+                if frame.f_code is self.target_codeobj:
+                    self.pending_exception = arg[1]
                 trace_event = TException(
                     globals=globs,
                     locals=locs,
                     type=arg[0],
                     value=arg[1],
                     traceback=arg[2],
+                    time=stamp,
                 )
             case _:
                 pass
 
-        if trace_event:
-            self.trace.append((frame.f_lineno, trace_event))
+        if event == "line" and frame.f_code is self.target_codeobj:
+            self.pending_exception = None
+
+        if trace_event and buffered:
+            assert self.loop_sampler
+            self.loop_sampler.append((frame.f_lineno, trace_event))
+        elif trace_event:
+            self.threaded.append((frame.f_lineno, trace_event))
+            if self.in_child:
+                self.save_child_trace(frame, event)
+
+    def count_copies(self, memo: Memo) -> None:
+        # deepcopy keeps the originals alive in the memo, under the id of the memo
+        originals = memo.get(id(memo))
+        for value_copy in memo.values():
+            if value_copy is not originals:
+                self.stats.copied_objects += 1
+                self.stats.copied_bytes += sys.getsizeof(value_copy)
+
+    def capture_changes(
+        self, frame: FrameType, event: str, memo: Memo
+    ) -> tuple[Changes, Changes]:
+        """
+        Mirrors what the interpreter does with complete snapshots:
+        - On a call all the locals are new, and the globals are left for the
+          next event
+        - On a return the frame is done (or suspended, for generators)
+        """
+        skipped_globals, skipped_locals = self.skipped_names(frame)
+        if event == "call":
+            globs = Changes()
+            previous_locals = self.previous_locals[frame] = {}
+        else:
+            globs = snapshot_changes(
+                frame.f_globals,
+                self.previous_globals,
+                memo,
+                self.copier,
+                skipped_globals,
+            )
+            previous_locals = self.previous_locals.setdefault(frame, {})
+
+        # At module level the locals are the globals, except within inlined
+        # comprehensions
+        module_level = frame.f_locals is frame.f_globals
+        locs = snapshot_changes(
+            {} if module_level else frame.f_locals,
+            previous_locals,
+            memo,
+            self.copier,
+            skipped_locals,
+        )
 
-    def is_of_interest(self, frame: FrameType, event: str, arg: Any) -> bool:
+        if event == "return":
+            del self.previous_locals[frame]
+
+        return globs, locs
+
+    def skipped_names(self, frame: FrameType) -> tuple[Skipped, Skipped]:
+        """The names left out of the globals and of the locals of the frame."""
+        skipped_globals = self.skipped_globals.get(id(frame.f_globals))
+        if skipped_globals is None:
+            skipped_globals = self.skipped_globals[id(frame.f_globals)] = {}
+        return skipped_globals, self.code_plan(frame.f_code).skipped_locals
+
+    def code_plan(self, code: CodeType) -> CodePlan:
+        plan = self.code_plans.get(id(code))
+        if plan is None:
+            plan = CodePlan(
+                code=code,
+                of_interest=self.is_code_of_interest(code),
+                in_atrace=code.co_filename == __file__,
+                skipped_locals={},
+            )
+            # Until we know the target, any code is of interest
+            if self.target_codeobj is not None:
+                self.code_plans[id(code)] = plan
+        return plan
+
+    def is_code_of_interest(self, code: CodeType) -> bool:
+        if self.scope_codes is not None:
+            return code in self.scope_codes
         # We don't want to step out of the file we are tracing
-        if (
-            self.target_codeobj
-            and self.target_codeobj.co_filename != frame.f_code.co_filename
-        ):
+        return not (
+            self.target_codeobj and self.target_codeobj.co_filename != code.co_filename
+        )
+
+    def is_of_interest(self, frame: FrameType, event: str, arg: Any) -> bool:
+        code = frame.f_code
+        plan = self.code_plans.get(id(code)) or self.code_plan(code)
+        if not plan.of_interest:
             return False
 
         # If we're running from instrumented code, then we ignore frames that were
@@ -342,15 +1403,16 @@ class Tracer:
         if (
             self.attached_to_frame
             and frame.f_back
-            and frame.f_back.f_code.co_filename == __file__
+            and self.code_plan(frame.f_back.f_code).in_atrace
         ):
             return False
 
         return True
 
     def is_end(self, frame: FrameType, event: str, arg: Any) -> bool:
-        # Detect if we are leaving the module we wanted to trace.
-        if event == "return" and frame.f_code == self.target_codeobj:
+        # Detect if we are leaving the module we wanted to trace. It's the frame
+        # that counts: a function in scope can call itself.
+        if event == "return" and frame is self.target_frame:
             debug_heading("FOUND END")
             debug(
                 "because: event is return",
@@ -362,13 +1424,299 @@ class Tracer:
             return False
 
     def unload(self):
+        self.stats.run_ns = time.perf_counter_ns() - self.started_ns
+        self.stats.deepcopy_fallbacks = (
+            COPY_STATS.deepcopy_fallbacks - self.fallbacks_at_start
+        )
         debug_heading("unloading")
         debug(self.stats)
-        sys.settrace(None)
-        if self.attached_to_frame:
-            self.attached_to_frame.f_trace = None
+        self.capture_engine.stop()
+        self.target_frame = None
+        _tracing_tracers.discard(self)
         sys.stdout = self.original_stdout
-        self.done_callback(self.trace)
+        sys.stderr = self.original_stderr
+        if self.loop_sampler:
+            self.loop_sampler.finish()
+        self.threaded.flush()
+        if self.owns_processes_dir:
+            del os.environ[PROCESSES_DIR_VARIABLE]
+            self.merge_processes()
+        self.output.close()
+        self.stats.peak_events = self.held_events()
+        self.stats.stored_output = self.output.stored
+        self.stats.spooled_output = self.output.spooled
+        if self.writer is not None:
+            self.writer.close()
+        if self.options.only_on_exception and not self.ended_with_exception():
+            debug_heading("NO UNCAUGHT EXCEPTION, DISCARDING THE TRACE")
+            return
+        if self.interpreted is not None and self.history_callback:
+            self.history_callback(self.interpreted.history())
+        elif self.writer is not None and self.done_callback:
+            # Import only here, to avoid circular import problems
+            from .trace_file import TraceReader  # noqa: E402
+
+            # Unmaps the file after, the reader maps it again if it is used later on
+            with TraceReader(self.writer.path) as reader:
+                self.done_callback(reader)
+        elif self.done_callback:
+            self.done_callback(self.collected_trace())
+
+    def held_events(self) -> int:
+        """How many events the trace holds in memory, it's the most it ever held."""
+        if isinstance(self.trace, list):
+            return len(self.trace)
+        if isinstance(self.trace, RetainedTrace):
+            return len(self.trace.first) + len(self.trace.last)
+        # The events are handed over as they arrive
+        return 0
+
+    def collected_trace(self) -> Trace:
+        if isinstance(self.trace, RetainedTrace):
+            return self.trace.to_trace()
+        assert isinstance(self.trace, list)
+        return self.trace
+
+    def ended_with_exception(self) -> bool:
+        match self.pending_exception:
+            case None:
+                return False
+            case SystemExit(code=None | 0):
+                return False
+            case _:
+                return True
+
+
+###############################################################################
+# CAPTURE ENGINES
+###############################################################################
+"""
+The engines deliver the interpreter events to the Tracer. Both produce the same Trace.
+
+- sys.settrace works everywhere, but the interpreter calls back into python for
+  every line of every frame, even those we end up ignoring.
+- sys.monitoring (PEP 669, CPython 3.12+) lets us only listen to the code objects
+  we trace, and to turn off the events we don't care about at the source.
+  https://docs.python.org/3/library/sys.monitoring.html
+"""
+
+
+class SettraceEngine:
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+
+    def start(self, attached_to_frame: FrameType | None) -> None:
+        # Imported here, startup is faster without it
+        import threading
+
+        sys.settrace(self.trace_vars)
+        # For the threads that the traced code starts
+        threading.settrace(self.trace_vars)
+        if attached_to_frame:
+            attached_to_frame.f_trace = self.trace_vars
+
+    def trace_vars(self, frame: FrameType, event: str, arg: Any) -> TraceFunc | None:
+        if self.tracer.handle_event(frame, event, arg):
+            return self.trace_vars
+        else:
+            return None
+
+    def stop(self) -> None:
+        import threading
+
+        sys.settrace(None)
+        threading.settrace(None)
+        if self.tracer.attached_to_frame:
+            self.tracer.attached_to_frame.f_trace = None
+
+
+class MonitoringEngine:
+    """
+    Mimics the events that sys.settrace would deliver, the same way CPython
+    implements settrace on top of sys.monitoring:
+    - call: PY_START, PY_RESUME, PY_THROW
+    - line: LINE, and backward JUMPs within a line (one line loops)
+    - return: PY_RETURN, PY_YIELD, PY_UNWIND (with None as the return value)
+    - exception: RAISE, STOP_ITERATION
+
+    Line and return events are only enabled on the code objects of interest,
+    everything else gets disabled the first time we see it.
+    """
+
+    # The tool ids that no other kind of tool reserves come first, so that a
+    # debugger, coverage or a profiler starting after us still gets its own
+    TOOL_IDS = (3, 4, 2, 1, 0)
+
+    # The tool ids we used before in this process
+    used_tool_ids: set[int] = set()
+
+    def __init__(self, tracer: Tracer, tool_id: int):
+        self.tracer = tracer
+        self.tool_id = tool_id
+        # The code objects on which we enabled local events
+        self.watched: set[CodeType] = set()
+        # For each watched code object: instruction offset -> line number
+        self.offset_lines: dict[CodeType, dict[int, int | None]] = {}
+        self.callbacks: dict[int, Callable[..., Any]] = {}
+
+    @staticmethod
+    def acquire_tool_id() -> int | None:
+        for tool_id in MonitoringEngine.TOOL_IDS:
+            try:
+                _monitoring.use_tool_id(tool_id, "atrace")
+                return tool_id
+            except ValueError:
+                continue
+        return None
+
+    def start(self, attached_to_frame: FrameType | None) -> None:
+        self.register_callbacks()
+        events = _monitoring.events
+        # PY_THROW, PY_UNWIND and RAISE cannot be enabled locally
+        _monitoring.set_events(
+            self.tool_id,
+            events.PY_START | events.PY_THROW | events.PY_UNWIND | events.RAISE,
+        )
+        if attached_to_frame:
+            self.watch(attached_to_frame.f_code)
+
+    def start_in_scope(self, scope_codes: set[CodeType]) -> None:
+        """Like start, but calls are only seen in the code of the scope."""
+        self.register_callbacks()
+        events = _monitoring.events
+        _monitoring.set_events(
+            self.tool_id, events.PY_THROW | events.PY_UNWIND | events.RAISE
+        )
+        for code in scope_codes:
+            self.watch(code, events.PY_START)
+
+    def register_callbacks(self) -> None:
+        events = _monitoring.events
+        self.callbacks = {
+            events.PY_START: self.on_start,
+            events.PY_RESUME: self.on_resume,
+            events.PY_THROW: self.on_throw,
+            events.LINE: self.on_line,
+            events.JUMP: self.on_jump,
+            events.PY_RETURN: self.on_return,
+            events.PY_YIELD: self.on_return,
+            events.PY_UNWIND: self.on_unwind,
+            events.RAISE: self.on_exception,
+            events.STOP_ITERATION: self.on_exception,
+        }
+        for event, callback in self.callbacks.items():
+            _monitoring.register_callback(self.tool_id, event, callback)
+
+        # Locations we disabled during an earlier run must be seen again. This
+        # re-enables the locations every other tool disabled too, so they pay for
+        # their events there again until they disable them anew
+        if self.tool_id in MonitoringEngine.used_tool_ids:
+            _monitoring.restart_events()
+        MonitoringEngine.used_tool_ids.add(self.tool_id)
+
+    def watch(self, code: CodeType, extra_events: int = 0) -> None:
+        if code not in self.watched:
+            events = _monitoring.events
+            _monitoring.set_local_events(
+                self.tool_id,
+                code,
+                events.LINE
+                | events.JUMP
+                | events.PY_RETURN
+                | events.PY_YIELD
+                | events.PY_RESUME
+                | events.STOP_ITERATION
+                | extra_events,
+            )
+            self.watched.add(code)
+
+    def stop(self) -> None:
+        _monitoring.set_events(self.tool_id, 0)
+        for code in self.watched:
+            _monitoring.set_local_events(self.tool_id, code, 0)
+        for event in self.callbacks:
+            _monitoring.register_callback(self.tool_id, event, None)
+        _monitoring.free_tool_id(self.tool_id)
+
+    # The callbacks are called from the monitored frame, hence sys._getframe(1)
+
+    def on_start(self, code: CodeType, instruction_offset: int) -> Any:
+        if self.tracer.handle_event(sys._getframe(1), "call", None):
+            self.watch(code)
+        elif (
+            self.tracer.state == TracerState.TRACING
+            and not self.tracer.code_plan(code).of_interest
+        ):
+            return _monitoring.DISABLE
+        return None
+
+    def on_resume(self, code: CodeType, instruction_offset: int) -> Any:
+        self.tracer.handle_event(sys._getframe(1), "call", None)
+
+    def on_throw(self, code: CodeType, instruction_offset: int, exc) -> Any:
+        if code in self.watched:
+            self.tracer.handle_event(sys._getframe(1), "call", None)
+
+    def on_line(self, code: CodeType, line_number: int) -> Any:
+        self.tracer.handle_event(sys._getframe(1), "line", None)
+
+    def on_jump(self, code: CodeType, instruction_offset: int, destination: int) -> Any:
+        if destination > instruction_offset:
+            return _monitoring.DISABLE
+        # Jumping back within a line doesn't generate a LINE event
+        lines = self.offset_lines.get(code)
+        if lines is None:
+            lines = self.offset_lines[code] = {
+                offset: line
+                for start, end, line in code.co_lines()
+                for offset in range(start, end, 2)
+            }
+        if lines.get(destination) != lines.get(instruction_offset):
+            return None
+        self.tracer.handle_event(sys._getframe(1), "line", None)
+
+    def on_return(self, code: CodeType, instruction_offset: int, retval) -> Any:
+        self.tracer.handle_event(sys._getframe(1), "return", retval)
+
+    def on_unwind(self, code: CodeType, instruction_offset: int, exc) -> Any:
+        if code in self.watched:
+            self.tracer.handle_event(sys._getframe(1), "return", None)
+
+    def on_exception(self, code: CodeType, instruction_offset: int, exc) -> Any:
+        if code in self.watched:
+            self.tracer.handle_event(
+                sys._getframe(1), "exception", (type(exc), exc, exc.__traceback__)
+            )
+
+
+CaptureEngine: TypeAlias = SettraceEngine | MonitoringEngine
+
+
+def start_capture_engine(
+    engine: Engine, tracer: Tracer, attached_to_frame: FrameType | None
+) -> CaptureEngine:
+    capture_engine: CaptureEngine = SettraceEngine(tracer)
+    if engine == Engine.MONITORING:
+        tool_id = MonitoringEngine.acquire_tool_id()
+        if tool_id is not None:
+            capture_engine = MonitoringEngine(tracer, tool_id)
+        else:
+            debug_heading("NO FREE MONITORING TOOL ID, FALLING BACK TO SETTRACE")
+    if isinstance(capture_engine, MonitoringEngine) and tracer.scope_codes:
+        capture_engine.start_in_scope(tracer.scope_codes)
+    else:
+        capture_engine.start(attached_to_frame)
+    return capture_engine
+
+
+def nested_codes(code: CodeType) -> set[CodeType]:
+    """The code, and the code of the functions, lambdas, classes and comprehensions
+    defined inside it."""
+    codes = {code}
+    for constant in code.co_consts:
+        if isinstance(constant, CodeType):
+            codes |= nested_codes(constant)
+    return codes
 
 
 ###############################################################################
@@ -376,7 +1724,12 @@ class Tracer:
 ###############################################################################
 
 
-def trace_code(source: str, done_callback: DoneCallback) -> None:
+def trace_code(
+    source: str,
+    done_callback: DoneCallback,
+    engine: Engine | None = None,
+    options: CaptureOptions | None = None,
+) -> None:
     """Generates a trace from Python source code.
 
     The callback architecture ensures that the trace is captured even if the
@@ -386,6 +1739,9 @@ def trace_code(source: str, done_callback: DoneCallback) -> None:
     Args:
         source (str): The Python source code to be executed.
         callback (callable): A function to handle the trace data.
+        engine (Engine | None): How to capture the events, defaults to the
+            fastest one available.
+        options (CaptureOptions | None): What to capture.
 
     Returns:
         list: A list of trace events captured during execution.
@@ -394,33 +1750,241 @@ def trace_code(source: str, done_callback: DoneCallback) -> None:
 
     module = ModuleType("traced_module")
 
-    trace_next_loaded_module(done_callback)
-    exec(compiled, module.__dict__)  # Execute code within the module's namespace
+    tracer = trace_next_loaded_module(done_callback, engine, options, source)
+    try:
+        exec(compiled, module.__dict__)  # Execute code within the module's namespace
+    finally:
+        tracer.finish()
+
+
+def interpret_code(
+    source: str,
+    history_callback: HistoryCallback,
+    engine: Engine | None = None,
+    options: CaptureOptions | None = None,
+) -> None:
+    """Like trace_code, but the events get interpreted while they are captured,
+    instead of being kept until the end. The callback gets the History."""
+    compiled = compile(source=source, filename="", mode="exec")
 
+    module = ModuleType("traced_module")
 
-def trace_next_loaded_module(done_callback: DoneCallback):
+    debug_heading("INTERPRET NEXT LOADED MODULE")
+    tracer = Tracer(None, None, engine, options, source, history_callback)
+    try:
+        exec(compiled, module.__dict__)  # Execute code within the module's namespace
+    finally:
+        # An exception raised inside a trace callback, like the one of a signal
+        # handler, stops the settrace events before the end of the module: the
+        # tracer never sees it
+        tracer.finish()
+
+
+def trace_next_loaded_module(
+    done_callback: DoneCallback,
+    engine: Engine | None = None,
+    options: CaptureOptions | None = None,
+    source: str | None = None,
+) -> "Tracer":
     debug_heading("TRACE NEXT LOADED MODULE")
-    Tracer(done_callback, None)
+    return Tracer(done_callback, None, engine, options, source)
 
 
-def on_trace(trace: Trace):
-    debug_heading("Got trace")
-    debug_pprint(trace)
+def on_history(history: "History"):
+    debug_heading("Got history")
+    debug_pprint(history)
     # Import only here, to avoid circular import problems
-    from .interpreter import trace_to_history  # noqa: E402
     from .reporter import print_history  # noqa: E402
 
-    history = trace_to_history(trace)
     print_history(history)
 
 
+###############################################################################
+# Tracing a part of a program
+###############################################################################
+"""
+Unlike `import atrace`, these only trace inside their scope. Outside of it no
+tracing is installed at all, the rest of the program runs at full speed.
+"""
+
+# The tracer of the scope being traced, scopes inside it don't get traced on their own
+_scope_tracer: Tracer | None = None
+# Set when importing atrace traces the importer
+_import_tracer: Tracer | None = None
+
+
+def _stop_tracing_from_import() -> None:
+    """A program that traces parts of itself does not want to be traced whole."""
+    global _import_tracer
+    if _import_tracer is not None:
+        _import_tracer.cancel()
+        _import_tracer = None
+
+
+def _in_traced_scope() -> bool:
+    return _scope_tracer is not None and _scope_tracer.state != TracerState.DONE
+
+
+class TracingScope:
+    """Traces the lines of a with block, see `tracing`."""
+
+    def __init__(
+        self,
+        engine: Engine | None,
+        options: CaptureOptions | None,
+        history_callback: HistoryCallback | None,
+    ):
+        self.engine = engine
+        self.options = options
+        self.history_callback = history_callback or on_history
+        self.tracer: Tracer | None = None
+
+    def __enter__(self) -> "TracingScope":
+        global _scope_tracer
+        _stop_tracing_from_import()
+        if _in_traced_scope():
+            return self
+        frame = sys._getframe(1)
+        self.tracer = _scope_tracer = Tracer(
+            None,
+            frame,
+            self.engine,
+            self.options,
+            history_callback=self.history_callback,
+        )
+        self.tracer.attach(frame)
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if self.tracer is not None:
+            self.tracer.finish()
+
+
+def tracing(
+    engine: Engine | None = None,
+    options: CaptureOptions | None = None,
+    history_callback: HistoryCallback | None = None,
+) -> TracingScope:
+    """
+    Traces the lines of the with block, and the functions of the same file that
+    they call:
+
+        with atrace.tracing():
+            ...
+
+    The history goes to the callback, by default its table gets printed. The rest of
+    the program is not traced, even when importing atrace started tracing it.
+    """
+    return TracingScope(engine, options, history_callback)
+
+
+def trace(
+    function: Callable | None = None,
+    *,
+    engine: Engine | None = None,
+    options: CaptureOptions | None = None,
+    history_callback: HistoryCallback | None = None,
+) -> Any:
+    """
+    Traces each call of the decorated function, with the functions defined inside
+    it, and hands over the history once the call returns:
+
+        @atrace.trace
+        def f(): ...
+
+        @atrace.trace(options=CaptureOptions(delta=True))
+        def g(): ...
+
+    Recursive calls are part of the outermost call. The history goes to the
+    callback, by default its table gets printed. The rest of the program is not
+    traced, even when importing atrace started tracing it.
+    """
+
+    def decorate(function: Callable) -> Callable:
+        _stop_tracing_from_import()
+        code = getattr(function, "__code__", None)
+        if code is None:
+            raise TypeError(f"{function!r} is not a python function")
+        import inspect
+
+        if inspect.isgeneratorfunction(function) or inspect.iscoroutinefunction(
+            function
+        ):
+            raise TypeError("Generator and coroutine functions cannot be traced")
+
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            global _scope_tracer
+            if _in_traced_scope():
+                return function(*args, **kwargs)
+            tracer = _scope_tracer = Tracer(
+                None,
+                None,
+                engine,
+                options,
+                history_callback=history_callback or on_history,
+                scope=code,
+            )
+            try:
+                return function(*args, **kwargs)
+            finally:
+                # Only needed when the call did not get to start
+                tracer.finish()
+
+        return traced
+
+    return decorate if function is None else decorate(function)
+
+
+###############################################################################
+# Child processes
+###############################################################################
+"""
+The child processes of a traced program (multiprocessing, concurrent.futures,
+os.fork) go on tracing, each one to a trace file of its own. Once the program is
+done these get merged into its trace, the table then has a process column.
+
+- A forked child inherits the tracer, which gets told to continue in the child.
+- A spawned child runs the main module again as __mp_main__, which imports atrace
+  again. The tracer then only starts with the next call of the main module.
+"""
+
+# Set while a program is traced, the directory where its children save their trace
+PROCESSES_DIR_VARIABLE = "ATRACE_PROCESSES_DIR"
+
+# The tracers that are tracing, in a forked child they continue
+_tracing_tracers: set[Tracer] = set()
+
+
+def _continue_in_forked_process() -> None:
+    for tracer in [*_tracing_tracers]:
+        tracer.continue_in_process()
+
+
+# Windows has no fork
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_continue_in_forked_process)
+
+
+def _trace_spawned_process(main_frame: FrameType) -> None:
+    if PROCESSES_DIR_VARIABLE not in os.environ:
+        return  # The parent is not traced
+    tracer = Tracer(lambda trace: None, None)
+    tracer.in_child = True
+    tracer.start(main_frame)
+    tracer.continue_in_process()
+
+
 def _get_importer_frame() -> FrameType | None:
-    # Get the current call stack
-    for frame_info in inspect.stack():
+    # Walk up the call stack. Unlike inspect.stack() this doesn't read the source
+    # lines of every frame
+    frame: FrameType | None = sys._getframe()
+    while frame:
         # Filter out internal importlib frames and the current module's frame
-        filename = frame_info.filename
+        filename = frame.f_code.co_filename
         if not filename.startswith("<") and filename != __file__:
-            return frame_info.frame
+            return frame
+        frame = frame.f_back
     return None
 
 
@@ -430,7 +1994,10 @@ if "unittest" not in sys.modules:
     # We want to only trace the module that imports us
     # Luckily, when run as a tool with -m no importer frame gets found
     importer_frame = _get_importer_frame()
-    if importer_frame:
+    if importer_frame and importer_frame.f_globals.get("__name__") == "__mp_main__":
+        debug_heading("TRACING A SPAWNED PROCESS")
+        _trace_spawned_process(importer_frame)
+    elif importer_frame:
         # When running in thonny we need to step up one level because
         # we get imported from a backend custom_import.
         # We got this extra step even when not in thonny, there is no negative impact.
@@ -438,4 +2005,4 @@ if "unittest" not in sys.modules:
             importer_frame = importer_frame.f_back
         debug_heading("ATTACH TO FRAME")
         debug_frame(importer_frame)
-        Tracer(on_trace, importer_frame)
+        _import_tracer = Tracer(None, importer_frame, history_callback=on_history)
@@ -4,37 +4,47 @@ Displays the trace of a given python program.
 
 import argparse
 
-from atrace.tool_support import terminal_or_svg
+from atrace.tool_support import add_stats_argument, print_stats, terminal_or_svg
 
-from . import Trace, trace_code
-from .interpreter import trace_to_history
+from . import CaptureOptions, Stats
+from .interpreter import History
 from .reporter import history_to_table
+from .trace_file import interpret_or_replay
 
 
 def run():
     parser = argparse.ArgumentParser(
         description="Displays the trace table of the given program"
     )
-    parser.add_argument("program", help="The path to a python file")
+    parser.add_argument(
+        "program",
+        help="The path to a python file, or to a trace saved with atrace.record",
+    )
     parser.add_argument(
         "--svg",
         help="The path to save the trace as an SVG file instead of displaying it",
     )
+    parser.add_argument(
+        "--no-fold",
+        action="store_true",
+        help="Show every row, instead of folding the iterations that repeat",
+    )
+    add_stats_argument(parser)
     options = parser.parse_args()
+    stats = Stats()
 
-    with open(options.program) as content_file:
-        source = content_file.read()
-
-    def on_trace(trace: Trace) -> None:
-        history = trace_to_history(trace)
-        table = history_to_table(history)
+    def on_history(source: str, history: History) -> None:
+        with stats.timed("table"):
+            table = history_to_table(history, fold=not options.no_fold)
 
-        with terminal_or_svg(options.svg) as console:
+        with stats.timed("render"), terminal_or_svg(options.svg) as console:
             console.print()
             console.print(table)
             console.print()
 
-    trace_code(source, on_trace)
+    interpret_or_replay(options.program, on_history, CaptureOptions(stats=stats))
+    if options.stats:
+        print_stats(stats)
 
 
 if __name__ == "__main__":
@@ -7,14 +7,21 @@ import argparse
 from rich.console import Console
 from rich.table import Table
 
-from . import Trace, trace_code
+from . import CaptureOptions, Stats
 from .code import CODE_VIEW_WIDTH, generate_code_display
-from .interpreter import trace_to_history
+from .interpreter import History
 from .reporter import (
     history_to_table_data,
     table_data_to_table,
 )
-from .tool_support import Context, add_line_numbers, animate
+from .tool_support import (
+    Context,
+    add_line_numbers,
+    add_stats_argument,
+    animate,
+    print_stats,
+)
+from .trace_file import interpret_or_replay
 
 
 def max_visible_rows():
@@ -43,18 +50,22 @@ def run():
     parser = argparse.ArgumentParser(
         description="Displays an animated trace of the given program."
     )
-    parser.add_argument("program", help="The path to a python file")
+    parser.add_argument(
+        "program",
+        help="The path to a python file, or to a trace saved with atrace.record",
+    )
+    add_stats_argument(parser)
     options = parser.parse_args()
+    stats = Stats()
 
-    with open(options.program) as content_file:
-        source = content_file.read()
-
-    def on_trace(trace: Trace) -> None:
+    def on_history(source: str, history: History) -> None:
         numbered_lines = add_line_numbers(source)
-        history = trace_to_history(trace)
-        animate(numbered_lines, history, generate_code_and_trace_display)
+        with stats.timed("render"):
+            animate(numbered_lines, history, generate_code_and_trace_display)
 
-    trace_code(source, on_trace)
+    interpret_or_replay(options.program, on_history, CaptureOptions(stats=stats))
+    if options.stats:
+        print_stats(stats)
 
 
 if __name__ == "__main__":
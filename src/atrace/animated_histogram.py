@@ -6,28 +6,35 @@ Displays an animation of a given program, with :
 
 import argparse
 
-from . import Trace, trace_code
+from . import CaptureOptions, Stats
 from .histogram import filter_events, generate_code_and_histogram_display
-from .interpreter import trace_to_history
-from .tool_support import add_line_numbers, animate
+from .interpreter import History
+from .tool_support import add_line_numbers, add_stats_argument, animate, print_stats
+from .trace_file import interpret_or_replay
 
 
 def run():
     parser = argparse.ArgumentParser(
         description="Displays the line histogram of the given program."
     )
-    parser.add_argument("program", help="The path to a python file")
+    parser.add_argument(
+        "program",
+        help="The path to a python file, or to a trace saved with atrace.record",
+    )
+    add_stats_argument(parser)
     options = parser.parse_args()
+    stats = Stats()
 
-    with open(options.program) as content_file:
-        source = content_file.read()
-
-    def on_trace(trace: Trace) -> None:
+    def on_history(source: str, history: History) -> None:
         numbered_lines = add_line_numbers(source)
-        history = filter_events(trace_to_history(trace))
-        animate(numbered_lines, history, generate_code_and_histogram_display)
-
-    trace_code(source, on_trace)
+        with stats.timed("table"):
+            history = filter_events(history)
+        with stats.timed("render"):
+            animate(numbered_lines, history, generate_code_and_histogram_display)
+
+    interpret_or_replay(options.program, on_history, CaptureOptions(stats=stats))
+    if options.stats:
+        print_stats(stats)
 
 
 if __name__ == "__main__":
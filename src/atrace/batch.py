@@ -0,0 +1,366 @@
+"""
+Traces many programs at once, for instance all the submissions to an exercise.
+
+Each program runs in a process of its own, as many at once as there are cores.
+Where possible the processes get forked from this one: they start with atrace and
+rich already imported, and the programs cannot affect each other.
+
+A program that runs out of time gets interrupted, and the trace up to there is
+saved. If it doesn't stop, it gets killed.
+
+The rendered traces go to an output directory that mirrors the directories of the
+programs, along with a summary.json. A summary gets printed at the end.
+"""
+
+import argparse
+import glob
+import io
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from collections import Counter, deque
+from dataclasses import asdict, dataclass
+from multiprocessing.connection import Connection, wait
+from multiprocessing.process import BaseProcess
+from pathlib import Path
+from types import FrameType
+from typing import Any, TypeAlias
+
+from rich.console import Console
+
+from . import interpret_code
+from .interpreter import History
+from .reporter import (
+    LeftAligned,
+    TableData,
+    history_to_table_data,
+    table_data_to_table,
+)
+
+FORMATS = ("text", "svg", "json")
+
+# The width of the rendered tables, the same as the SVG of the other tools
+WIDTH = 120
+
+# How long a program that ran out of time gets to save its trace before it gets
+# killed, in seconds
+GRACE = 10.0
+
+# What became of a program
+OK = "ok"  # It ran to the end
+RAISED = "raised"  # It ended with an uncaught exception, the trace shows it
+TIMEOUT = "timeout"  # It ran out of time, the trace shows what it did until then
+KILLED = "killed"  # It didn't stop in time, nothing was saved
+FAILED = "failed"  # It could not be traced, for instance because of a syntax error
+
+
+class TimeLimit(BaseException):
+    """Interrupts a program that ran out of time. It's not an Exception, so that the
+    program doesn't catch it by mistake."""
+
+
+@dataclass
+class Task:
+    program: str
+    # Where the renderings go, without the suffix
+    output: str
+    # What the program reads from stdin
+    stdin: str
+    formats: list[str]
+    timeout: float
+    # Fold the rows of the iterations that repeat
+    fold: bool = True
+
+
+@dataclass
+class Result:
+    program: str
+    status: str
+    seconds: float = 0.0
+    rows: int = 0
+    error: str | None = None
+
+
+###############################################################################
+# Finding the programs
+###############################################################################
+
+
+def find_programs(paths: list[str]) -> list[Path]:
+    """The python files in the given files, directories and glob patterns."""
+    programs: list[Path] = []
+    for path in paths:
+        if os.path.isdir(path):
+            programs.extend(sorted(Path(path).rglob("*.py")))
+        elif any(character in path for character in "*?["):
+            programs.extend(Path(match) for match in sorted(glob.glob(path)))
+        else:
+            programs.append(Path(path))
+    return programs
+
+
+def common_root(programs: list[Path]) -> Path:
+    return Path(os.path.commonpath([program.resolve().parent for program in programs]))
+
+
+def stdin_of(program: Path, root: Path, fixtures: Path | None) -> str:
+    """
+    A fixture file is read by all the programs. In a fixture directory, each
+    program reads the .txt file at the same path as its own. Without fixture, the
+    program reads nothing.
+    """
+    if fixtures is None:
+        return ""
+    if fixtures.is_dir():
+        fixtures = fixtures / program.resolve().relative_to(root).with_suffix(".txt")
+    return fixtures.read_text() if fixtures.is_file() else ""
+
+
+###############################################################################
+# Running one program, in its own process
+###############################################################################
+
+
+def raise_time_limit(signal_number: int, frame: FrameType | None) -> None:
+    raise TimeLimit()
+
+
+def trace_program(
+    source: str, stdin: str, timeout: float
+) -> tuple[str, str | None, History | None]:
+    """Trace the source within the time limit. Returns the status, the error if
+    any, and the history if the program got to start."""
+    status, error = OK, None
+    histories: list[History] = []
+
+    sys.stdin = io.StringIO(stdin)
+    # The output is part of the trace
+    sys.stdout = sys.stderr = io.StringIO()
+    # Time limits need SIGALRM, Windows has none: there the programs get killed
+    if hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, raise_time_limit)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        interpret_code(source, histories.append)
+    except TimeLimit:
+        status = TIMEOUT
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            status, error = RAISED, f"SystemExit: {e.code}"
+    except Exception as e:
+        # Without history the program didn't even start
+        status = RAISED if histories else FAILED
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        if hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return status, error, histories[0] if histories else None
+
+
+def run_task(task: Task, connection: Connection) -> None:
+    """Trace the program, save its renderings and send back how it went."""
+    start = time.perf_counter()
+    result = Result(task.program, OK)
+
+    program = Path(task.program).resolve()
+    sys.argv = [task.program]
+    try:
+        source = program.read_text()
+        os.chdir(program.parent)
+    except OSError as e:
+        result.status, result.error = FAILED, f"{type(e).__name__}: {e}"
+    else:
+        result.status, result.error, history = trace_program(
+            source, task.stdin, task.timeout
+        )
+        if history:
+            result.rows = save(history, Path(task.output), task.formats, task.fold)
+    result.seconds = time.perf_counter() - start
+    connection.send(asdict(result))
+
+
+SUFFIXES = {"text": ".txt", "svg": ".svg", "json": ".json"}
+
+
+def table_json(table_data: TableData) -> dict[str, Any]:
+    headers, rows = table_data
+    names = [
+        header.header if isinstance(header, LeftAligned) else header
+        for header in headers
+    ]
+    return {"headers": names, "rows": rows}
+
+
+def render(table_data: TableData, format: str, title: str) -> str:
+    if format == "json":
+        return json.dumps(table_json(table_data), ensure_ascii=False) + "\n"
+    console = Console(record=True, file=io.StringIO(), width=WIDTH)
+    console.print(table_data_to_table(table_data))
+    if format == "svg":
+        return console.export_svg(title=title)
+    return console.export_text()
+
+
+def save(history: History, output: Path, formats: list[str], fold: bool = True) -> int:
+    """Save the renderings of the trace, returns how many rows it has."""
+    output.parent.mkdir(parents=True, exist_ok=True)
+    table_data = history_to_table_data(history, fold)
+    for format in formats:
+        rendering = render(table_data, format, output.name)
+        output.with_suffix(SUFFIXES[format]).write_text(rendering)
+    return len(table_data[1])
+
+
+###############################################################################
+# Running all of them
+###############################################################################
+
+
+def process_class() -> type[BaseProcess]:
+    # Forked processes start with everything imported already
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork").Process
+    return multiprocessing.Process
+
+
+Running: TypeAlias = tuple[Task, BaseProcess, Connection, float]
+
+
+def run_tasks(tasks: list[Task], jobs: int) -> list[Result]:
+    """Run the tasks, at most jobs at once. The results come in the order the
+    tasks end."""
+    process_type = process_class()
+    results: list[Result] = []
+    pending = deque(tasks)
+    # process sentinel -> the task, its process, where its result arrives, and when
+    # it gets killed
+    running: dict[int, Running] = {}
+    while pending or running:
+        while pending and len(running) < jobs:
+            task = pending.popleft()
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = process_type(target=run_task, args=(task, sender), daemon=True)
+            started = time.monotonic()
+            process.start()
+            sender.close()
+            kill_at = started + task.timeout + GRACE
+            running[process.sentinel] = task, process, receiver, kill_at
+
+        next_kill = min(kill_at for *_, kill_at in running.values())
+        ended = wait(list(running), timeout=max(0.0, next_kill - time.monotonic()))
+        now = time.monotonic()
+        for sentinel, (task, process, receiver, kill_at) in [*running.items()]:
+            if sentinel in ended:
+                process.join()
+                if receiver.poll():
+                    results.append(Result(**receiver.recv()))
+                else:
+                    error = f"The process exited with code {process.exitcode}"
+                    results.append(Result(task.program, FAILED, error=error))
+            elif now >= kill_at:
+                process.kill()
+                process.join()
+                seconds = task.timeout + GRACE
+                results.append(Result(task.program, KILLED, seconds))
+            else:
+                continue
+            receiver.close()
+            del running[sentinel]
+    return results
+
+
+def summary(results: list[Result], seconds: float, jobs: int) -> str:
+    statuses = Counter(result.status for result in results)
+    lines = [
+        f"Traced {len(results)} programs in {seconds:.1f} s "
+        f"({len(results) / seconds:.1f} programs/s, {jobs} at once)",
+        "  "
+        + ", ".join(
+            f"{statuses[status]} {status}"
+            for status in (OK, RAISED, TIMEOUT, KILLED, FAILED)
+        ),
+    ]
+    problems = [result for result in results if result.status in (KILLED, FAILED)]
+    if problems:
+        lines.append("Not traced:")
+        for result in sorted(problems, key=lambda result: result.program):
+            lines.append(f"  {result.program}: {result.status} {result.error or ''}")
+    return "\n".join(lines)
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Traces many programs in parallel, and saves their traces"
+    )
+    parser.add_argument(
+        "programs",
+        nargs="+",
+        help="Python files, directories of python files, or glob patterns",
+    )
+    parser.add_argument(
+        "--output", default="traces", help="The directory of the rendered traces"
+    )
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        action="append",
+        help="How to render the traces, can be repeated, defaults to text",
+    )
+    parser.add_argument(
+        "--input",
+        help="What the programs read from stdin: a file for all of them, or a "
+        "directory with a .txt file per program, at the same path as the program",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=10.0, help="Seconds per program"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="How many programs run at once, defaults to the number of cores",
+    )
+    parser.add_argument(
+        "--no-fold",
+        action="store_true",
+        help="Show every row, instead of folding the iterations that repeat",
+    )
+    options = parser.parse_args()
+
+    programs = find_programs(options.programs)
+    if not programs:
+        parser.error("No python files found")
+    root = common_root(programs)
+    output = Path(options.output).resolve()
+    fixtures = Path(options.input) if options.input else None
+    formats = options.format or ["text"]
+    tasks = [
+        Task(
+            program=str(program),
+            output=str(output / program.resolve().relative_to(root).with_suffix("")),
+            stdin=stdin_of(program, root, fixtures),
+            formats=formats,
+            timeout=options.timeout,
+            fold=not options.no_fold,
+        )
+        for program in programs
+    ]
+
+    start = time.perf_counter()
+    results = run_tasks(tasks, options.jobs)
+    seconds = time.perf_counter() - start
+
+    output.mkdir(parents=True, exist_ok=True)
+    (output / "summary.json").write_text(
+        json.dumps([asdict(result) for result in results], indent=2) + "\n"
+    )
+    print(summary(results, seconds, options.jobs))
+    if any(result.status in (KILLED, FAILED) for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,288 @@
+"""
+Measures how fast programs get traced, to compare commits and Python versions.
+
+Runs each program untraced, then traced, then turns the trace into a history and a
+table. Reports the events captured per second, the slowdown compared to the
+untraced run, and the time of each phase. The results go to a JSON file, which a
+later run can compare itself to.
+
+Besides the given programs, generated stress programs are always measured: a long
+loop, a deep recursion, a growing list and many variables.
+
+The startup gets measured too: how long `import atrace` takes and what it imports,
+and how long a whole run of a tiny program takes, compared to Python alone. For
+short programs the startup is most of the time.
+"""
+
+import argparse
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import Any
+from unittest.mock import patch
+
+from . import CaptureOptions, Engine, Stats, Trace, default_engine, trace_code
+from .interpreter import trace_to_history
+from .reporter import history_to_table_data
+
+# The answer to the programs that ask for input
+ANSWER = "R"
+
+CONFIGURATIONS = {
+    "default": CaptureOptions,
+    "delta": lambda: CaptureOptions(delta=True),
+    "repr_only": lambda: CaptureOptions(repr_only=True),
+}
+
+
+def stress_programs(scale: float) -> dict[str, str]:
+    def size(n: int) -> int:
+        return max(1, int(n * scale))
+
+    variables = size(300)
+    return {
+        "long_loop": f"total = 0\nfor i in range({size(20_000)}):\n    total += i\n",
+        "deep_recursion": (
+            "def down(n):\n"
+            "    if n == 0:\n"
+            "        return 0\n"
+            "    return 1 + down(n - 1)\n\n"
+            # Stays below the default recursion limit
+            f"result = down({min(size(500), 900)})\n"
+        ),
+        "large_list": (
+            f"data = []\nfor i in range({size(2_000)}):\n    data.append(i)\n"
+        ),
+        "many_variables": "".join(f"v{i} = {i}\n" for i in range(variables))
+        + f"for i in range(100):\n    v{variables - 1} += i\n",
+    }
+
+
+# Imports only needed to render, `import atrace` should not do any of them: they
+# wait until the program is done
+RENDERING_MODULES = ("rich", "gettext", "configparser", "tempfile", "atrace.reporter")
+
+IMPORT_SCRIPT = """
+import sys, time
+before = set(sys.modules)
+start = time.perf_counter_ns()
+import atrace
+print(time.perf_counter_ns() - start)
+print(" ".join(sorted(set(sys.modules) - before)))
+"""
+
+TINY_PROGRAM = "import atrace\nprint('hello')\n"
+
+
+def run_python(*arguments: str) -> tuple[int, str]:
+    """The time a new Python process takes to run, and its output."""
+    start = time.perf_counter_ns()
+    completed = subprocess.run(
+        [sys.executable, *arguments], capture_output=True, text=True, check=True
+    )
+    return time.perf_counter_ns() - start, completed.stdout
+
+
+def measure_startup(repeat: int) -> dict[str, Any]:
+    """The best of repeat runs of each."""
+    python_ns = min(run_python("-c", "pass")[0] for _ in range(repeat))
+    imports = [run_python("-c", IMPORT_SCRIPT)[1].split("\n") for _ in range(repeat)]
+    modules = imports[0][1].split()
+    with tempfile.TemporaryDirectory() as directory:
+        program = Path(directory) / "tiny.py"
+        program.write_text(TINY_PROGRAM)
+        tiny_ns = min(run_python(str(program))[0] for _ in range(repeat))
+    return {
+        "python_ns": python_ns,
+        "import_ns": min(int(lines[0]) for lines in imports),
+        "tiny_program_ns": tiny_ns,
+        "imported_modules": len(modules),
+        "rendering_modules": [
+            module
+            for module in modules
+            if module.startswith(tuple(f"{name}." for name in RENDERING_MODULES))
+            or module in RENDERING_MODULES
+        ],
+    }
+
+
+def run_untraced(source: str) -> int:
+    compiled = compile(source, "", "exec")
+    start = time.perf_counter_ns()
+    try:
+        exec(compiled, {"__name__": "__main__"})
+    except (Exception, SystemExit):
+        pass  # Raising or exiting is part of what some programs do
+    return time.perf_counter_ns() - start
+
+
+def run_traced(source: str, engine: Engine, options: CaptureOptions) -> Stats:
+    stats = options.stats = Stats()
+    traces: list[Trace] = []
+    try:
+        trace_code(source, traces.append, engine, options)
+    except (Exception, SystemExit):
+        # The trace was handed over already, unless the source didn't compile
+        if not traces:
+            raise
+    with stats.timed("interpret"):
+        history = trace_to_history(traces[0])
+    with stats.timed("table"):
+        history_to_table_data(history, fold=True)
+    return stats
+
+
+def measure(source: str, engine: Engine, configuration: str, repeat: int) -> dict:
+    """The best of repeat runs, the other ones are slowed down by something else."""
+    untraced_ns = min(run_untraced(source) for _ in range(repeat))
+    runs = [
+        run_traced(source, engine, CONFIGURATIONS[configuration]())
+        for _ in range(repeat)
+    ]
+    best = min(runs, key=lambda stats: stats.run_ns)
+    run_s = best.run_ns / 1e9
+    return {
+        "events": best.captured,
+        "events_per_second": round(best.captured / run_s) if run_s else None,
+        "slowdown": round(best.run_ns / max(untraced_ns, 1), 2),
+        "untraced_ns": untraced_ns,
+        "run_ns": best.run_ns,
+        "capture_ns": best.capture_ns,
+        "snapshot_ns": best.snapshot_ns,
+        "interpret_ns": best.interpret_ns,
+        "table_ns": best.table_ns,
+        "peak_events": best.peak_events,
+        "copied_bytes": best.copied_bytes,
+    }
+
+
+def environment(engine: Engine) -> dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_implementation(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "commit": commit,
+        "engine": engine.name,
+    }
+
+
+def compare(baseline: dict, results: dict) -> str:
+    """The events per second of each measure, compared to the baseline."""
+    previous = {
+        (result["program"], result["configuration"]): result
+        for result in baseline["results"]
+    }
+    lines = [
+        f"compared to {baseline['environment']['commit']} "
+        f"({baseline['environment']['python']} "
+        f"{baseline['environment']['python_version']}):"
+    ]
+    for result in results["results"]:
+        old = previous.get((result["program"], result["configuration"]))
+        if not old or not old["events_per_second"] or not result["events_per_second"]:
+            continue
+        ratio = result["events_per_second"] / old["events_per_second"]
+        lines.append(
+            f"  {result['program']:<30} {result['configuration']:<10} "
+            f"{old['events_per_second']:>10} -> {result['events_per_second']:>10} "
+            f"events/s (×{ratio:.2f})"
+        )
+    if "startup" in baseline and "startup" in results:
+        for name in ("import_ns", "tiny_program_ns"):
+            old_ms = baseline["startup"][name] / 1e6
+            new_ms = results["startup"][name] / 1e6
+            lines.append(
+                f"  {name.removesuffix('_ns'):<41} "
+                f"{old_ms:>10.1f} -> {new_ms:>10.1f} ms (×{new_ms / old_ms:.2f})"
+            )
+    return "\n".join(lines)
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Measures how fast the given programs get traced"
+    )
+    parser.add_argument(
+        "programs", nargs="*", help="Paths to python files, e.g. examples/*.py"
+    )
+    parser.add_argument(
+        "--output", default="benchmark.json", help="Where to write the results"
+    )
+    parser.add_argument(
+        "--compare", metavar="BASELINE", help="The results of an earlier run"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=[engine.name.lower() for engine in Engine],
+        help="How to capture the events, defaults to the fastest one available",
+    )
+    parser.add_argument(
+        "--configuration",
+        choices=list(CONFIGURATIONS),
+        action="append",
+        help="The capture options to measure, can be repeated, defaults to all",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measure")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiplies the stress sizes"
+    )
+    options = parser.parse_args()
+
+    engine = Engine[options.engine.upper()] if options.engine else default_engine()
+    programs = {path: Path(path).read_text() for path in options.programs}
+    programs.update(stress_programs(options.scale))
+    configurations = options.configuration or list(CONFIGURATIONS)
+
+    results: dict[str, Any] = {"environment": environment(engine), "results": []}
+    for name, source in programs.items():
+        for configuration in configurations:
+            with (
+                redirect_stdout(io.StringIO()),
+                patch("builtins.input", return_value=ANSWER),
+            ):
+                result = measure(source, engine, configuration, options.repeat)
+            results["results"].append(
+                {"program": name, "configuration": configuration, **result}
+            )
+            print(
+                f"{name:<30} {configuration:<10} {result['events']:>8} events "
+                f"{result['events_per_second']:>10} events/s "
+                f"×{result['slowdown']} slowdown"
+            )
+
+    startup = results["startup"] = measure_startup(options.repeat)
+    print(
+        f"{'import atrace':<41} {startup['import_ns'] / 1e6:>8.1f} ms "
+        f"{startup['imported_modules']:>4} modules"
+    )
+    print(
+        f"{'tiny program':<41} {startup['tiny_program_ns'] / 1e6:>8.1f} ms "
+        f"(python alone {startup['python_ns'] / 1e6:.1f} ms)"
+    )
+    if startup["rendering_modules"]:
+        print(f"import atrace imports {', '.join(startup['rendering_modules'])}")
+
+    Path(options.output).write_text(json.dumps(results, indent=2) + "\n")
+    print(f"Saved the results to {options.output}")
+    if options.compare:
+        baseline = json.loads(Path(options.compare).read_text())
+        print(compare(baseline, results))
+
+
+if __name__ == "__main__":
+    run()
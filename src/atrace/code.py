@@ -7,14 +7,17 @@ import argparse
 from rich.syntax import Syntax
 from rich.table import Table
 
-from . import Trace, trace_code
-from .interpreter import trace_to_history
+from . import CaptureOptions, Stats
+from .interpreter import History
 from .tool_support import (
     Context,
     add_line_numbers,
+    add_stats_argument,
+    print_stats,
     terminal_or_svg,
     visible_program_lines,
 )
+from .trace_file import interpret_or_replay
 
 INTENSE_COLOR = 0, 0, 255
 
@@ -69,26 +72,29 @@ def run():
     parser = argparse.ArgumentParser(
         description="Displays the code of the given program."
     )
-    parser.add_argument("program", help="The path to a python file")
+    parser.add_argument(
+        "program",
+        help="The path to a python file, or to a trace saved with atrace.record",
+    )
     parser.add_argument(
         "--svg",
         help="The path to save the code as an SVG file instead of displaying it",
     )
+    add_stats_argument(parser)
     options = parser.parse_args()
+    stats = Stats()
 
-    with open(options.program) as content_file:
-        source = content_file.read()
-
-    def on_trace(trace: Trace) -> None:
-        history = trace_to_history(trace)
+    def on_history(source: str, history: History) -> None:
         numbered_lines = add_line_numbers(source)
-        table = generate_code_display(Context(numbered_lines, history))
-        with terminal_or_svg(options.svg) as console:
+        with stats.timed("render"), terminal_or_svg(options.svg) as console:
+            table = generate_code_display(Context(numbered_lines, history))
             console.print()
             console.print(table)
             console.print()
 
-    trace_code(source, on_trace)
+    interpret_or_replay(options.program, on_history, CaptureOptions(stats=stats))
+    if options.stats:
+        print_stats(stats)
 
 
 if __name__ == "__main__":
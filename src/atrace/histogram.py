@@ -2,12 +2,15 @@
 Displays a view of a given program, with :
  - The code on the left
  - A histogram of how many times each line was executed on the right
+
+With --time, the histogram shows how long each line ran instead, making it a small
+line profiler.
 """
 
 import argparse
 import math
 from collections import Counter
-from typing import TypeAlias
+from typing import NamedTuple, TypeAlias
 
 from rich import box
 from rich.console import RenderableType
@@ -15,32 +18,56 @@ from rich.padding import Padding
 from rich.table import Table
 from rich.text import Text
 
-from atrace.interpreter import Call, History, Line
+from atrace.interpreter import (
+    Call,
+    Elided,
+    History,
+    Line,
+    Process,
+    Return,
+    Skipped,
+    Thread,
+)
 
-from . import Trace, trace_code
+from . import CaptureOptions, Stats
 from .code import (
     CODE_VIEW_WIDTH,
     add_line_numbers,
     generate_code_display,
 )
-from .interpreter import trace_to_history
 from .tool_support import (
     Context,
+    add_stats_argument,
+    print_stats,
     terminal_or_svg,
     visible_program_lines,
 )
+from .trace_file import interpret_or_replay
 
 BAR_COLOR = "rgb(0,0,255)"
 
+# As in "999.9ms"
+DURATION_WIDTH = 7
+
 ExecutionsPerLine: TypeAlias = dict[int, int]
 
 
+class LineTime(NamedTuple):
+    # Spent running the line itself, in nanoseconds
+    self_ns: int = 0
+    # Spent from the start to the end of the line, the functions it called included
+    cumulative_ns: int = 0
+
+
+TimePerLine: TypeAlias = dict[int, LineTime]
+
+
 def filter_events(history: History) -> History:
     """Keep only events that are interesting for the histogram."""
     result: History = []
     for lineno, item in history:
         match item:
-            case Call(_, _) | Line():
+            case Call(_, _) | Line() | Elided():
                 result.append((lineno, item))
             case _:
                 pass
@@ -48,15 +75,98 @@ def filter_events(history: History) -> History:
 
 
 def line_histogram(history: History) -> ExecutionsPerLine:
-    return Counter(lineno for lineno, _ in history)
+    histogram: Counter[int] = Counter()
+    for lineno, item in history:
+        if isinstance(item, Elided):
+            histogram.update(item.line_counts)
+        else:
+            histogram[lineno] += 1
+    return histogram
+
+
+def line_times(history: History) -> TimePerLine:
+    """
+    How long each line ran, from the times of the history items (the trace needs
+    timestamps, see CaptureOptions).
+
+    The time between two items goes to the line running then: to its self time,
+    and to the cumulative time of the lines of all the active calls. The time of
+    elided loop iterations goes to the line where the elision started.
+    """
+    self_ns: Counter[int] = Counter()
+    cumulative_ns: Counter[int] = Counter()
+    # The line running in each active call, per thread
+    stacks: dict[str | None, list[int]] = {}
+    previous_times: dict[str | None, int] = {}
+    thread: str | None = None
+    stack = stacks.setdefault(thread, [])
+    for lineno, item in history:
+        match item:
+            case Thread(name):
+                thread = name
+                stack = stacks.setdefault(thread, [])
+                continue
+            case Process():
+                # The same lines, run by another process
+                thread = None
+                stacks = {thread: []}
+                stack = stacks[thread]
+                previous_times = {}
+                continue
+            case Skipped():
+                # The lines running after the dropped events are unknown
+                stack.clear()
+                previous_times.pop(thread, None)
+                continue
+        time = getattr(item, "time", None)
+        if time is None:
+            continue
+
+        previous_time = previous_times.get(thread)
+        if previous_time is not None and stack:
+            elapsed = time - previous_time
+            self_ns[stack[-1]] += elapsed
+            # A recursive call runs the same line more than once at a time
+            for running in set(stack):
+                cumulative_ns[running] += elapsed
+        previous_times[thread] = time
+
+        match item:
+            case Call():
+                # The line of the def, until the first line of the function runs
+                stack.append(lineno)
+            case Line() if stack:
+                stack[-1] = lineno
+            case Line():
+                stack.append(lineno)
+            case Return() if stack:
+                stack.pop()
+
+    return {
+        lineno: LineTime(self_ns[lineno], cumulative_ns[lineno])
+        for lineno in self_ns.keys() | cumulative_ns.keys()
+    }
+
 
+def format_duration(ns: int) -> str:
+    if ns >= 1_000_000_000:
+        return f"{ns / 1e9:.2f}s"
+    if ns >= 1_000_000:
+        return f"{ns / 1e6:.1f}ms"
+    return f"{ns / 1e3:.0f}µs"
 
-def generate_histogram_display(context: Context) -> Table:
+
+def generate_histogram_display(
+    context: Context, times: TimePerLine | None = None
+) -> Table:
+    """With times, the bars show the self time of the lines instead of their hits."""
     numbered_lines, history, current_lineno = context
     executions_per_line = line_histogram(history)
     max_hits = max(executions_per_line.values()) if executions_per_line else 1
 
     table = Table(show_header=False, box=None, padding=(0, 1, 0, 0))
+    # The times take room from the bars, the histogram stays as wide
+    bar_columns = 30 if times is None else 30 - 2 * (DURATION_WIDTH + 1)
 
     table.add_column(
         "Hits",
@@ -64,25 +174,48 @@ def generate_histogram_display(context: Context) -> Table:
         justify="right",
         no_wrap=True,
     )
-    table.add_column("Bar", width=30, no_wrap=True)
+    if times is not None:
+        table.add_column("Self", width=DURATION_WIDTH, justify="right", no_wrap=True)
+        table.add_column(
+            "Cumulative", width=DURATION_WIDTH, justify="right", no_wrap=True
+        )
+        max_ns = max((time.self_ns for time in times.values()), default=1)
+    table.add_column("Bar", width=bar_columns, no_wrap=True)
 
     for lineno, line in visible_program_lines(numbered_lines, current_lineno):
         hits = executions_per_line.get(lineno, 0)
 
-        # Calculate width relative 30-unit max
-        bar_width = int((hits / max_hits) * 30) if max_hits > 0 else 0
+        # Calculate width relative to the widest bar
+        if times is None:
+            bar_width = int((hits / max_hits) * bar_columns) if max_hits > 0 else 0
+        else:
+            line_time = times.get(lineno, LineTime())
+            share = line_time.self_ns / max_ns if max_ns > 0 else 0
+            bar_width = int(share * bar_columns)
 
         # Create a text object: [Hit Count] + [Space styled with background]
         bar_display = Text()
         if bar_width:
             bar_display.append(" " * bar_width, style=f"on {BAR_COLOR}")
 
-        table.add_row(str(hits), bar_display)
+        if times is None:
+            table.add_row(str(hits), bar_display)
+        elif lineno in times:
+            table.add_row(
+                str(hits),
+                format_duration(line_time.self_ns),
+                format_duration(line_time.cumulative_ns),
+                bar_display,
+            )
+        else:
+            table.add_row(str(hits), "", "", bar_display)
 
     return table
 
 
-def generate_code_and_histogram_display(context: Context) -> RenderableType:
+def generate_code_and_histogram_display(
+    context: Context, times: TimePerLine | None = None
+) -> RenderableType:
     grid = Table(
         show_header=False,
         show_edge=False,
@@ -97,7 +230,7 @@ def generate_code_and_histogram_display(context: Context) -> RenderableType:
 
     grid.add_row(
         generate_code_display(context),
-        generate_histogram_display(context),
+        generate_histogram_display(context, times),
     )
 
     # Pad so that there are empty lines at the top and bottom
@@ -109,24 +242,39 @@ def run():
     parser = argparse.ArgumentParser(
         description="Displays the line histogram of the given program."
     )
-    parser.add_argument("program", help="The path to a python file")
+    parser.add_argument(
+        "program",
+        help="The path to a python file, or to a trace saved with atrace.record",
+    )
     parser.add_argument(
         "--svg",
         help="The path to save the histogram as an SVG file instead of displaying it",
     )
+    parser.add_argument(
+        "--time",
+        action="store_true",
+        help="Also show how long each line ran, by itself and with the functions it "
+        "called, the bars then show the time of the lines",
+    )
+    add_stats_argument(parser)
     options = parser.parse_args()
+    stats = Stats()
 
-    with open(options.program) as content_file:
-        source = content_file.read()
-
-    def on_trace(trace: Trace) -> None:
+    def on_history(source: str, history: History) -> None:
         numbered_lines = add_line_numbers(source)
-        history = filter_events(trace_to_history(trace))
-        display = generate_code_and_histogram_display(Context(numbered_lines, history))
-        with terminal_or_svg(options.svg) as console:
+        with stats.timed("table"):
+            times = line_times(history) if options.time else None
+            history = filter_events(history)
+        with stats.timed("render"), terminal_or_svg(options.svg) as console:
+            display = generate_code_and_histogram_display(
+                Context(numbered_lines, history), times
+            )
             console.print(display)
 
-    trace_code(source, on_trace)
+    capture_options = CaptureOptions(timestamps=options.time, stats=stats)
+    interpret_or_replay(options.program, on_history, capture_options)
+    if options.stats:
+        print_stats(stats)
 
 
 if __name__ == "__main__":
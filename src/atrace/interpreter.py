@@ -1,10 +1,34 @@
-from collections.abc import Generator
+import time
+from collections.abc import Generator, Iterable
 from dataclasses import dataclass
-from itertools import groupby
 from types import TracebackType
 from typing import Any, NamedTuple, TypeAlias
 
-from . import Symbols, TCall, TException, TLine, TOutput, Trace, TReturn
+from . import (
+    BOUNDARY_CONAMES,
+    ConsumedTrace,
+    Stats,
+    Symbols,
+    TCall,
+    TElided,
+    TEvent,
+    TException,
+    TGap,
+    TLine,
+    TOutput,
+    TProcess,
+    TraceItem,
+    TReturn,
+    TThread,
+)
+from .snapshot import (
+    ATOM_TYPES,
+    UNASSIGN,
+    Changes,
+    Fingerprint,
+    fingerprint,
+    same_value,
+)
 
 """
 Takes a raw trace to make sense of it:
@@ -20,26 +44,70 @@ class Var(NamedTuple):
     name: str
 
 
-class Unassign:
-    def __repr__(self):
-        return "<UNASSIGN>"
-
-
-UNASSIGN = Unassign()
 Assignments: TypeAlias = dict[Var, Any]
 
 
-def diff(scope: str, before: Symbols, after: Symbols) -> Assignments:
+class Fingerprints:
+    """Caches the fingerprints of snapshot values.
+    Each value gets compared twice: when it appears and when it gets replaced.
+
+    The cache keeps the values alive, so they get forgotten once replaced."""
+
+    MAX_SIZE = 10_000
+
+    def __init__(self):
+        # id(value) -> (value, fingerprint). Holding the value keeps its id unique.
+        self.cache: dict[int, tuple[Any, Fingerprint]] = {}
+
+    def __call__(self, value: Any) -> Fingerprint:
+        if type(value) in ATOM_TYPES:
+            return fingerprint(value)
+        entry = self.cache.get(id(value))
+        if entry is not None and entry[0] is value:
+            return entry[1]
+        if len(self.cache) >= self.MAX_SIZE:
+            self.cache.clear()
+        value_fingerprint = fingerprint(value)
+        self.cache[id(value)] = value, value_fingerprint
+        return value_fingerprint
+
+    def forget(self, value: Any) -> None:
+        entry = self.cache.get(id(value))
+        if entry is not None and entry[0] is value:
+            del self.cache[id(value)]
+
+
+def diff(
+    scope: str,
+    before: Symbols,
+    after: Symbols,
+    fingerprints: Fingerprints | None = None,
+) -> Assignments:
+    if isinstance(after, Changes):
+        # The tracer already did the work
+        return {Var(scope, var): val for var, val in after.items()}
+
+    # Complete snapshots hold a new copy of each value, even an unchanged one: that
+    # one gets compared in full, like it got copied in full
+    fingerprint_of = fingerprints or fingerprint
     assignments = {}
 
     # New variables or changes
     for var, val in after.items():
-        if var not in before or val != before[var]:
+        if var not in before:
+            assignments[Var(scope, var)] = val
+            continue
+        previous = before[var]
+        if not same_value(previous, val, fingerprint_of):
             assignments[Var(scope, var)] = val
+        if fingerprints is not None and previous is not val:
+            fingerprints.forget(previous)
 
     # Variables that were unassigned
     for unassigned in before.keys() - after.keys():
         assignments[Var(scope, unassigned)] = UNASSIGN
+        if fingerprints is not None:
+            fingerprints.forget(before[unassigned])
 
     return assignments
 
@@ -47,20 +115,25 @@ def diff(scope: str, before: Symbols, after: Symbols) -> Assignments:
 class Call(NamedTuple):
     function_name: str
     bindings: Assignments
+    # The time of the event, when the trace has timestamps
+    time: int | None = None
 
 
 class Return(NamedTuple):
     return_value: Any
+    time: int | None = None
 
 
 class Raise(NamedTuple):
     type: type
     value: Exception
-    traceback: TracebackType
+    # None when the trace was read from a file
+    traceback: TracebackType | None
+    time: int | None = None
 
 
 class Line(NamedTuple):
-    pass
+    time: int | None = None
 
 
 class LineEffects(NamedTuple):
@@ -68,100 +141,229 @@ class LineEffects(NamedTuple):
     output: str | None
 
 
-HistoryItem: TypeAlias = tuple[int, Line | LineEffects | Call | Return | Raise]
+class Skipped(NamedTuple):
+    """Some events were dropped from the trace."""
+
+    dropped: int
+    # The functions active after the dropped events, the outermost first
+    call_stack: list[str]
+
+
+class Elided(NamedTuple):
+    """The iterations of a loop past the first ones were not captured.
+    The effects that follow are those of all the elided iterations."""
+
+    iterations: int
+    last_line: int
+    line_counts: dict[int, int]
+
+
+class Thread(NamedTuple):
+    """The items that follow happened in this thread."""
+
+    # None for the thread that started tracing
+    name: str | None
+
+
+class Process(NamedTuple):
+    """The items that follow happened in this child process."""
+
+    pid: int
+
+
+HistoryItem: TypeAlias = tuple[
+    int,
+    Line | LineEffects | Call | Return | Raise | Skipped | Elided | Thread | Process,
+]
 History: TypeAlias = list[HistoryItem]
 
 
 @dataclass
 class Activation:
     function_name: str
-    locals: Symbols
+    # None when we don't know the locals yet, after a gap in the trace
+    locals: Symbols | None
     last_line_no: int
 
 
-def _trace_to_unpacked_history(trace: Trace) -> Generator[HistoryItem]:
+class Interpreter:
     """Simulate the state of global and local symbols in order to reconstruct
     a history of assignments.
 
+    The events are pushed one at a time, so the history can be built while the
+    program runs: a snapshot can be dropped as soon as it has been compared to the
+    previous one.
+
     Because line events are emitted _before_ a line is executed,
     we only see the new values of globals and locals when the next event arrives.
-    """
 
-    current_globals: Symbols = {}
-    activations = [Activation("guard", {}, -1)]
+    After a gap in the trace we don't know the values of the symbols: the first
+    snapshot of each scope becomes its starting point.
 
-    for lineno, event in trace:
-
-        def _compute_assignments(activation: Activation, globs: Symbols, locs: Symbols):
-            local_assignments = diff(activation.function_name, activation.locals, locs)
-            global_assignments = diff("<module>", current_globals, globs)
-            return local_assignments | global_assignments
+    Each thread has its own stack of activations, the globals are shared.
+    """
 
+    def __init__(self):
+        self.current_globals: Symbols | None = {}
+        self.activations: list[Activation] = [Activation("guard", {}, -1)]
+        self.thread: str | None = None
+        # The activations of the other threads
+        self.thread_activations: dict[str | None, list[Activation]] = {}
+        # The locals of the threads we have not seen yet, None after a gap
+        self.new_thread_locals: Symbols | None = {}
+        self.fingerprints = Fingerprints()
+        self.packed: History = []
+        # Where the items of the child processes start
+        self.children_start: int | None = None
+
+    def push(self, item: TraceItem) -> None:
+        lineno, event = item
+        for history_item in self.unpack(lineno, event):
+            self.pack(history_item)
+
+    def history(self) -> History:
+        if self.children_start is None:
+            return _filter_artifacts(self.packed)
+        # The artifacts are those of the traced process
+        start = self.children_start
+        return _filter_artifacts(self.packed[:start]) + self.packed[start:]
+
+    def pack(self, item: HistoryItem) -> None:
+        """Merge consecutive LineEffects together."""
+        lineno, history_item = item
+        if not isinstance(history_item, LineEffects):
+            self.packed.append(item)
+            return
+
+        assignments, output = history_item
+        if self.packed:
+            previous_lineno, previous = self.packed[-1]
+            if previous_lineno == lineno and isinstance(previous, LineEffects):
+                self.packed.pop()
+                assignments = previous.assignments | assignments
+                output = (previous.output or "") + (output or "")
+        self.packed.append((lineno, LineEffects(assignments, output or None)))
+
+    def compute_assignments(
+        self, activation: Activation, globs: Symbols, locs: Symbols
+    ) -> Assignments:
+        local_assignments = (
+            {}
+            if activation.locals is None
+            else diff(
+                activation.function_name, activation.locals, locs, self.fingerprints
+            )
+        )
+        global_assignments = (
+            {}
+            if self.current_globals is None
+            else diff("<module>", self.current_globals, globs, self.fingerprints)
+        )
+        return local_assignments | global_assignments
+
+    def unpack(self, lineno: int, event: TEvent) -> Generator[HistoryItem]:
+        activations = self.activations
         match event:
-            case TCall(_, locs, function_name):
+            case TCall(_, locs, function_name, time):
                 activations.append(Activation(function_name, locs, -1))
                 function_bindings = diff(function_name, {}, locs)
-                yield lineno, Call(function_name, function_bindings)
+                yield lineno, Call(function_name, function_bindings, time)
 
-            case TLine(globs, locs):
+            case TLine(globs, locs, time):
                 activation = activations[-1]
-                a = _compute_assignments(activation, globs, locs)
+                a = self.compute_assignments(activation, globs, locs)
                 if a:
                     yield activation.last_line_no, LineEffects(a, None)
 
-                yield lineno, Line()
-                current_globals = globs
+                yield lineno, Line(time)
+                self.current_globals = globs
                 activation.locals = locs
                 activation.last_line_no = lineno
 
-            case TReturn(globs, locs, return_value):
+            case TReturn(globs, locs, return_value, time):
                 activation = activations[-1]
-                a = _compute_assignments(activation, globs, locs)
+                a = self.compute_assignments(activation, globs, locs)
                 if a:
                     yield activation.last_line_no, LineEffects(a, None)
 
-                current_globals = globs
-                yield lineno, Return(return_value)
-                activations.pop()
+                self.current_globals = globs
+                yield lineno, Return(return_value, time)
+                if len(activations) > 1:
+                    activations.pop()
 
-            case TException(globs, locs, _exception, value, traceback):
+            case TException(globs, locs, _exception, value, traceback, time):
                 activation = activations[-1]
-                a = _compute_assignments(activation, globs, locs)
+                a = self.compute_assignments(activation, globs, locs)
                 if a:
                     yield activation.last_line_no, LineEffects(a, None)
 
-                current_globals = globs
-                yield lineno, Raise(_exception, value, traceback)
+                self.current_globals = globs
+                yield lineno, Raise(_exception, value, traceback, time)
 
             case TOutput(text):
                 activation = activations[-1]
                 yield activation.last_line_no, LineEffects({}, text)
 
-
-def _pack_effects(unpacked: Generator[HistoryItem]) -> Generator[HistoryItem]:
-    """Merge consecutive LineEffects together."""
-    for (lineno, is_effects), group in groupby(
-        unpacked, key=lambda x: (x[0], isinstance(x[1], LineEffects))
-    ):
-        if is_effects:
-            assignments: Assignments = {}
-            outputs: list[str] = []
-
-            for _, line_effects in group:
-                assert isinstance(line_effects, LineEffects)  # for mypy
-                assignments |= line_effects.assignments
-                if line_effects.output is not None:
-                    outputs.append(line_effects.output)
-
-            yield lineno, LineEffects(assignments, "".join(outputs) or None)
-        else:
-            yield from group
+            case TThread(name):
+                self.thread_activations[self.thread] = activations
+                self.thread = name
+                self.activations = self.thread_activations.pop(name, []) or [
+                    Activation("guard", self.new_thread_locals, -1)
+                ]
+                yield lineno, Thread(name)
+
+            case TGap(dropped, call_stack, line_numbers, thread):
+                if thread != self.thread:
+                    yield lineno, Thread(thread)
+                self.current_globals = None
+                self.thread = thread
+                self.thread_activations = {}
+                self.new_thread_locals = None
+                self.activations = [
+                    Activation(name, None, line_no)
+                    for name, line_no in zip(["guard", *call_stack], line_numbers)
+                ]
+                functions = [n for n in call_stack if n not in BOUNDARY_CONAMES]
+                yield lineno, Skipped(dropped, functions)
+
+            case TProcess(pid):
+                if self.children_start is None:
+                    self.children_start = len(self.packed)
+                # Nothing is known of the child yet, its globals included
+                self.current_globals = None
+                self.thread = None
+                self.thread_activations = {}
+                self.new_thread_locals = None
+                self.activations = [Activation("guard", None, -1)]
+                yield lineno, Process(pid)
+
+            case TElided(iterations, last_line, line_counts):
+                # The state is the one before the loop was elided, the next event
+                # shows what the elided iterations did
+                activations[-1].last_line_no = lineno
+                yield lineno, Elided(iterations, last_line, line_counts)
+
+
+class InterpretedTrace(ConsumedTrace):
+    """Interprets the events as they get captured, instead of collecting them."""
+
+    def __init__(self, stats: Stats | None = None):
+        self.interpreter = Interpreter()
+        self.stats = stats if stats is not None else Stats()
+
+    def consume(self, item: TraceItem) -> None:
+        start = time.perf_counter_ns()
+        self.interpreter.push(item)
+        self.stats.interpret_ns += time.perf_counter_ns() - start
+
+    def history(self) -> History:
+        return self.interpreter.history()
 
 
 def _filter_artifacts(history: History) -> History:
     """Remove implementation artifacts from History:
-    - It always contains an extra return at the end that's not part of our program.
-      We get rid of that
+    - It always contains an extra return at the end that's not part of our program
+      (unless the end of the trace was not retained). We get rid of that
     - Depending on how the trace was captured it sometimes starts with a call into the
       module with lineno 0. We get rid of that as well.
     """
@@ -169,15 +371,14 @@ def _filter_artifacts(history: History) -> History:
     if len(history) < 2:
         return history
 
-    lineno, _ = history[0]
-    if lineno == 0:
-        return history[1:-1]
-    else:
-        return history[:-1]
+    start = 1 if history[0][0] == 0 else 0
+    end = -1 if isinstance(history[-1][1], Return) else len(history)
+    return history[start:end]
 
 
-def trace_to_history(trace: Trace) -> History:
+def trace_to_history(trace: Iterable[TraceItem]) -> History:
     """Build a History by interpreting the trace."""
-    unpacked = _trace_to_unpacked_history(trace)
-    packed = _pack_effects(unpacked)
-    return _filter_artifacts(list(packed))
+    interpreter = Interpreter()
+    for item in trace:
+        interpreter.push(item)
+    return interpreter.history()
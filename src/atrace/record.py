@@ -0,0 +1,46 @@
+"""
+Runs a given python program and saves its trace to a file.
+
+All the other tools accept the saved trace in place of the program.
+"""
+
+import argparse
+from pathlib import Path
+
+from . import CaptureOptions, Stats
+from .tool_support import add_stats_argument, print_stats
+from .trace_file import record
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Saves the trace of the given program to a file"
+    )
+    parser.add_argument("program", help="The path to a python file")
+    parser.add_argument(
+        "trace",
+        nargs="?",
+        help="The path of the trace file, defaults to the program with .atrace",
+    )
+    parser.add_argument(
+        "--time",
+        action="store_true",
+        help="Save when each event happened, for atrace.histogram --time",
+    )
+    add_stats_argument(parser)
+    options = parser.parse_args()
+
+    with open(options.program) as content_file:
+        source = content_file.read()
+
+    trace_path = options.trace or str(Path(options.program).with_suffix(".atrace"))
+    stats = Stats()
+    capture_options = CaptureOptions(timestamps=options.time, stats=stats)
+    record(source, trace_path, options=capture_options)
+    print(f"Successfully saved trace to {trace_path}")
+    if options.stats:
+        print_stats(stats)
+
+
+if __name__ == "__main__":
+    run()
@@ -1,8 +1,9 @@
-import configparser
 import gettext
 import os
 import pathlib
 import re
+from bisect import bisect_right
+from collections import Counter
 from contextlib import suppress
 from typing import Any, NamedTuple, TypeAlias
 
@@ -13,10 +14,14 @@ from .interpreter import (
     UNASSIGN,
     Assignments,
     Call,
+    Elided,
     History,
     LineEffects,
+    Process,
     Raise,
     Return,
+    Skipped,
+    Thread,
     Var,
 )
 
@@ -30,11 +35,13 @@ Takes an execution history and builds an execution table, displaying for each li
 # - Use 120 columns for the table (Thonny's shell always reports 80)
 # - Extract the language from the thonny config (because Thonny doesn't pass the
 # language as an # environment variable)
-with suppress(OSError, configparser.Error):
-    thonny_dir = os.environ.get("THONNY_USER_DIR")
-    if thonny_dir:  # We're in thonny
-        os.environ["COLUMNS"] = "120"
+thonny_dir = os.environ.get("THONNY_USER_DIR")
+if thonny_dir:  # We're in thonny
+    # Import only here, the config is only read in thonny
+    import configparser
 
+    os.environ["COLUMNS"] = "120"
+    with suppress(OSError, configparser.Error):
         config_path = os.path.join(thonny_dir, "configuration.ini")
         config = configparser.ConfigParser()
         config.read(config_path)
@@ -48,6 +55,27 @@ t = gettext.translation("atrace", str(LOCALE_DIR), fallback=True)
 _ = t.gettext
 
 LINE, OUTPUT, EXCEPTION = _("line"), _("output"), _("exception")
+THREAD = _("thread")
+PROCESS = _("process")
+
+# Displayed in the line column in place of the events that were dropped
+SKIPPED_MARKER = "⋮"
+
+
+# Rows that repeat the same pattern this many times get folded
+FOLD_MIN_ITERATIONS = 20
+# A pattern starts and ends before one of the next rows like its first one: how
+# many of those get tried
+FOLD_MAX_CANDIDATES = 10
+
+
+def format_span(first_line: int, last_line: int, iterations: int) -> str:
+    lines = str(first_line) if first_line == last_line else f"{first_line}–{last_line}"
+    return f"{SKIPPED_MARKER} {lines} ×{iterations}"
+
+
+def format_elided(first_line: int, elided: Elided) -> str:
+    return format_span(first_line, elided.last_line, elided.iterations)
 
 
 def format_value(value: Any) -> str:
@@ -143,6 +171,8 @@ def _prepare(history: History) -> tuple[list[Var | str], bool, bool]:
                     history_has_output = True
             case Raise(_, _, _):
                 history_has_exception = True
+            case Skipped(_, functions):
+                add_to_cols(*functions)
 
     return list(cols_dict), history_has_exception, history_has_output
 
@@ -155,20 +185,38 @@ def header_data(var_or_func: VarOrFunction) -> HeaderData:
             return LeftAligned(var_or_func)
 
 
-ITS_A_CALL = object()
+class DepthMarkers:
+    """The markers of the calls that are under way in a function column, one per
+    call. Each depth's marker gets built once, and shared by all its cells."""
 
+    def __init__(self):
+        self.markers = [""]
 
-def history_to_table_data(history: History) -> TableData:
+    def __getitem__(self, depth: int) -> str:
+        while len(self.markers) <= depth:
+            self.markers.append(self.markers[-1] + "│  ")
+        return self.markers[depth]
+
+
+def history_to_table_data(history: History, fold: bool = False) -> TableData:
     """Build an intermediate representation of the trace table.
 
-    All the headers and rows are complete.
+    All the headers and rows are complete. Each row only gets built from the
+    columns its item changes, and the columns of the functions being called.
+    With fold, the rows of the iterations that repeat get folded (see fold_rows).
     """
     history = _filter_functions_in_assignments(history)
 
     all_vars_or_funcs, history_has_exception, history_has_output = _prepare(history)
+    history_has_threads = any(isinstance(item, Thread) for _, item in history)
+    history_has_processes = any(isinstance(item, Process) for _, item in history)
 
     # Build table columns
     headers: list[HeaderData] = [LINE]
+    if history_has_processes:
+        headers.append(PROCESS)
+    if history_has_threads:
+        headers.append(THREAD)
     for var_or_func in all_vars_or_funcs:
         headers.append(header_data(var_or_func))
     if history_has_output:
@@ -176,10 +224,24 @@ def history_to_table_data(history: History) -> TableData:
     if history_has_exception:
         headers.append(EXCEPTION)
 
-    call_stack: list[str] = []
-
-    def recursive_depth(function_name) -> int:
-        return call_stack.count(function_name) if call_stack else 0
+    width = len(headers)
+    first_column = 1 + history_has_processes + history_has_threads
+    column_of = {
+        var_or_func: column
+        for column, var_or_func in enumerate(all_vars_or_funcs, start=first_column)
+    }
+    output_column = first_column + len(all_vars_or_funcs)
+    exception_column = output_column + history_has_output
+    markers = DepthMarkers()
+
+    # None is the process that started tracing
+    process: int | None = None
+    # Each thread has its own call stack, None is the thread that started tracing.
+    # The depths count the calls of each function in the stack, the functions that
+    # are not in it have none.
+    thread: str | None = None
+    call_stacks: dict[str | None, tuple[list[str], Counter[str]]] = {}
+    call_stack, depths = call_stacks.setdefault(thread, ([], Counter()))
 
     # Build rows
     rows = []
@@ -187,53 +249,179 @@ def history_to_table_data(history: History) -> TableData:
         assignments: Assignments = {}
         output: str | None = None
         exception: Exception | None = None
-        function_name: str | None = None
-        return_value: Any | None = ITS_A_CALL
+        called: str | None = None
+        returned: str | None = None
+        return_value: Any = None
 
         # All these cases are capturing variables that we use just below,
         # they are doing something, despite the `pass`
         match history_item:
-            case Call(function_name, assignments):
-                call_stack.append(function_name)
+            case Call(called, assignments):
+                call_stack.append(called)
+                depths[called] += 1
             case LineEffects(assignments, output):
                 pass
             case Raise(_, exception, _):
                 pass
-            case Return(return_value):
-                function_name = call_stack.pop()
-
-        row: RowData = [str(lineno)]
-
-        for var_or_func in all_vars_or_funcs:
-            content = ""
-            match var_or_func:
-                case Var(_, _) as var if var in assignments:
-                    content = format_value(assignments[var])
-                case str():
-                    content = "│  " * recursive_depth(var_or_func)
-                    if function_name == var_or_func:
-                        if return_value == ITS_A_CALL:
-                            content = "│  " * (recursive_depth(var_or_func) - 1)
-                            content += f"{function_name}("
-                            content += ",".join(
-                                format_value(v) for v in assignments.values()
-                            )
-                            content += ")"
-                        else:
-                            content += "└─ "
-                            if return_value is not None:
-                                content += format_value(return_value)
-            row.append(content)
+            case Return(return_value) if call_stack:
+                returned = call_stack.pop()
+                depths[returned] -= 1
+                if not depths[returned]:
+                    del depths[returned]
+            case Return():
+                # The return of the traced module, after the events of a thread
+                continue
+            case Skipped(dropped, functions):
+                call_stack, depths = functions.copy(), Counter(functions)
+                call_stacks = {thread: (call_stack, depths)}
+                # Nothing was dropped when the trace started in a running frame
+                if dropped:
+                    rows.append([SKIPPED_MARKER] + [""] * (width - 1))
+                continue
+            case Elided() as elided:
+                rows.append([format_elided(lineno, elided)] + [""] * (width - 1))
+                continue
+            case Thread(name):
+                thread = name
+                call_stack, depths = call_stacks.setdefault(thread, ([], Counter()))
+                continue
+            case Process(pid):
+                process = pid
+                thread = None
+                call_stack, depths = [], Counter()
+                call_stacks = {thread: (call_stack, depths)}
+                continue
+
+        if not (assignments or output or exception or called or returned):
+            continue
+
+        row: RowData = [""] * width
+        row[0] = str(lineno)
+        if history_has_processes:
+            row[1] = "" if process is None else str(process)
+        if history_has_threads:
+            row[first_column - 1] = thread or ""
+
+        for function_name, depth in depths.items():
+            row[column_of[function_name]] = markers[depth]
+        for var, value in assignments.items():
+            row[column_of[var]] = format_value(value)
+        if called is not None:
+            arguments = ",".join(format_value(v) for v in assignments.values())
+            row[column_of[called]] = (
+                f"{markers[depths[called] - 1]}{called}({arguments})"
+            )
+        if returned is not None:
+            shown = "" if return_value is None else format_value(return_value)
+            row[column_of[returned]] = f"{markers[depths[returned]]}└─ {shown}"
 
         if history_has_output:
-            row.append(format_output(output))
+            row[output_column] = format_output(output)
         if history_has_exception:
-            row.append(format_exception(exception))
-
-        if assignments or output or exception or function_name:
-            rows.append(row)
-
-    return headers, rows
+            row[exception_column] = format_exception(exception)
+        rows.append(row)
+
+    value_columns = [False] * (history_has_processes + history_has_threads)
+    value_columns += [isinstance(v, Var) for v in all_vars_or_funcs]
+    value_columns += [True] * (len(headers) - 1 - len(value_columns))
+    return headers, fold_rows(rows, value_columns) if fold else rows
+
+
+RowShape: TypeAlias = tuple[str, tuple[bool, ...]] | None
+
+
+def _row_shape(row: RowData) -> RowShape:
+    """The line and the columns that have content.
+    Rows that are not about a line (markers) have no shape, they never get folded."""
+    if not row[0].isdigit():
+        return None
+    return row[0], tuple(bool(cell) for cell in row[1:])
+
+
+def _repetitions(shapes: list[RowShape], start: int, period: int) -> int:
+    """How many times in a row the pattern of the rows at start repeats."""
+    end = start + period
+    if end > len(shapes) or None in shapes[start:end]:
+        return 0
+    while end < len(shapes) and shapes[end] == shapes[end - period]:
+        end += 1
+    return (end - start) // period
+
+
+def _periods(
+    shapes: list[RowShape], positions: dict[RowShape, list[int]], start: int
+) -> list[int]:
+    """The periods a pattern starting at start can have: up to the next rows like
+    the one at start, as long as the pattern can repeat enough times."""
+    shape = shapes[start]
+    if shape is None:
+        return []
+    longest = (len(shapes) - start) // FOLD_MIN_ITERATIONS
+    same = positions[shape]
+    first = bisect_right(same, start)
+    periods = [
+        position - start for position in same[first : first + FOLD_MAX_CANDIDATES]
+    ]
+    return [
+        period
+        for period in periods
+        if period <= longest
+        and shapes[start + (FOLD_MIN_ITERATIONS - 1) * period] == shape
+    ]
+
+
+def _fold_summary(
+    rows: list[RowData], iterations: int, value_columns: list[bool]
+) -> RowData:
+    """One row standing for the given rows. Value columns go from their first
+    to their last value, other columns are only kept when they don't change."""
+    line_numbers = [int(row[0]) for row in rows]
+    summary = [format_span(min(line_numbers), max(line_numbers), iterations)]
+    for column, is_value in enumerate(value_columns, start=1):
+        cells = [row[column] for row in rows if row[column]]
+        if not cells:
+            summary.append("")
+        elif all(cell == cells[0] for cell in cells):
+            summary.append(cells[0])
+        elif is_value:
+            summary.append(f"{cells[0]} → {cells[-1]}")
+        else:
+            summary.append("")
+    return summary
+
+
+def fold_rows(rows: list[RowData], value_columns: list[bool]) -> list[RowData]:
+    """Fold the rows of the iterations that repeat the same pattern of rows
+    (same lines, same columns changing), keeping the first and the last iteration."""
+    shapes = [_row_shape(row) for row in rows]
+    # Where each shape appears
+    positions: dict[RowShape, list[int]] = {}
+    for position, shape in enumerate(shapes):
+        positions.setdefault(shape, []).append(position)
+    result: list[RowData] = []
+    start = 0
+    while start < len(rows):
+        # The shortest pattern that repeats the most
+        iterations, period = max(
+            (
+                (_repetitions(shapes, start, period), period)
+                for period in _periods(shapes, positions, start)
+            ),
+            key=lambda repetitions: (repetitions[0], -repetitions[1]),
+            default=(0, 0),
+        )
+        if iterations < FOLD_MIN_ITERATIONS:
+            result.append(rows[start])
+            start += 1
+            continue
+
+        last = start + (iterations - 1) * period
+        folded = rows[start + period : last]
+        result += rows[start : start + period]
+        result.append(_fold_summary(folded, iterations - 2, value_columns))
+        result += rows[last : last + period]
+        start = last + period
+    return result
 
 
 def table_data_to_table(table_data: TableData) -> Table:
@@ -257,9 +445,9 @@ def table_data_to_table(table_data: TableData) -> Table:
     return table
 
 
-def history_to_table(history: History) -> Table:
+def history_to_table(history: History, fold: bool = False) -> Table:
     """The main entrypoint: generate the Table of a given History."""
-    table_data = history_to_table_data(history)
+    table_data = history_to_table_data(history, fold)
     return table_data_to_table(table_data)
 
 
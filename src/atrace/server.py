@@ -0,0 +1,209 @@
+"""
+Traces programs on request, for editors that trace every run and should not pay
+each time for starting Python and importing atrace and rich.
+
+Reads requests from stdin, or from the connections to a Unix socket, one JSON
+object per line:
+
+    {"id": 1, "source": "print('hi')", "stdin": "", "format": "text", "timeout": 10}
+
+Only the source is required. The format is text, svg or json. The rows of the
+iterations that repeat get folded, unless the request has "fold": false.
+Each request gets answered with one JSON object per line, in the same order:
+
+    {"id": 1, "status": "ok", "error": null, "seconds": 0.01, "rows": 1,
+     "trace": "..."}
+
+The statuses are those of atrace.batch. The trace is the rendered table, or with
+the json format an object with its headers and rows.
+
+Each program runs in a process forked from the server: it starts with everything
+imported already, and cannot affect the server nor the programs after it.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socketserver
+import stat
+import sys
+import time
+from contextlib import suppress
+from multiprocessing.connection import Connection
+from typing import Any, TextIO
+
+from .batch import (
+    FAILED,
+    FORMATS,
+    GRACE,
+    KILLED,
+    process_class,
+    render,
+    table_json,
+    trace_program,
+)
+from .reporter import TableData, history_to_table_data
+
+# Seconds per program, when the request doesn't say
+TIMEOUT = 10.0
+
+Answer = dict[str, Any]
+
+
+###############################################################################
+# Answering one request
+###############################################################################
+
+
+def invalid(request: Any) -> str | None:
+    """What is wrong with the request, if anything."""
+    if not isinstance(request, dict):
+        return "A request is a JSON object"
+    if not isinstance(request.get("source"), str):
+        return "The source is missing"
+    if not isinstance(request.get("stdin", ""), str):
+        return "The stdin is a string"
+    if request.get("format", "text") not in FORMATS:
+        return f"The format is one of {', '.join(FORMATS)}"
+    timeout = request.get("timeout", TIMEOUT)
+    if not isinstance(timeout, (int, float)) or timeout <= 0:
+        return "The timeout is a positive number of seconds"
+    if not isinstance(request.get("fold", True), bool):
+        return "The fold is true or false"
+    return None
+
+
+def run_request(request: dict[str, Any], connection: Connection) -> None:
+    """Trace the source and send back the answer, in the forked process."""
+    start = time.perf_counter()
+    status, error, history = trace_program(
+        request["source"],
+        request.get("stdin", ""),
+        request.get("timeout", TIMEOUT),
+    )
+    answer: Answer = {"status": status, "error": error, "rows": 0, "trace": None}
+    if history:
+        table_data = history_to_table_data(history, request.get("fold", True))
+        answer["rows"] = len(table_data[1])
+        format = request.get("format", "text")
+        answer["trace"] = (
+            table_json(table_data)
+            if format == "json"
+            else render(table_data, format, "atrace")
+        )
+    answer["seconds"] = time.perf_counter() - start
+    connection.send(answer)
+
+
+def answer(request: Any) -> Answer:
+    request_id = request.get("id") if isinstance(request, dict) else None
+    error = invalid(request)
+    if error:
+        return {"id": request_id, "status": FAILED, "error": error}
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = process_class()(target=run_request, args=(request, sender), daemon=True)
+    process.start()
+    sender.close()
+    # The answer can be larger than the pipe, it gets read before joining
+    timeout = request.get("timeout", TIMEOUT)
+    if receiver.poll(timeout + GRACE):
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = {
+                "status": FAILED,
+                "error": "The process exited before answering",
+            }
+    else:
+        process.kill()
+        result = {"status": KILLED, "error": None, "seconds": timeout + GRACE}
+    process.join()
+    receiver.close()
+    return {"id": request_id, **result}
+
+
+###############################################################################
+# Serving
+###############################################################################
+
+
+def serve(requests: TextIO, answers: TextIO) -> None:
+    """Answer the requests, one per line, until there are no more."""
+    for line in requests:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            result = {"id": None, "status": FAILED, "error": f"Invalid JSON: {e}"}
+        else:
+            result = answer(request)
+        answers.write(json.dumps(result, ensure_ascii=False) + "\n")
+        answers.flush()
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        with (
+            self.request.makefile("r", encoding="utf-8") as requests,
+            self.request.makefile("w", encoding="utf-8") as answers,
+        ):
+            serve(requests, answers)
+
+
+def serve_socket(path: str) -> None:
+    """Answer the requests of each connection in a process forked from the
+    server, so that connections don't wait for each other."""
+
+    # Both exist only on Unix
+    class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        # Stopping doesn't wait for the connections to close
+        block_on_close = False
+
+    # A socket left behind by an earlier server
+    with suppress(FileNotFoundError):
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    # Stopping the server removes its socket
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit())
+    with Server(path, RequestHandler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+def warm_up() -> None:
+    """Render once, so that what rich imports on first use is imported here
+    rather than in each forked process."""
+    table_data: TableData = (["line", "x"], [["1", "1"]])
+    for format in FORMATS:
+        render(table_data, format, "atrace")
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Traces programs on request, one JSON object per line"
+    )
+    parser.add_argument(
+        "--socket",
+        metavar="PATH",
+        help="Listen on a Unix socket, instead of reading stdin",
+    )
+    options = parser.parse_args()
+
+    warm_up()
+    try:
+        if options.socket:
+            serve_socket(options.socket)
+        else:
+            serve(sys.stdin, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,553 @@
+import copy
+import reprlib
+import sys
+from collections import ChainMap
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+from itertools import chain, islice
+from types import (
+    BuiltinFunctionType,
+    EllipsisType,
+    FunctionType,
+    MethodType,
+    ModuleType,
+    NoneType,
+)
+from typing import Any, TypeAlias
+
+"""
+Takes snapshots of the variables of a frame, so that later mutations of the
+values don't affect what we captured.
+
+Deep copying every value at every step is what costs the most while tracing,
+so the copy strategy is chosen by the exact type of each value:
+- Atoms and immutable containers are referenced directly
+- Flat containers (holding only immutable values) get a shallow copy
+- Everything else falls back to a deepcopy
+- Functions, classes and modules are skipped, they never get displayed
+
+The names that get skipped can be remembered with the value they had: as long as
+they are bound to the same object, the next snapshots leave them out at once.
+
+All the copies of one snapshot share a memo (the one deepcopy uses), so a value
+referenced by several variables is copied once, and the aliasing is preserved.
+
+Instead of complete snapshots we can also take Changes: only the values that differ
+from the previous snapshot get copied.
+
+When only the display of the values matters, copy_repr can replace the copies by
+their Repr: a bounded string that never holds on to the original values.
+
+Values bigger than some Limits can be replaced by a Summary instead of a copy, so
+that the cost of a snapshot doesn't depend on how much data the program handles.
+
+To decide whether a value changed we first look at cheap fingerprints, and only
+compare the values themselves when their fingerprints are the same. So a value
+that changed is found out cheaply, but one that didn't still gets compared in
+full, unless it is the very same object. With complete snapshots that happens
+when interpreting, to a copy of the value. With Changes it happens when taking the
+snapshot, and saves copying the value.
+"""
+
+Symbols: TypeAlias = dict[str, Any]
+
+# name -> the value it had when it got skipped
+Skipped: TypeAlias = dict[str, Any]
+
+# id(original) -> copy, as used by copy.deepcopy
+Memo: TypeAlias = dict[int, Any]
+
+Copier: TypeAlias = Callable[[Any, Memo], Any]
+
+
+class Skip:
+    def __repr__(self):
+        return "<SKIP>"
+
+
+SKIP = Skip()
+
+
+class Unassign:
+    def __repr__(self):
+        return "<UNASSIGN>"
+
+    def __reduce__(self):
+        # Unpickles to the same object, it gets compared by identity
+        return "UNASSIGN"
+
+
+UNASSIGN = Unassign()
+
+
+class Changes(dict[str, Any]):
+    """The bindings that changed since the previous snapshot.
+    The bindings that disappeared are bound to UNASSIGN."""
+
+
+ATOM_TYPES = frozenset(
+    {NoneType, bool, int, float, complex, str, bytes, range, EllipsisType}
+)
+
+
+def is_immutable(value: Any) -> bool:
+    value_type = type(value)
+    if value_type in ATOM_TYPES:
+        return True
+    if value_type is tuple or value_type is frozenset:
+        return all_immutable(value)
+    return False
+
+
+def all_immutable(values: Iterable[Any]) -> bool:
+    return all(type(v) in ATOM_TYPES or is_immutable(v) for v in values)
+
+
+def copy_reference(value: Any, memo: Memo) -> Any:
+    return value
+
+
+def copy_skip(value: Any, memo: Memo) -> Any:
+    return SKIP
+
+
+@dataclass
+class CopyStats:
+    # The values that could not be deep copied, and got referenced instead
+    deepcopy_fallbacks: int = 0
+
+
+COPY_STATS = CopyStats()
+
+
+def copy_deep(value: Any, memo: Memo) -> Any:
+    """
+    If we cannot deepcopy an item, we revert to just referencing it:
+    - The program doesn't break
+    - We may not be able to see some mutations.
+
+    A deepcopy that fails leaves half built copies in its memo, so it copies into
+    a scratch memo that only gets merged into the shared one once it succeeds.
+    """
+    scratch: Memo = {}
+    chained = ChainMap(scratch, memo)
+    try:
+        value_copy = copy.deepcopy(value, chained)  # type: ignore[arg-type]
+    # Objects that can't cross processes, like pools and queues, refuse to be
+    # copied with all kinds of errors
+    except Exception:
+        COPY_STATS.deepcopy_fallbacks += 1
+        return value
+    # deepcopy keeps the originals alive under the id of its memo
+    kept_alive = scratch.pop(id(chained), None)
+    if kept_alive:
+        memo.setdefault(id(memo), []).extend(kept_alive)
+    memo.update(scratch)
+    return value_copy
+
+
+def copy_immutable_container(value: tuple | frozenset, memo: Memo) -> Any:
+    return value if all_immutable(value) else copy_deep(value, memo)
+
+
+def copy_shallow(value: list | set | dict, memo: Memo) -> Any:
+    value_copy = memo[id(value)] = value.copy()
+    return value_copy
+
+
+def copy_flat_container(value: list | set, memo: Memo) -> Any:
+    if id(value) in memo:
+        return memo[id(value)]
+    if all_immutable(value):
+        return copy_shallow(value, memo)
+    return copy_deep(value, memo)
+
+
+def copy_dict(value: dict, memo: Memo) -> Any:
+    if id(value) in memo:
+        return memo[id(value)]
+    if all_immutable(value) and all_immutable(value.values()):
+        return copy_shallow(value, memo)
+    return copy_deep(value, memo)
+
+
+# The objects of these packages hold processes, pipes and locks. Copying them can
+# duplicate their file descriptors, which the copies then close: they get
+# referenced instead
+REFERENCED_PACKAGES = ("multiprocessing.", "concurrent.")
+
+
+def copy_other(value: Any, memo: Memo) -> Any:
+    """The fallback for all the types that have no registered copier."""
+    if callable(value) or isinstance(value, ModuleType):
+        return SKIP
+    if type(value).__module__.startswith(REFERENCED_PACKAGES):
+        register_copier(type(value), copy_reference)
+        return value
+    return copy_deep(value, memo)
+
+
+COPIERS: dict[type, Copier] = {atom_type: copy_reference for atom_type in ATOM_TYPES}
+
+
+def register_copier(value_type: type, copier: Copier) -> None:
+    """Use the given copier for values of exactly this type.
+    The copier can return SKIP to leave the value out of the snapshot."""
+    COPIERS[value_type] = copier
+
+
+register_copier(tuple, copy_immutable_container)
+register_copier(frozenset, copy_immutable_container)
+register_copier(list, copy_flat_container)
+register_copier(set, copy_flat_container)
+register_copier(dict, copy_dict)
+for skipped_type in (
+    FunctionType,
+    BuiltinFunctionType,
+    MethodType,
+    type,
+    ModuleType,
+):
+    register_copier(skipped_type, copy_skip)
+
+
+def copy_value(value: Any, memo: Memo) -> Any:
+    """Copy with the copier registered for the type of the value."""
+    return COPIERS.get(type(value), copy_other)(value, memo)
+
+
+def snapshot(
+    variables: Symbols,
+    memo: Memo | None = None,
+    copier: Copier = copy_value,
+    skipped: Skipped | None = None,
+) -> Symbols:
+    """Copy the variables that may be displayed, leaving out dunder names.
+
+    Pass the same memo to take several snapshots at the same moment
+    (globals and locals), and the same skipped names to the snapshots of the
+    same variables."""
+    if memo is None:
+        memo = {}
+    if skipped is None:
+        skipped = {}
+    result = {}
+    for name, value in variables.items():
+        if skipped.get(name, SKIP) is value:
+            continue
+        if name.startswith("__"):
+            skipped[name] = value
+            continue
+        value_copy = copier(value, memo)
+        if value_copy is not SKIP:
+            result[name] = value_copy
+        elif is_skipped(value):
+            skipped[name] = value
+    return result
+
+
+###############################################################################
+# Representations
+###############################################################################
+
+# The longest representation kept, the rest gets cut
+MAX_REPR_LENGTH = 200
+
+
+@dataclass(frozen=True)
+class Repr:
+    """Stands for a value, of which we only keep what gets displayed."""
+
+    text: str
+    # Values of different types can have the same representation
+    type_name: str
+
+    def __repr__(self):
+        return self.text
+
+
+# Builds the representation of containers from a limited number of their items, so
+# that it costs the same however big the containers are
+_reprs = reprlib.Repr()
+_reprs.maxlevel = 4
+_reprs.maxdict = _reprs.maxlist = _reprs.maxtuple = 30
+_reprs.maxset = _reprs.maxfrozenset = _reprs.maxdeque = _reprs.maxarray = 30
+_reprs.maxstring = _reprs.maxlong = _reprs.maxother = MAX_REPR_LENGTH
+
+
+def is_skipped(value: Any) -> bool:
+    """Whether the copier registered for the type of the value always skips it."""
+    copier = COPIERS.get(type(value), copy_other)
+    return copier is copy_skip or (
+        copier is copy_other and (callable(value) or isinstance(value, ModuleType))
+    )
+
+
+def copy_repr(value: Any, memo: Memo) -> Any:
+    """A copier that keeps the representation of the value instead of a copy.
+    Skips the same values as the copiers registered for their types."""
+    value_repr = memo.get(id(value))
+    if value_repr is not None:
+        return value_repr
+    if is_skipped(value):
+        return SKIP
+    text = _reprs.repr(value)
+    if len(text) > MAX_REPR_LENGTH:
+        text = text[: MAX_REPR_LENGTH - 1] + "…"
+    value_repr = memo[id(value)] = Repr(text, type(value).__qualname__)
+    return value_repr
+
+
+###############################################################################
+# Size limits
+###############################################################################
+
+# How many items a summary shows
+SUMMARY_ITEMS = 3
+
+BRACKETS: dict[type, tuple[str, str]] = {
+    list: ("[", "]"),
+    tuple: ("(", ")"),
+    dict: ("{", "}"),
+    set: ("{", "}"),
+    frozenset: ("frozenset({", "})"),
+}
+
+
+@dataclass(frozen=True)
+class Limits:
+    """The biggest values that get copied, None for no limit."""
+
+    # The items of the value and of all the values nested in it
+    items: int | None = None
+    # Containers in containers, a flat list has a depth of 1
+    depth: int | None = None
+    # As reported by sys.getsizeof, for the value and all the values nested in it
+    bytes: int | None = None
+
+
+# Marks the end of the children of a container
+END = object()
+
+
+def only_atoms(values: Iterable[Any]) -> bool:
+    # Stops at the first value that isn't, without a python loop
+    return ATOM_TYPES.issuperset(map(type, values))
+
+
+def exceeds(value: Any, limits: Limits) -> bool:
+    """Whether the value is bigger than the limits.
+    Stops looking as soon as it is. The items of a container are counted before
+    going over them, and they are gone over lazily, so with an items limit the
+    cost is bounded by it. With a bytes limit, the sizes add up as the values are
+    reached, and it stops as soon as they pass it.
+
+    The atoms in a container add nothing to its items or its depth, only to its
+    bytes. Without a bytes limit, a container holding only atoms is not gone
+    over."""
+    items = size = 0
+    seen: set[int] = set()
+    # The children left to look at, of each container being gone over
+    pending: list[tuple[Iterator[Any], int]] = [(iter((value,)), 1)]
+    while pending:
+        children, depth = pending[-1]
+        current: Any = next(children, END)
+        if current is END:
+            pending.pop()
+            continue
+        current_type = type(current)
+        if limits.bytes is None and current_type in ATOM_TYPES:
+            continue
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        if limits.bytes is not None:
+            size += sys.getsizeof(current)
+            if size > limits.bytes:
+                return True
+        if current_type in ATOM_TYPES:
+            continue
+        if current_type is dict:
+            items += 2 * len(current)
+            nested: Iterable[Any] = chain(current.keys(), current.values())
+        elif isinstance(current, list | tuple | set | frozenset):
+            items += len(current)
+            nested = current
+        else:
+            attributes = getattr(current, "__dict__", None)
+            if type(attributes) is not dict:
+                continue
+            items += len(attributes)
+            nested = attributes.values()
+        if limits.items is not None and items > limits.items:
+            return True
+        if limits.depth is not None and depth > limits.depth:
+            return True
+        # Atoms add nothing to the items or to the depth
+        if limits.bytes is None and (
+            only_atoms(current) and only_atoms(current.values())
+            if current_type is dict
+            else only_atoms(nested)
+        ):
+            continue
+        pending.append((iter(nested), depth + 1))
+    return False
+
+
+@dataclass(frozen=True)
+class Summary:
+    """Stands for a value that was too big to be copied. Its length and its
+    fingerprint tell whether it changed."""
+
+    text: str
+    length: int | None
+    fingerprint: "Fingerprint"
+
+    def __repr__(self):
+        return self.text
+
+
+def summarize(value: Any) -> Summary:
+    brackets = BRACKETS.get(type(value))
+    if brackets is None:
+        text = _reprs.repr(value)
+    else:
+        items: Any = value.items() if type(value) is dict else value
+        shown = [*islice(items, SUMMARY_ITEMS)]
+        if type(value) is dict:
+            texts = [f"{_reprs.repr(k)}: {_reprs.repr(v)}" for k, v in shown]
+        else:
+            texts = [_reprs.repr(item) for item in shown]
+        more = len(value) - len(shown)
+        if more:
+            texts.append(f"… {more:,} more".replace(",", " "))
+        opening, closing = brackets
+        text = opening + ", ".join(texts) + closing
+    length = len(value) if hasattr(value, "__len__") else None
+    return Summary(text, length, fingerprint(value))
+
+
+def capped(copier: Copier, limits: Limits) -> Copier:
+    """A copier that summarizes the values bigger than the limits."""
+
+    def copy_capped(value: Any, memo: Memo) -> Any:
+        if (
+            type(value) not in ATOM_TYPES
+            and id(value) not in memo
+            and not is_skipped(value)
+            and exceeds(value, limits)
+        ):
+            summary = memo[id(value)] = summarize(value)
+            return summary
+        return copier(value, memo)
+
+    return copy_capped
+
+
+###############################################################################
+# Change detection
+###############################################################################
+
+# How many items at each end of a container are part of its fingerprint
+FINGERPRINT_SAMPLE = 3
+FINGERPRINT_DEPTH = 2
+
+Fingerprint: TypeAlias = tuple[Any, ...]
+
+
+def fingerprint(value: Any, depth: int = FINGERPRINT_DEPTH) -> Fingerprint:
+    """A summary of a value: two values with different fingerprints are different.
+
+    Only the type, the length and a few items at both ends of containers are looked
+    at, so the cost doesn't depend on the size of the value."""
+    value_type = type(value)
+    if value_type in ATOM_TYPES:
+        return value_type, value
+    if value_type is list or value_type is tuple:
+        items = value
+    elif value_type is dict:
+        items = value.items()
+    elif value_type is set or value_type is frozenset:
+        # Equal sets can iterate in different orders
+        return value_type, len(value)
+    else:
+        return (value_type,)
+
+    if depth == 0 or not items:
+        return value_type, len(items)
+    sample = [*islice(items, FINGERPRINT_SAMPLE)]
+    if len(items) > FINGERPRINT_SAMPLE:
+        sample += islice(reversed(items), FINGERPRINT_SAMPLE)
+    return value_type, len(items), *(fingerprint(v, depth - 1) for v in sample)
+
+
+def equal(a: Any, b: Any) -> bool:
+    """Compare two values, even those that don't know how to."""
+    try:
+        return bool(a == b)
+    except Exception:
+        # Element-wise comparisons (like numpy arrays) don't give a bool.
+        # What matters to us is that they display the same.
+        try:
+            return repr(a) == repr(b)
+        except Exception:
+            return False
+
+
+def same_value(
+    a: Any, b: Any, fingerprint_of: Callable[[Any], Fingerprint] = fingerprint
+) -> bool:
+    if a is b:
+        return True
+    if fingerprint_of(a) != fingerprint_of(b):
+        return False
+    return equal(a, b)
+
+
+def snapshot_changes(
+    variables: Symbols,
+    previous: Symbols,
+    memo: Memo,
+    copier: Copier = copy_value,
+    skipped: Skipped | None = None,
+) -> Changes:
+    """Copy only the variables that changed since the previous snapshot.
+
+    The previous snapshot gets updated in place, it is the state we compare the
+    next snapshot to.
+
+    Representations and summaries are compared to the ones of the values, those
+    cost little to take."""
+    if skipped is None:
+        skipped = {}
+    changes = Changes()
+    for name, value in variables.items():
+        if skipped.get(name, SKIP) is value:
+            value_copy = SKIP
+        elif name.startswith("__"):
+            skipped[name] = value
+            continue
+        else:
+            before = previous.get(name, SKIP)
+            if type(before) is Repr or type(before) is Summary:
+                value_copy = copier(value, memo)
+                if value_copy == before:
+                    continue
+            else:
+                if before is not SKIP and same_value(value, before):
+                    continue
+                value_copy = copier(value, memo)
+            if value_copy is SKIP and is_skipped(value):
+                skipped[name] = value
+        if value_copy is SKIP:
+            if name in previous:
+                del previous[name]
+                changes[name] = UNASSIGN
+            continue
+        changes[name] = previous[name] = value_copy
+
+    for name in previous.keys() - variables.keys():
+        del previous[name]
+        changes[name] = UNASSIGN
+
+    return changes
@@ -0,0 +1,206 @@
+"""
+Indexes a History, so that a long one can be queried without going over it from
+the start each time:
+- What was the value of a variable at a given step
+- How a variable changed between two steps
+- The first step where a variable satisfies a condition
+- The steps of a given line, or of a given kind of item
+
+A step is the position of an item in the History. The line numbers and kinds of
+the items are kept in arrays, and the changes of each variable in a list sorted by
+step, which lookups bisect.
+
+A variable of a function is the same Var in all the calls of that function. When
+a call returns, its locals get back the values they have in the enclosing call of
+the same function (with recursion), or no value.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Iterable
+from typing import Any, NamedTuple
+
+from . import TraceItem
+from .interpreter import (
+    UNASSIGN,
+    Assignments,
+    Call,
+    Elided,
+    History,
+    Line,
+    LineEffects,
+    Process,
+    Raise,
+    Return,
+    Skipped,
+    Thread,
+    Var,
+    trace_to_history,
+)
+
+KINDS = (Line, LineEffects, Call, Return, Raise, Skipped, Elided, Thread, Process)
+
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+# The scope of the globals, that outlive the calls
+GLOBAL_SCOPE = "<module>"
+
+
+class VarChanges(NamedTuple):
+    """The steps where a variable got assigned, and the values it got."""
+
+    steps: list[int]
+    values: list[Any]
+
+
+class Activation(NamedTuple):
+    """A call that has not returned yet, with the current values of its locals."""
+
+    function_name: str
+    locals: Assignments
+
+
+class Timeline:
+    def __init__(self, history: History):
+        self.history = history
+        self.line_numbers = array("i")
+        self.kinds = array("B")
+        self.changes: dict[Var, VarChanges] = {}
+        # Built on the first query that needs them
+        self.line_steps: dict[int, list[int]] | None = None
+        self.kind_steps: dict[type, list[int]] | None = None
+
+        # The activations of each thread, like the interpreter keeps them
+        thread: str | None = None
+        stack: list[Activation] = []
+        activations = {thread: stack}
+        for step, (lineno, item) in enumerate(history):
+            self.line_numbers.append(lineno)
+            self.kinds.append(KIND_CODES[type(item)])
+            match item:
+                case Call(function_name, bindings):
+                    stack.append(Activation(function_name, {}))
+                    self.record(step, bindings, stack[-1])
+                case LineEffects(assignments, _):
+                    self.record(step, assignments, stack[-1] if stack else None)
+                case Return() if stack:
+                    self.record(step, restored(stack.pop(), stack), None)
+                case Thread(name):
+                    thread = name
+                    stack = activations.setdefault(thread, [])
+                case Skipped(_, call_stack):
+                    stack = [Activation(name, {}) for name in call_stack]
+                    activations = {thread: stack}
+                case Process():
+                    thread = None
+                    stack = []
+                    activations = {thread: stack}
+
+    def record(
+        self, step: int, assignments: Assignments, activation: Activation | None
+    ) -> None:
+        for var, value in assignments.items():
+            changes = self.changes.get(var)
+            if changes is None:
+                changes = self.changes[var] = VarChanges([], [])
+            changes.steps.append(step)
+            changes.values.append(value)
+            if (
+                activation is not None
+                and var.scope == activation.function_name
+                and var.scope != GLOBAL_SCOPE
+            ):
+                activation.locals[var] = value
+
+    def __len__(self) -> int:
+        return len(self.history)
+
+    def variables(self) -> list[Var]:
+        """In the order they were first assigned."""
+        return list(self.changes)
+
+    def value_at(self, var: Var, step: int) -> Any:
+        """The value of the variable once the step is done, UNASSIGN when it
+        doesn't have one."""
+        changes = self.changes.get(var)
+        if changes is None:
+            return UNASSIGN
+        index = bisect_right(changes.steps, step) - 1
+        return changes.values[index] if index >= 0 else UNASSIGN
+
+    def state_at(self, step: int) -> Assignments:
+        """The value of each variable that has one once the step is done."""
+        state = {}
+        for var in self.changes:
+            value = self.value_at(var, step)
+            if value is not UNASSIGN:
+                state[var] = value
+        return state
+
+    def changes_between(self, var: Var, start: int, stop: int) -> list[tuple[int, Any]]:
+        """The steps from start to stop (excluded) that assigned the variable,
+        with the values they assigned."""
+        changes = self.changes.get(var)
+        if changes is None:
+            return []
+        first = bisect_left(changes.steps, start)
+        last = bisect_left(changes.steps, stop)
+        return list(zip(changes.steps[first:last], changes.values[first:last]))
+
+    def find(
+        self, var: Var, predicate: Callable[[Any], bool], start: int = 0
+    ) -> int | None:
+        """The first step from start on where the value of the variable satisfies
+        the predicate, None if there is none. Only the steps where it changes get
+        looked at."""
+        if (value := self.value_at(var, start)) is not UNASSIGN and predicate(value):
+            return start
+        changes = self.changes.get(var)
+        if changes is None:
+            return None
+        for index in range(bisect_right(changes.steps, start), len(changes.steps)):
+            value = changes.values[index]
+            if value is not UNASSIGN and predicate(value):
+                return changes.steps[index]
+        return None
+
+    def steps_on_line(self, lineno: int) -> list[int]:
+        if self.line_steps is None:
+            self.line_steps = {}
+            for step, line_number in enumerate(self.line_numbers):
+                self.line_steps.setdefault(line_number, []).append(step)
+        return self.line_steps.get(lineno, [])
+
+    def steps_of(self, kind: type) -> list[int]:
+        """The steps of the items of a kind, e.g. Call."""
+        if self.kind_steps is None:
+            self.kind_steps = {}
+            for step, code in enumerate(self.kinds):
+                self.kind_steps.setdefault(KINDS[code], []).append(step)
+        return self.kind_steps.get(kind, [])
+
+
+def restored(returned: Activation, stack: list[Activation]) -> Assignments:
+    """The locals of a call that returned get back the values they have in the
+    enclosing call of the same function, or no value."""
+    enclosing = next(
+        (
+            activation
+            for activation in reversed(stack)
+            if activation.function_name == returned.function_name
+        ),
+        None,
+    )
+    assignments = {}
+    for var, value in returned.locals.items():
+        enclosing_value = (
+            UNASSIGN if enclosing is None else enclosing.locals.get(var, UNASSIGN)
+        )
+        if enclosing_value is not value:
+            assignments[var] = enclosing_value
+    return assignments
+
+
+def trace_to_timeline(trace: Iterable[TraceItem]) -> Timeline:
+    """Build a History by interpreting the trace, and index it."""
+    return Timeline(trace_to_history(trace))
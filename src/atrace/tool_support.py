@@ -1,5 +1,7 @@
+import argparse
 import contextlib
 import io
+import sys
 import time
 from collections.abc import Callable, Iterator
 from typing import NamedTuple, TypeAlias
@@ -7,6 +9,7 @@ from typing import NamedTuple, TypeAlias
 from rich.console import Console, RenderableType
 from rich.live import Live
 
+from . import Stats
 from .interpreter import History
 
 # The extra information we display is always tied to line numbers.
@@ -44,6 +47,18 @@ def terminal_or_svg(svg_path: str | None) -> Iterator[Console]:
         yield Console()
 
 
+def add_stats_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print where the time went to stderr, once done",
+    )
+
+
+def print_stats(stats: Stats) -> None:
+    print(stats.report(), file=sys.stderr)
+
+
 # Scrolling support
 
 
@@ -0,0 +1,387 @@
+import hashlib
+import mmap
+import pickle
+import struct
+from collections.abc import Callable, Iterator, Sequence
+from dataclasses import dataclass, replace
+from typing import Any, BinaryIO, overload
+
+from . import (
+    CaptureOptions,
+    ConsumedTrace,
+    Engine,
+    Stats,
+    Symbols,
+    TCall,
+    TElided,
+    TEvent,
+    TException,
+    TGap,
+    TLine,
+    TOutput,
+    TProcess,
+    TraceItem,
+    TReturn,
+    TThread,
+    interpret_code,
+    trace_code,
+)
+from .interpreter import History, trace_to_history
+from .snapshot import Changes
+
+"""
+Saves traces to files, so that a program can be recorded once and rendered many times.
+
+A trace file is a header followed by records. Each record is a kind, a length, and
+a payload:
+- S: the source of the traced program (always the first record, when present)
+- V: a value, pickled. Values get numbered in the order they appear
+- E: an event, where the values are replaced by their numbers
+
+Identical values are stored once, which keeps the file small when a program
+carries the same values from line to line.
+
+The file is written while the program runs, and read lazily through mmap, so
+neither side has to hold the whole trace in memory.
+"""
+
+MAGIC = b"ATRACE"
+VERSION = 2
+HEADER = MAGIC + bytes([VERSION])
+
+RECORD_HEADER = struct.Struct("<cI")
+
+SOURCE = b"S"
+VALUE = b"V"
+EVENT = b"E"
+
+# The decoded values kept around by a reader, so that repeated values are shared
+MAX_CACHED_VALUES = 10_000
+
+
+@dataclass(frozen=True)
+class Unpicklable:
+    """Stands for a value that could not be saved, it only keeps its repr."""
+
+    text: str
+
+    def __repr__(self):
+        return self.text
+
+
+def is_trace_file(path: str) -> bool:
+    with open(path, "rb") as file:
+        return file.read(len(HEADER)) == HEADER
+
+
+###############################################################################
+# Writing
+###############################################################################
+
+
+class TraceWriter(ConsumedTrace):
+    """Writes the events to a file as they get captured."""
+
+    def __init__(self, path: str, source: str | None = None):
+        self.path = path
+        self.file: BinaryIO = open(path, "wb")
+        self.file.write(HEADER)
+        self.has_source = False
+        # digest of the pickled value -> value number
+        self.value_numbers: dict[bytes, int] = {}
+        if source is not None:
+            self.write_source(source)
+
+    def write_source(self, source: str) -> None:
+        if self.has_source:
+            return
+        self.write_record(SOURCE, source.encode())
+        self.has_source = True
+
+    def write_record(self, kind: bytes, payload: bytes) -> None:
+        self.file.write(RECORD_HEADER.pack(kind, len(payload)))
+        self.file.write(payload)
+
+    def value_number(self, value: Any) -> int:
+        try:
+            pickled = pickle.dumps(value)
+        except Exception:
+            pickled = pickle.dumps(Unpicklable(repr(value)))
+        digest = hashlib.blake2b(pickled, digest_size=16).digest()
+        number = self.value_numbers.get(digest)
+        if number is None:
+            number = self.value_numbers[digest] = len(self.value_numbers)
+            self.write_record(VALUE, pickled)
+        return number
+
+    def symbol_numbers(self, symbols: Symbols) -> Symbols:
+        numbers = {name: self.value_number(value) for name, value in symbols.items()}
+        return Changes(numbers) if isinstance(symbols, Changes) else numbers
+
+    def encode(self, event: TEvent) -> tuple:
+        match event:
+            case TLine(globs, locs, time):
+                return (
+                    "line",
+                    self.symbol_numbers(globs),
+                    self.symbol_numbers(locs),
+                    time,
+                )
+            case TCall(globs, locs, function_name, time):
+                return (
+                    "call",
+                    self.symbol_numbers(globs),
+                    self.symbol_numbers(locs),
+                    function_name,
+                    time,
+                )
+            case TReturn(globs, locs, return_value, time):
+                return (
+                    "return",
+                    self.symbol_numbers(globs),
+                    self.symbol_numbers(locs),
+                    self.value_number(return_value),
+                    time,
+                )
+            case TException(globs, locs, exception_type, value, _traceback, time):
+                # Tracebacks hold frames, they cannot be saved
+                return (
+                    "exception",
+                    self.symbol_numbers(globs),
+                    self.symbol_numbers(locs),
+                    self.value_number(exception_type),
+                    self.value_number(value),
+                    time,
+                )
+            case TOutput(text):
+                return "output", text
+            case TGap(dropped, call_stack, line_numbers, thread):
+                return "gap", dropped, call_stack, line_numbers, thread
+            case TElided(iterations, last_line, line_counts):
+                return "elided", iterations, last_line, line_counts
+            case TThread(name):
+                return "thread", name
+            case TProcess(pid):
+                return "process", pid
+        raise ValueError(f"Unknown event {event}")
+
+    def consume(self, item: TraceItem) -> None:
+        lineno, event = item
+        self.write_record(EVENT, pickle.dumps((lineno, *self.encode(event))))
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+###############################################################################
+# Reading
+###############################################################################
+
+
+class TraceReader(Sequence[TraceItem]):
+    """
+    A trace read lazily from a file.
+
+    Iterating decodes the events one at a time. Indexing and len need the position
+    of every event, those get collected by a first pass over the file.
+
+    The file gets mapped while it is read, and unmapped once an iteration is over:
+    a reader handed over and read once holds on to nothing. Close it, or use it as
+    a context manager, after indexing it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mmap: mmap.mmap | None = None
+        if self.mapping()[: len(HEADER)] != HEADER:
+            self.close()
+            raise ValueError(f"{path} is not a trace file")
+        self.source = ""
+        for kind, start, end in self.records():
+            if kind == SOURCE:
+                self.source = self.mapping()[start:end].decode()
+            break
+        # Value number -> position of the pickled value
+        self.value_positions: list[tuple[int, int]] = []
+        self.event_positions: list[tuple[int, int]] | None = None
+        self.values: dict[int, Any] = {}
+        # How many iterations are going on
+        self.iterating = 0
+
+    def mapping(self) -> mmap.mmap:
+        if self.mmap is None:
+            with open(self.path, "rb") as file:
+                self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mmap
+
+    def records(self) -> Iterator[tuple[bytes, int, int]]:
+        """The kind, start and end of the payload of each record."""
+        position = len(HEADER)
+        size = len(self.mapping())
+        while position + RECORD_HEADER.size <= size:
+            kind, length = RECORD_HEADER.unpack_from(self.mapping(), position)
+            start = position + RECORD_HEADER.size
+            position = start + length
+            if position > size:
+                # The program was killed while writing the record
+                return
+            yield kind, start, position
+
+    def event_index(self) -> list[tuple[int, int]]:
+        if self.event_positions is None:
+            value_positions = []
+            event_positions = []
+            for kind, start, end in self.records():
+                if kind == VALUE:
+                    value_positions.append((start, end))
+                elif kind == EVENT:
+                    event_positions.append((start, end))
+            self.value_positions = value_positions
+            self.event_positions = event_positions
+        return self.event_positions
+
+    def value(self, number: int) -> Any:
+        if number not in self.values:
+            if len(self.values) >= MAX_CACHED_VALUES:
+                self.values.clear()
+            start, end = self.value_positions[number]
+            self.values[number] = pickle.loads(self.mapping()[start:end])
+        return self.values[number]
+
+    def symbols(self, numbers: Symbols) -> Symbols:
+        symbols = {name: self.value(number) for name, number in numbers.items()}
+        return Changes(symbols) if isinstance(numbers, Changes) else symbols
+
+    def decode(self, start: int, end: int) -> TraceItem:
+        lineno, kind, *fields = pickle.loads(self.mapping()[start:end])
+        event: TEvent
+        match kind, fields:
+            case "line", [globs, locs, time]:
+                event = TLine(self.symbols(globs), self.symbols(locs), time)
+            case "call", [globs, locs, function_name, time]:
+                event = TCall(
+                    self.symbols(globs), self.symbols(locs), function_name, time
+                )
+            case "return", [globs, locs, return_value, time]:
+                event = TReturn(
+                    self.symbols(globs),
+                    self.symbols(locs),
+                    self.value(return_value),
+                    time,
+                )
+            case "exception", [globs, locs, exception_type, value, time]:
+                event = TException(
+                    self.symbols(globs),
+                    self.symbols(locs),
+                    self.value(exception_type),
+                    self.value(value),
+                    None,
+                    time,
+                )
+            case "output", [text]:
+                event = TOutput(text)
+            case "gap", [dropped, call_stack, line_numbers, thread]:
+                event = TGap(dropped, call_stack, line_numbers, thread)
+            case "elided", [iterations, last_line, line_counts]:
+                event = TElided(iterations, last_line, line_counts)
+            case "thread", [name]:
+                event = TThread(name)
+            case "process", [pid]:
+                event = TProcess(pid)
+            case _:
+                raise ValueError(f"Unknown event {kind}")
+        return lineno, event
+
+    def __iter__(self) -> Iterator[TraceItem]:
+        self.iterating += 1
+        try:
+            yield from self.events()
+        finally:
+            self.iterating -= 1
+            if not self.iterating:
+                self.close()
+
+    def events(self) -> Iterator[TraceItem]:
+        if self.event_positions is not None:
+            for start, end in self.event_positions:
+                yield self.decode(start, end)
+            return
+        values_seen = 0
+        for kind, start, end in self.records():
+            if kind == VALUE:
+                # An earlier iteration may have collected the positions already
+                if values_seen == len(self.value_positions):
+                    self.value_positions.append((start, end))
+                values_seen += 1
+            elif kind == EVENT:
+                yield self.decode(start, end)
+
+    def __len__(self) -> int:
+        return len(self.event_index())
+
+    @overload
+    def __getitem__(self, index: int) -> TraceItem: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> Sequence[TraceItem]: ...
+
+    def __getitem__(self, index: int | slice) -> TraceItem | Sequence[TraceItem]:
+        positions = self.event_index()
+        if isinstance(index, slice):
+            return [self.decode(start, end) for start, end in positions[index]]
+        return self.decode(*positions[index])
+
+    def close(self) -> None:
+        """Unmap the file, it gets mapped again if the reader is used again."""
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def __enter__(self) -> "TraceReader":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+###############################################################################
+# Recording and replaying
+###############################################################################
+
+
+def record(
+    source: str,
+    path: str,
+    engine: Engine | None = None,
+    options: CaptureOptions | None = None,
+) -> None:
+    """Run the source and save its trace to a file."""
+    options = replace(options or CaptureOptions(), record_to=path)
+    trace_code(source, lambda trace: None, engine, options)
+
+
+def replay(path: str) -> TraceReader:
+    """Open a trace saved with `record`."""
+    return TraceReader(path)
+
+
+def interpret_or_replay(
+    path: str,
+    on_history: Callable[[str, History], None],
+    options: CaptureOptions | None = None,
+) -> None:
+    """Run the program at path and hand over its source and its history.
+    If path is a trace file, the history of the saved trace is handed over instead."""
+    if is_trace_file(path):
+        stats = options.stats if options and options.stats is not None else Stats()
+        with replay(path) as reader, stats.timed("interpret"):
+            history = trace_to_history(reader)
+        on_history(reader.source, history)
+        return
+
+    with open(path) as content_file:
+        source = content_file.read()
+    interpret_code(source, lambda history: on_history(source, history), options=options)
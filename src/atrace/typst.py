@@ -1,9 +1,11 @@
 import argparse
 import re
 
-from . import Trace, trace_code
-from .interpreter import trace_to_history
+from . import CaptureOptions, Stats
+from .interpreter import History
 from .reporter import LeftAligned, TableData, history_to_table_data
+from .tool_support import add_stats_argument, print_stats
+from .trace_file import interpret_or_replay
 
 
 def escape_markdown(text: str) -> str:
@@ -58,20 +60,30 @@ def run():
     parser = argparse.ArgumentParser(
         description="Displays a markdown output of the trace of the given program."
     )
-    parser.add_argument("program", help="The path to a python file")
+    parser.add_argument(
+        "program",
+        help="The path to a python file, or to a trace saved with atrace.record",
+    )
+    parser.add_argument(
+        "--no-fold",
+        action="store_true",
+        help="Show every row, instead of folding the iterations that repeat",
+    )
+    add_stats_argument(parser)
     options = parser.parse_args()
-
-    with open(options.program) as content_file:
-        source = content_file.read()
-
-    def on_trace(trace: Trace) -> None:
-        history = trace_to_history(trace)
-        table_data = history_to_table_data(history)
-        typst = table_data_to_typst(table_data)
-        print()  # To separate the typst markup from the program output
-        print(typst)
-
-    trace_code(source, on_trace)
+    stats = Stats()
+
+    def on_history(source: str, history: History) -> None:
+        with stats.timed("table"):
+            table_data = history_to_table_data(history, fold=not options.no_fold)
+        with stats.timed("render"):
+            typst = table_data_to_typst(table_data)
+            print()  # To separate the typst markup from the program output
+            print(typst)
+
+    interpret_or_replay(options.program, on_history, CaptureOptions(stats=stats))
+    if options.stats:
+        print_stats(stats)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+import pathlib
+import re
+from collections.abc import Iterable
+from unittest.mock import patch
+
+from atrace import CaptureOptions, Engine, TException, Trace, interpret_code, trace_code
+from atrace.interpreter import History, Raise
+
+SNIPPETS_DIR = pathlib.Path(__file__).parent / "snippets"
+
+# Tracing this one attaches to the importer instead of the traced module
+SKIPPED_SNIPPETS = ("instrumented.py",)
+
+
+def snippet_sources() -> Iterable[tuple[str, str]]:
+    for path in sorted(SNIPPETS_DIR.glob("*.py")):
+        if path.name not in SKIPPED_SNIPPETS:
+            yield path.name, path.read_text()
+
+
+def comparable(value):
+    """
+    Functions, exceptions and the objects that only equal themselves (like the
+    range iterator of a comprehension before 3.12) are different objects from
+    one run to the next.
+    """
+    if callable(value):
+        return getattr(value, "__qualname__", repr(value))
+    if isinstance(value, BaseException):
+        return repr(value)
+    if isinstance(value, dict):
+        return {k: comparable(v) for k, v in value.items()}
+    if value is not None and type(value).__eq__ is object.__eq__:
+        return re.sub(r" at 0x[0-9a-f]+", "", repr(value))
+    return value
+
+
+def comparable_events(events: Iterable[tuple[int, tuple]]) -> list:
+    """Works for traces and histories."""
+    result = []
+    for lineno, event in events:
+        fields = list(event)
+        if isinstance(event, TException | Raise):
+            del fields[event._fields.index("traceback")]
+        result.append((lineno, type(event).__name__, *map(comparable, fields)))
+    return result
+
+
+def trace_with(
+    source: str, engine: Engine | None = None, options: CaptureOptions | None = None
+) -> Trace:
+    traces: list[Trace] = []
+    with patch("builtins.input", return_value="Bob"):
+        try:
+            trace_code(source, traces.append, engine, options)
+        except Exception:
+            pass
+    return traces[0]
+
+
+def history_with(source: str, options: CaptureOptions | None = None) -> History:
+    histories: list[History] = []
+    with patch("builtins.input", return_value="Bob"):
+        try:
+            interpret_code(source, histories.append, options=options)
+        except Exception:
+            pass
+    return histories[0]
@@ -0,0 +1,807 @@
+import io
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from unittest.mock import patch
+
+from atrace import (
+    CaptureOptions,
+    Changes,
+    Engine,
+    MonitoringEngine,
+    Stats,
+    TCall,
+    TElided,
+    TException,
+    TGap,
+    TLine,
+    TOutput,
+    Trace,
+    Tracer,
+    TReturn,
+    TThread,
+    _monitoring,
+    default_engine,
+    interpret_code,
+    trace,
+    trace_code,
+    tracing,
+)
+from atrace.histogram import LineTime, filter_events, line_histogram, line_times
+from atrace.interpreter import (
+    UNASSIGN,
+    Call,
+    History,
+    Line,
+    LineEffects,
+    Process,
+    Return,
+    Skipped,
+    Thread,
+    Var,
+    trace_to_history,
+)
+from atrace.reporter import LeftAligned, history_to_table_data
+from atrace.snapshot import Repr
+
+from .helpers import (
+    SNIPPETS_DIR,
+    comparable_events,
+    history_with,
+    snippet_sources,
+    trace_with,
+)
+
+# Before 3.12 a comprehension runs in its own frame, with its iterator in a
+# local that only equals itself. Every copy of it looks like a change, but its
+# representation does not.
+SELF_EQUAL_SNIPPETS = ("list_comprehension.py",) if sys.version_info < (3, 12) else ()
+
+
+class TestEngines(unittest.TestCase):
+    @unittest.skipUnless(
+        default_engine() == Engine.MONITORING, "sys.monitoring is not available"
+    )
+    def test_same_trace(self):
+        for name, source in snippet_sources():
+            with self.subTest(snippet=name):
+                self.assertEqual(
+                    comparable_events(trace_with(source, Engine.SETTRACE)),
+                    comparable_events(trace_with(source, Engine.MONITORING)),
+                )
+
+    @unittest.skipUnless(
+        default_engine() == Engine.MONITORING, "sys.monitoring is not available"
+    )
+    def test_reserved_tool_ids_come_last(self):
+        taken = []
+        try:
+            for expected in (3, 4, 2):
+                tool_id = MonitoringEngine.acquire_tool_id()
+                self.assertEqual(expected, tool_id)
+                taken.append(tool_id)
+        finally:
+            for tool_id in taken:
+                _monitoring.free_tool_id(tool_id)
+
+
+class TestHotPath(unittest.TestCase):
+    source = "total = 0\nfor i in range({n}):\n    total += i\n"
+
+    def test_no_diagnostics_per_event_when_debug_is_off(self):
+        calls = []
+        for n in (10, 1000):
+            with (
+                patch("atrace.debug") as debug,
+                patch("atrace.debug_heading") as debug_heading,
+                patch("atrace.debug_frame") as debug_frame,
+            ):
+                trace_with(self.source.format(n=n))
+            calls.append(
+                (debug.call_count, debug_heading.call_count, debug_frame.call_count)
+            )
+        self.assertEqual(calls[0], calls[1])
+
+    def test_decisions_are_cached_by_code(self):
+        traces: list[Trace] = []
+        tracer = Tracer(traces.append, None)
+        exec(compile(self.source.format(n=10), "<string>", "exec"), {})
+        self.assertEqual(
+            [(tracer.target_codeobj, True, False, {})],
+            list(tracer.code_plans.values()),
+        )
+
+
+class TestStats(unittest.TestCase):
+    def test_stats(self):
+        stats = Stats()
+        source = "x = [[1], [2]]\nfor i in range(3):\n    x[0].append(i)\n"
+        trace = trace_with(source, options=CaptureOptions(stats=stats))
+        self.assertEqual(len(trace), stats.captured)
+        self.assertEqual(len(trace), stats.peak_events)
+        self.assertGreater(stats.copied_objects, 0)
+        self.assertGreater(stats.copied_bytes, 0)
+        self.assertGreater(stats.snapshot_ns, 0)
+        self.assertGreaterEqual(stats.capture_ns, stats.snapshot_ns)
+        self.assertGreaterEqual(stats.run_ns, stats.capture_ns)
+        self.assertGreaterEqual(stats.slowdown, 1)
+        self.assertEqual(0, stats.deepcopy_fallbacks)
+
+    def test_deepcopy_fallbacks(self):
+        stats = Stats()
+        trace_with("g = [(i for i in [])]\n", options=CaptureOptions(stats=stats))
+        self.assertEqual(1, stats.deepcopy_fallbacks)
+
+    def test_interpretation_is_timed(self):
+        stats = Stats()
+        options = CaptureOptions(stats=stats)
+        interpret_code("x = 1\n", lambda history: None, options=options)
+        self.assertGreater(stats.interpret_ns, 0)
+        self.assertEqual(0, stats.peak_events)
+
+    def test_timed(self):
+        stats = Stats()
+        with stats.timed("table"):
+            pass
+        self.assertGreater(stats.table_ns, 0)
+        self.assertIn("slowdown", stats.report())
+
+
+class TestDelta(unittest.TestCase):
+    def test_only_changes_are_captured(self):
+        source = (SNIPPETS_DIR / "function_shadowing_global.py").read_text()
+        trace = trace_with(source, options=CaptureOptions(delta=True))
+        for _, event in trace:
+            if isinstance(event, TCall | TLine | TReturn | TException):
+                self.assertIsInstance(event.globals, Changes)
+                self.assertIsInstance(event.locals, Changes)
+
+        source = "x = 0\nwhile x < 2:\n    x = x + 1\ndel x\n"
+        trace = trace_with(source, options=CaptureOptions(delta=True))
+        expected_trace = [
+            (0, TCall({}, {}, "<module>")),
+            (1, TLine({}, {})),
+            (2, TLine({"x": 0}, {})),
+            (3, TLine({}, {})),
+            (2, TLine({"x": 1}, {})),
+            (3, TLine({}, {})),
+            (2, TLine({"x": 2}, {})),
+            (4, TLine({}, {})),
+            (4, TReturn({"x": UNASSIGN}, {}, None)),
+        ]
+        self.assertEqual(expected_trace, trace)
+
+    def test_same_history(self):
+        for name, source in snippet_sources():
+            with self.subTest(snippet=name):
+                self.assertEqual(
+                    comparable_events(trace_to_history(trace_with(source))),
+                    comparable_events(
+                        trace_to_history(
+                            trace_with(source, options=CaptureOptions(delta=True))
+                        )
+                    ),
+                )
+
+
+class TestRetention(unittest.TestCase):
+    source = textwrap.dedent("""\
+        def f(n):
+            total = 0
+            for i in range(n):
+                total += i
+            return total
+
+
+        x = f(4)
+        print(x)
+        """)
+
+    def test_keep_last(self):
+        trace = trace_with(self.source, options=CaptureOptions(keep_last=6))
+        self.assertEqual(7, len(trace))
+        self.assertEqual((3, TGap(13, ["<module>", "f"], [-1, 8, 4])), trace[0])
+
+        expected_table_data = (
+            ["line", LeftAligned("f"), "x", "output"],
+            [
+                ["⋮", "", "", ""],
+                ["5", "└─ 6", "", ""],
+                ["8", "", "6", ""],
+                ["9", "", "", "6"],
+            ],
+        )
+        table_data = history_to_table_data(trace_to_history(trace))
+        self.assertEqual(expected_table_data, table_data)
+
+    def test_keep_first_and_last(self):
+        options = CaptureOptions(keep_first=3, keep_last=4)
+        trace = trace_with(self.source, options=options)
+        self.assertEqual(8, len(trace))
+        self.assertEqual((5, TGap(12, ["<module>", "f"], [-1, 8, 5])), trace[3])
+
+        history = trace_to_history(trace)
+        self.assertEqual(
+            [
+                (1, Line()),
+                (8, Line()),
+                (5, Skipped(12, ["f"])),
+                (5, Return(6)),
+                (8, LineEffects({Var("<module>", "x"): 6}, None)),
+                (9, Line()),
+                (9, LineEffects({}, "6\n")),
+            ],
+            history,
+        )
+
+    def test_keep_first(self):
+        trace = trace_with(self.source, options=CaptureOptions(keep_first=5))
+        self.assertEqual((9, TGap(14, [], [-1])), trace[-1])
+        history = trace_to_history(trace)
+        self.assertEqual((9, Skipped(14, [])), history[-1])
+
+    def test_only_on_exception(self):
+        options = CaptureOptions(only_on_exception=True, keep_last=10)
+        traces: list[Trace] = []
+        trace_code(self.source, traces.append, options=options)
+        with self.assertRaises(SystemExit):
+            trace_code("import sys\nsys.exit(0)", traces.append, options=options)
+        self.assertEqual([], traces)
+
+        with self.assertRaises(ZeroDivisionError):
+            trace_code("x = 1\nx / 0\n", traces.append, options=options)
+        self.assertEqual(1, len(traces))
+
+    def test_delta_keep_last(self):
+        with self.assertRaises(ValueError):
+            CaptureOptions(delta=True, keep_last=10)
+
+
+class TestLoopSampling(unittest.TestCase):
+    source = textwrap.dedent("""\
+        def square(n):
+            return n * n
+
+
+        total = 0
+        for i in range({n}):
+            total = total + square(i)
+        print(total)
+        """)
+
+    def test_elided_iterations(self):
+        options = CaptureOptions(loop_iterations=2)
+        trace = trace_with(self.source.format(n=10), options=options)
+        self.assertIn((6, TElided(7, 7, {6: 6, 7: 7, 1: 7, 2: 7})), trace)
+
+        expected_table_data = (
+            ["line", "total", "i", LeftAligned("square"), "(square) n", "output"],
+            [
+                ["5", "0", "", "", "", ""],
+                ["6", "", "0", "", "", ""],
+                ["1", "", "", "square(0)", "0", ""],
+                ["2", "", "", "└─ 0", "", ""],
+                ["6", "", "1", "", "", ""],
+                ["1", "", "", "square(1)", "1", ""],
+                ["2", "", "", "└─ 1", "", ""],
+                ["7", "1", "", "", "", ""],
+                ["⋮ 6–7 ×7", "", "", "", "", ""],
+                # The last iteration is captured
+                ["6", "204", "8", "", "", ""],
+                ["6", "", "9", "", "", ""],
+                ["1", "", "", "square(9)", "9", ""],
+                ["2", "", "", "└─ 81", "", ""],
+                ["7", "285", "", "", "", ""],
+                ["8", "", "", "", "", "285"],
+            ],
+        )
+        table_data = history_to_table_data(trace_to_history(trace))
+        self.assertEqual(expected_table_data, table_data)
+        delta_trace = trace_with(
+            self.source.format(n=10),
+            options=CaptureOptions(loop_iterations=2, delta=True),
+        )
+        self.assertEqual(
+            expected_table_data, history_to_table_data(trace_to_history(delta_trace))
+        )
+
+    def test_nothing_elided(self):
+        # Exactly as many iterations as get captured, and one more
+        for n in (3, 4):
+            with self.subTest(n=n):
+                source = self.source.format(n=n)
+                trace = trace_with(source, options=CaptureOptions(loop_iterations=3))
+                self.assertNotIn(TElided, [type(event) for _, event in trace])
+                self.assertEqual(
+                    history_to_table_data(trace_to_history(trace_with(source))),
+                    history_to_table_data(trace_to_history(trace)),
+                )
+
+    def test_last_iteration_output(self):
+        source = (
+            "for i in range(6):\n    print(i)\n    x = i\n    del x\nprint('end')\n"
+        )
+        for delta in (False, True):
+            with self.subTest(delta=delta):
+                options = CaptureOptions(loop_iterations=2, delta=delta)
+                _, rows = history_to_table_data(
+                    trace_to_history(trace_with(source, options=options))
+                )
+                self.assertEqual(
+                    [
+                        ["⋮ 1–4 ×3", "", "", ""],
+                        ["1", "4", "", ""],
+                        ["1", "5", "", ""],
+                        ["2", "", "", "5"],
+                        ["3", "", "5", ""],
+                        ["4", "", "✖", ""],
+                        ["5", "", "", "end"],
+                    ],
+                    rows[-7:],
+                )
+
+    def test_same_line_counts(self):
+        source = self.source.format(n=10)
+        options = CaptureOptions(loop_iterations=2)
+        self.assertEqual(
+            line_histogram(filter_events(trace_to_history(trace_with(source)))),
+            line_histogram(
+                filter_events(trace_to_history(trace_with(source, options=options)))
+            ),
+        )
+
+    def test_capture_does_not_grow_with_iterations(self):
+        options = CaptureOptions(loop_iterations=3)
+        lengths = [
+            len(trace_with(self.source.format(n=n), options=options))
+            for n in (10, 10_000)
+        ]
+        self.assertEqual(lengths[0], lengths[1])
+
+    def test_same_history_when_loops_are_short(self):
+        options = CaptureOptions(loop_iterations=100)
+        for name, source in snippet_sources():
+            with self.subTest(snippet=name):
+                self.assertEqual(
+                    comparable_events(trace_with(source)),
+                    comparable_events(trace_with(source, options=options)),
+                )
+
+
+class TestTimestamps(unittest.TestCase):
+    source = "def f():\n    return 1\n\nx = f()\n"
+
+    def times(self, trace: Trace) -> list:
+        return [getattr(event, "time", None) for _, event in trace]
+
+    def test_off_by_default(self):
+        self.assertEqual({None}, set(self.times(trace_with(self.source))))
+
+    def test_increasing(self):
+        trace = trace_with(self.source, options=CaptureOptions(timestamps=True))
+        times = self.times(trace)
+        self.assertNotIn(None, times)
+        self.assertEqual(sorted(times), times)
+
+    def test_handling_is_left_out(self):
+        stats = Stats()
+        options = CaptureOptions(timestamps=True, stats=stats)
+        times = self.times(trace_with(self.source, options=options))
+        self.assertLess(times[-1] - times[0], stats.run_ns - stats.capture_ns)
+
+    def test_line_times(self):
+        history: History = [
+            (1, Line(time=0)),
+            (4, Line(time=10)),
+            (1, Call("f", {}, time=20)),
+            (2, Line(time=30)),
+            (2, Return(1, time=100)),
+            (5, Thread("worker")),
+            (7, Line(time=1000)),
+            (8, Line(time=1500)),
+            (5, Thread(None)),
+            (5, Line(time=110)),
+            (6, Line()),
+            (6, Line(time=111)),
+        ]
+        self.assertEqual(
+            {
+                1: LineTime(20, 20),
+                2: LineTime(70, 70),
+                4: LineTime(20, 100),
+                5: LineTime(1, 1),
+                7: LineTime(500, 500),
+            },
+            line_times(history),
+        )
+
+
+def engines() -> list[Engine]:
+    if default_engine() == Engine.MONITORING:
+        return [Engine.SETTRACE, Engine.MONITORING]
+    return [Engine.SETTRACE]
+
+
+def double(x: int) -> int:
+    return x * 2
+
+
+def triangle(n: int) -> int:
+    total = 0
+    for i in range(n):
+        total += double(i)
+    return total
+
+
+def countdown(n: int) -> int:
+    return n if n == 0 else countdown(n - 1)
+
+
+def in_a_block(engine: Engine, histories: list[History]) -> int:
+    total = 5
+    with tracing(engine, history_callback=histories.append):
+        total += double(1)
+    return total
+
+
+class TestScopes(unittest.TestCase):
+    def test_decorator(self):
+        line = triangle.__code__.co_firstlineno
+        for engine in engines():
+            with self.subTest(engine=engine):
+                histories: list[History] = []
+                traced = trace(engine=engine, history_callback=histories.append)(
+                    triangle
+                )
+                self.assertEqual(2, traced(2))
+                [history] = histories
+                # The functions defined elsewhere, like double, are not traced
+                self.assertEqual(
+                    (
+                        [
+                            "line",
+                            LeftAligned("triangle"),
+                            "(triangle) n",
+                            "(triangle) total",
+                            "(triangle) i",
+                        ],
+                        [
+                            [str(line), "triangle(2)", "2", "", ""],
+                            [str(line + 1), "│  ", "", "0", ""],
+                            [str(line + 2), "│  ", "", "", "0"],
+                            [str(line + 2), "│  ", "", "", "1"],
+                            [str(line + 3), "│  ", "", "2", ""],
+                        ],
+                    ),
+                    history_to_table_data(history),
+                )
+
+    def test_recursion_is_part_of_the_outermost_call(self):
+        for engine in engines():
+            with self.subTest(engine=engine):
+                histories: list[History] = []
+                traced = trace(engine=engine, history_callback=histories.append)(
+                    countdown
+                )
+                traced(3)
+                self.assertEqual(1, len(histories))
+
+    def test_with_block(self):
+        line = in_a_block.__code__.co_firstlineno
+        for engine in engines():
+            with self.subTest(engine=engine):
+                histories: list[History] = []
+                self.assertEqual(7, in_a_block(engine, histories))
+                [history] = histories
+                self.assertEqual(
+                    (
+                        [
+                            "line",
+                            LeftAligned("in_a_block"),
+                            LeftAligned("double"),
+                            "(double) x",
+                            "(in_a_block) total",
+                        ],
+                        [
+                            [str(line - 15), "│  ", "double(1)", "1", ""],
+                            [str(line - 14), "│  ", "└─ 2", "", ""],
+                            [str(line + 3), "│  ", "", "", "7"],
+                        ],
+                    ),
+                    history_to_table_data(history),
+                )
+
+    def test_nothing_is_left_installed(self):
+        for engine in engines():
+            with self.subTest(engine=engine):
+                trace(engine=engine, history_callback=lambda history: None)(triangle)(3)
+                in_a_block(engine, [])
+                self.assertIsNone(sys.gettrace())
+                if engine == Engine.MONITORING:
+                    self.assertEqual(
+                        [None] * 5,
+                        [_monitoring.get_tool(tool_id) for tool_id in range(5)],
+                    )
+
+    def test_nested_scopes(self):
+        histories: list[History] = []
+        traced = trace(history_callback=histories.append)(triangle)
+        with tracing(history_callback=histories.append):
+            traced(2)
+        self.assertEqual(1, len(histories))
+
+    def test_generators_cannot_be_traced(self):
+        def generator():
+            yield 1
+
+        with self.assertRaises(TypeError):
+            trace(generator)
+
+
+class TestThreads(unittest.TestCase):
+    source = textwrap.dedent("""\
+        import threading
+
+
+        def work(n):
+            total = n * 2
+            print("total", total)
+
+
+        worker = threading.Thread(target=work, args=(3,), name="worker")
+        worker.start()
+        worker.join()
+        del worker
+        x = 1
+        """)
+
+    def test_events_are_attributed_to_their_thread(self):
+        for engine in {Engine.SETTRACE, default_engine()}:
+            with self.subTest(engine=engine):
+                trace = trace_with(self.source, engine)
+                self.assertIn((4, TThread("worker")), trace)
+                self.assertIn(TThread(None), [event for _, event in trace])
+
+                headers, rows = history_to_table_data(trace_to_history(trace))
+                self.assertEqual(["line", "thread", "worker"], headers[:3])
+                # Leave out the worker column, it shows the id of the thread
+                self.assertEqual(
+                    [
+                        ["9", "", "", "", "", "", ""],
+                        ["4", "worker", "work(3)", "3", "", "", ""],
+                        ["5", "worker", "│  ", "", "6", "", ""],
+                        ["6", "worker", "│  ", "", "", "", "total 6"],
+                        ["6", "worker", "└─ ", "", "", "", ""],
+                        ["12", "", "", "", "", "", ""],
+                        ["13", "", "", "", "", "1", ""],
+                    ],
+                    [row[:2] + row[3:] for row in rows],
+                )
+
+    def test_gap_has_the_stack_of_its_thread(self):
+        trace = trace_with(self.source, options=CaptureOptions(keep_last=3))
+        lineno, gap = trace[0]
+        assert isinstance(gap, TGap)
+        # How many events got dropped depends on how the threads took turns
+        self.assertEqual((12, ["<module>"], [-1, 11], None), (lineno, *gap[1:]))
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "fork is not available")
+class TestProcesses(unittest.TestCase):
+    source = textwrap.dedent("""\
+        import multiprocessing
+
+
+        def work(n):
+            total = n * 2
+            print("total", total)
+
+
+        child = multiprocessing.get_context("fork").Process(target=work, args=(3,))
+        child.start()
+        child.join()
+        pid = child.pid
+        """)
+
+    def test_forked_process(self):
+        for engine in engines():
+            with self.subTest(engine=engine):
+                history = trace_to_history(trace_with(self.source, engine))
+                [pid] = [item.pid for _, item in history if isinstance(item, Process)]
+                self.assertNotEqual(os.getpid(), pid)
+
+                headers, rows = history_to_table_data(history)
+                self.assertEqual(["line", "process", "child"], headers[:3])
+                # Leave out the child column, it shows the id of the process
+                self.assertEqual(
+                    [
+                        ["9", "", "", "", "", "", ""],
+                        ["12", "", str(pid), "", "", "", ""],
+                        ["4", str(pid), "", "work(3)", "3", "", ""],
+                        ["5", str(pid), "", "│  ", "", "6", ""],
+                        ["6", str(pid), "", "│  ", "", "", "total 6"],
+                        ["6", str(pid), "", "└─ ", "", "", ""],
+                    ],
+                    [row[:2] + row[3:] for row in rows],
+                )
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_child_that_exits_without_notice(self):
+        source = textwrap.dedent("""\
+            import os
+
+            pid = os.fork()
+            if pid == 0:
+                total = 2 * 3
+                os._exit(0)
+            os.waitpid(pid, 0)
+            """)
+        for engine in engines():
+            with self.subTest(engine=engine):
+                history = trace_to_history(trace_with(source, engine))
+                [pid] = [item.pid for _, item in history if isinstance(item, Process)]
+                # The child never gets back to code that is not traced
+                self.assertEqual(
+                    [["3", "", str(pid), ""], ["5", str(pid), "", "6"]],
+                    history_to_table_data(history)[1],
+                )
+
+    def test_nothing_is_left_behind(self):
+        trace_with(self.source)
+        self.assertNotIn("ATRACE_PROCESSES_DIR", os.environ)
+
+    def test_spawned_processes(self):
+        program = textwrap.dedent("""\
+            import atrace
+            import multiprocessing
+
+
+            def square(n):
+                return n * n
+
+
+            if __name__ == "__main__":
+                with multiprocessing.get_context("spawn").Pool(2) as pool:
+                    squares = pool.map(square, [2, 3])
+            """)
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / "program.py"
+            path.write_text(program)
+            result = subprocess.run(
+                [sys.executable, str(path)],
+                capture_output=True,
+                text=True,
+                check=True,
+                timeout=60,
+                env={
+                    **os.environ,
+                    "PYTHONPATH": os.pathsep.join(sys.path),
+                    "COLUMNS": "200",
+                },
+            )
+        self.assertIn("process", result.stdout)
+        self.assertIn("square(2)", result.stdout)
+        self.assertIn("└─ 9", result.stdout)
+        self.assertEqual("", result.stderr)
+
+
+class TestReprOnly(unittest.TestCase):
+    def test_same_table(self):
+        for options in (
+            CaptureOptions(repr_only=True),
+            CaptureOptions(repr_only=True, delta=True),
+        ):
+            for name, source in snippet_sources():
+                if name in SELF_EQUAL_SNIPPETS:
+                    continue
+                with self.subTest(snippet=name, delta=options.delta):
+                    self.assertEqual(
+                        history_to_table_data(trace_to_history(trace_with(source))),
+                        history_to_table_data(
+                            trace_to_history(trace_with(source, options=options))
+                        ),
+                    )
+
+    def test_no_copies_are_kept(self):
+        source = "x = [[1], [2]]\nx[0].append(3)\n"
+        trace = trace_with(source, options=CaptureOptions(repr_only=True))
+        values = [v for _, e in trace for v in getattr(e, "globals", {}).values()]
+        self.assertEqual([Repr("[[1], [2]]", "list")], values[:1])
+        self.assertTrue(all(isinstance(value, Repr) for value in values))
+
+
+class TestLimits(unittest.TestCase):
+    source = textwrap.dedent("""\
+        data = list(range(1000))
+        data[-1] = 0
+        data = data[:2]
+        """)
+
+    def test_big_values_are_summarized(self):
+        for options in (
+            CaptureOptions(max_items=100),
+            CaptureOptions(max_items=100, delta=True),
+        ):
+            with self.subTest(delta=options.delta):
+                trace = trace_with(self.source, options=options)
+                expected_table_data = (
+                    ["line", "data"],
+                    [
+                        ["1", "[0, 1, 2, … 997 more]"],
+                        ["2", "[0, 1, 2, … 997 more]"],
+                        ["3", "[0, 1]"],
+                    ],
+                )
+                table_data = history_to_table_data(trace_to_history(trace))
+                self.assertEqual(expected_table_data, table_data)
+
+
+class TestOutput(unittest.TestCase):
+    def outputs(self, source: str, options: CaptureOptions | None = None) -> list:
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            trace = trace_with(source, options=options)
+        return [(lineno, e.text) for lineno, e in trace if isinstance(e, TOutput)]
+
+    def test_pieces_are_joined_once(self):
+        options = CaptureOptions(max_row_output=None, max_output=None)
+        self.assertEqual(
+            [(1, " ".join(map(str, range(100_000))) + "\n")],
+            self.outputs("print(*range(100_000))\n", options),
+        )
+
+    def test_limits(self):
+        source = 'print("abcdefgh")\nprint("ijkl")\nprint("m")\n'
+        options = CaptureOptions(max_row_output=5, max_output=8)
+        [(_, first), (_, second), (_, third)] = self.outputs(source, options)
+        path = re.sub(r".* in (.*)\n", r"\1", first)
+        self.addCleanup(os.remove, path)
+        self.assertEqual(
+            [
+                f"abcde… 4 more characters in {path}\n",
+                f"ijk… 2 more characters in {path}\n",
+                f"… 2 more characters in {path}\n",
+            ],
+            [first, second, third],
+        )
+        self.assertEqual("fgh\nl\nm\n", pathlib.Path(path).read_text())
+
+    def test_stderr(self):
+        source = 'import sys\nprint("out")\nprint("err", file=sys.stderr)\n'
+        self.assertEqual([(2, "out\n")], self.outputs(source))
+        self.assertEqual(
+            [(2, "out\n"), (3, "err\n")],
+            self.outputs(source, CaptureOptions(capture_stderr=True)),
+        )
+
+
+class TestInterpretedCapture(unittest.TestCase):
+    def test_same_history(self):
+        for options in (CaptureOptions(), CaptureOptions(delta=True)):
+            for name, source in snippet_sources():
+                with self.subTest(snippet=name, delta=options.delta):
+                    self.assertEqual(
+                        comparable_events(trace_to_history(trace_with(source))),
+                        comparable_events(history_with(source, options)),
+                    )
+
+    def test_output_is_coalesced(self):
+        history = history_with('print("a", "b")\nprint("c")\n')
+        self.assertEqual(
+            [
+                (1, Line()),
+                (1, LineEffects({}, "a b\n")),
+                (2, Line()),
+                (2, LineEffects({}, "c\n")),
+            ],
+            history,
+        )
+
+    def test_all_the_events_are_needed(self):
+        with self.assertRaises(ValueError):
+            interpret_code("x = 1", print, options=CaptureOptions(keep_last=5))
@@ -29,18 +29,17 @@ class TestFunctions(unittest.TestCase):
         expected_trace = [
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
-            (5, TLine({"p": mock.ANY}, {})),
-            (1, TCall({"p": mock.ANY}, {}, "p")),
-            (2, TLine({"p": mock.ANY}, {})),
+            (5, TLine({}, {})),
+            (1, TCall({}, {}, "p")),
+            (2, TLine({}, {})),
             (2, TOutput("hello\n")),
-            (2, TReturn({"p": mock.ANY}, {}, None)),
-            (5, TReturn({"p": mock.ANY}, {}, None)),
+            (2, TReturn({}, {}, None)),
+            (5, TReturn({}, {}, None)),
         ]
         self.assertEqual(expected_trace, self.trace)
 
         expected_history = [
             (1, Line()),
-            (1, LineEffects({Var("<module>", "p"): mock.ANY}, None)),
             (5, Line()),
             (1, Call("p", {})),
             (2, Line()),
@@ -56,19 +55,18 @@ class TestFunctions(unittest.TestCase):
         expected_trace = [
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
-            (6, TLine({"double": mock.ANY}, {})),
-            (1, TCall({"double": mock.ANY}, {"a": 3}, "double")),
-            (2, TLine({"double": mock.ANY}, {"a": 3})),
-            (3, TLine({"double": mock.ANY}, {"a": 3, "result": 6})),
-            (3, TReturn({"double": mock.ANY}, {"a": 3, "result": 6}, 6)),
-            (6, TReturn({"double": mock.ANY, "x": 6}, {}, None)),
+            (6, TLine({}, {})),
+            (1, TCall({}, {"a": 3}, "double")),
+            (2, TLine({}, {"a": 3})),
+            (3, TLine({}, {"a": 3, "result": 6})),
+            (3, TReturn({}, {"a": 3, "result": 6}, 6)),
+            (6, TReturn({"x": 6}, {}, None)),
         ]
 
         self.assertEqual(expected_trace, self.trace)
 
         expected_history = [
             (1, Line()),
-            (1, LineEffects({Var("<module>", "double"): mock.ANY}, None)),
             (6, Line()),
             (1, Call("double", {Var("double", "a"): 3})),
             (2, Line()),
@@ -86,18 +84,17 @@ class TestFunctions(unittest.TestCase):
         expected_trace = [
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
-            (5, TLine({"double": mock.ANY}, {})),
-            (6, TLine({"double": mock.ANY, "x": 3}, {})),
-            (1, TCall({"double": mock.ANY, "x": 3}, {"a": 5}, "double")),
-            (2, TLine({"double": mock.ANY, "x": 3}, {"a": 5})),
-            (2, TReturn({"double": mock.ANY, "x": 3}, {"a": 5}, 10)),
-            (6, TReturn({"double": mock.ANY, "x": 10}, {}, None)),
+            (5, TLine({}, {})),
+            (6, TLine({"x": 3}, {})),
+            (1, TCall({"x": 3}, {"a": 5}, "double")),
+            (2, TLine({"x": 3}, {"a": 5})),
+            (2, TReturn({"x": 3}, {"a": 5}, 10)),
+            (6, TReturn({"x": 10}, {}, None)),
         ]
         self.assertEqual(expected_trace, self.trace)
 
         expected_history = [
             (1, Line()),
-            (1, LineEffects({Var("<module>", "double"): mock.ANY}, None)),
             (5, Line()),
             (5, LineEffects({Var("<module>", "x"): 3}, None)),
             (6, Line()),
@@ -115,19 +112,18 @@ class TestFunctions(unittest.TestCase):
         expected_trace = [
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
-            (5, TLine({"double": mock.ANY}, {})),
+            (5, TLine({}, {})),
             (5, TOutput("hahaha\n")),
-            (6, TLine({"double": mock.ANY}, {})),
-            (1, TCall({"double": mock.ANY}, {"a": 5}, "double")),
-            (2, TLine({"double": mock.ANY}, {"a": 5})),
-            (2, TReturn({"double": mock.ANY}, {"a": 5}, 10)),
-            (6, TReturn({"double": mock.ANY, "x": 10}, {}, None)),
+            (6, TLine({}, {})),
+            (1, TCall({}, {"a": 5}, "double")),
+            (2, TLine({}, {"a": 5})),
+            (2, TReturn({}, {"a": 5}, 10)),
+            (6, TReturn({"x": 10}, {}, None)),
         ]
         self.assertEqual(expected_trace, self.trace)
 
         expected_history = [
             (1, Line()),
-            (1, LineEffects({Var("<module>", "double"): mock.ANY}, None)),
             (5, Line()),
             (5, LineEffects({}, "hahaha\n")),
             (6, Line()),
@@ -146,12 +142,12 @@ class TestFunctions(unittest.TestCase):
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
             (4, TLine({"c": "start"}, {})),
-            (10, TLine({"c": "start", "f": mock.ANY}, {})),
-            (4, TCall({"c": "start", "f": mock.ANY}, {"a": 3, "b": 14}, "f")),
-            (6, TLine({"c": "start", "f": mock.ANY}, {"a": 3, "b": 14})),
-            (7, TLine({"c": 17, "f": mock.ANY}, {"a": 3, "b": 14})),
-            (7, TReturn({"c": 17, "f": mock.ANY}, {"a": 3, "b": 14}, 17)),
-            (10, TReturn({"c": 17, "f": mock.ANY, "x": 34}, {}, None)),
+            (10, TLine({"c": "start"}, {})),
+            (4, TCall({"c": "start"}, {"a": 3, "b": 14}, "f")),
+            (6, TLine({"c": "start"}, {"a": 3, "b": 14})),
+            (7, TLine({"c": 17}, {"a": 3, "b": 14})),
+            (7, TReturn({"c": 17}, {"a": 3, "b": 14}, 17)),
+            (10, TReturn({"c": 17, "x": 34}, {}, None)),
         ]
         self.assertEqual(expected_trace, self.trace)
 
@@ -159,7 +155,6 @@ class TestFunctions(unittest.TestCase):
             (1, Line()),
             (1, LineEffects({Var("<module>", "c"): "start"}, None)),
             (4, Line()),
-            (4, LineEffects({Var("<module>", "f"): mock.ANY}, None)),
             (10, Line()),
             (4, Call("f", {Var("f", "a"): 3, Var("f", "b"): 14})),
             (6, Line()),
@@ -178,12 +173,12 @@ class TestFunctions(unittest.TestCase):
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
             (4, TLine({"c": "start"}, {})),
-            (9, TLine({"c": "start", "f": mock.ANY}, {})),
-            (4, TCall({"c": "start", "f": mock.ANY}, {"a": 3, "b": 14}, "f")),
-            (5, TLine({"c": "start", "f": mock.ANY}, {"a": 3, "b": 14})),
-            (6, TLine({"c": "start", "f": mock.ANY}, {"a": 3, "b": 14, "c": 17})),
-            (6, TReturn({"c": "start", "f": mock.ANY}, {"a": 3, "b": 14, "c": 17}, 17)),
-            (9, TReturn({"c": "start", "f": mock.ANY, "x": 34}, {}, None)),
+            (9, TLine({"c": "start"}, {})),
+            (4, TCall({"c": "start"}, {"a": 3, "b": 14}, "f")),
+            (5, TLine({"c": "start"}, {"a": 3, "b": 14})),
+            (6, TLine({"c": "start"}, {"a": 3, "b": 14, "c": 17})),
+            (6, TReturn({"c": "start"}, {"a": 3, "b": 14, "c": 17}, 17)),
+            (9, TReturn({"c": "start", "x": 34}, {}, None)),
         ]
         self.assertEqual(expected_trace, self.trace)
 
@@ -191,7 +186,6 @@ class TestFunctions(unittest.TestCase):
             (1, Line()),
             (1, LineEffects({Var("<module>", "c"): "start"}, None)),
             (4, Line()),
-            (4, LineEffects({Var("<module>", "f"): mock.ANY}, None)),
             (9, Line()),
             (4, Call("f", {Var("f", "a"): 3, Var("f", "b"): 14})),
             (5, Line()),
@@ -209,26 +203,25 @@ class TestFunctions(unittest.TestCase):
         expected_trace = [
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
-            (5, TLine({"sum_up_to": mock.ANY}, {})),
-            (1, TCall({"sum_up_to": mock.ANY}, {"x": 2}, "sum_up_to")),
-            (2, TLine({"sum_up_to": mock.ANY}, {"x": 2})),
-            (1, TCall({"sum_up_to": mock.ANY}, {"x": 1}, "sum_up_to")),
-            (2, TLine({"sum_up_to": mock.ANY}, {"x": 1})),
-            (1, TCall({"sum_up_to": mock.ANY}, {"x": 0}, "sum_up_to")),
-            (2, TLine({"sum_up_to": mock.ANY}, {"x": 0})),
-            (2, TReturn({"sum_up_to": mock.ANY}, {"x": 0}, 0)),
-            (2, TReturn({"sum_up_to": mock.ANY}, {"x": 1}, 1)),
-            (2, TReturn({"sum_up_to": mock.ANY}, {"x": 2}, 3)),
+            (5, TLine({}, {})),
+            (1, TCall({}, {"x": 2}, "sum_up_to")),
+            (2, TLine({}, {"x": 2})),
+            (1, TCall({}, {"x": 1}, "sum_up_to")),
+            (2, TLine({}, {"x": 1})),
+            (1, TCall({}, {"x": 0}, "sum_up_to")),
+            (2, TLine({}, {"x": 0})),
+            (2, TReturn({}, {"x": 0}, 0)),
+            (2, TReturn({}, {"x": 1}, 1)),
+            (2, TReturn({}, {"x": 2}, 3)),
             (
                 5,
-                TReturn({"sum_up_to": mock.ANY, "result": 3}, {}, None),
+                TReturn({"result": 3}, {}, None),
             ),
         ]
         self.assertEqual(expected_trace, self.trace)
 
         expected_history = [
             (1, Line()),
-            (1, LineEffects({Var("<module>", "sum_up_to"): mock.ANY}, None)),
             (5, Line()),
             (1, Call("sum_up_to", {Var("sum_up_to", "x"): 2})),
             (2, Line()),
@@ -250,38 +243,36 @@ class TestFunctions(unittest.TestCase):
         expected_trace = [
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
-            (11, TLine({"outer": mock.ANY}, {})),
-            (1, TCall({"outer": mock.ANY}, {"x": 4}, "outer")),
-            (2, TLine({"outer": mock.ANY}, {"x": 4})),
-            (4, TLine({"outer": mock.ANY}, {"x": 4, "y": 5})),
+            (11, TLine({}, {})),
+            (1, TCall({}, {"x": 4}, "outer")),
+            (2, TLine({}, {"x": 4})),
+            (4, TLine({}, {"x": 4, "y": 5})),
             (
                 8,
-                TLine({"outer": mock.ANY}, {"x": 4, "y": 5, "inner": mock.ANY}),
+                TLine({}, {"x": 4, "y": 5}),
             ),
-            (4, TCall({"outer": mock.ANY}, {"a": 8, "y": 5}, "inner")),
-            (5, TLine({"outer": mock.ANY}, {"a": 8, "y": 5})),
-            (6, TLine({"outer": mock.ANY}, {"a": 8, "x": 13, "y": 5})),
+            (4, TCall({}, {"a": 8, "y": 5}, "inner")),
+            (5, TLine({}, {"a": 8, "y": 5})),
+            (6, TLine({}, {"a": 8, "x": 13, "y": 5})),
             (
                 6,
-                TReturn({"outer": mock.ANY}, {"a": 8, "x": 13, "y": 5}, 13),
+                TReturn({}, {"a": 8, "x": 13, "y": 5}, 13),
             ),
             (
                 8,
-                TReturn({"outer": mock.ANY}, {"x": 4, "y": 5, "inner": mock.ANY}, 13),
+                TReturn({}, {"x": 4, "y": 5}, 13),
             ),
-            (11, TReturn({"outer": mock.ANY, "result": 13}, {}, None)),
+            (11, TReturn({"result": 13}, {}, None)),
         ]
         self.assertEqual(expected_trace, self.trace)
 
         expected_history = [
             (1, Line()),
-            (1, LineEffects({Var("<module>", "outer"): mock.ANY}, None)),
             (11, Line()),
             (1, Call("outer", {Var("outer", "x"): 4})),
             (2, Line()),
             (2, LineEffects({Var("outer", "y"): 5}, None)),
             (4, Line()),
-            (4, LineEffects({Var("outer", "inner"): mock.ANY}, None)),
             (8, Line()),
             # Closures in action!
             (4, Call("inner", {Var("inner", "a"): 8, Var("inner", "y"): 5})),
@@ -301,24 +292,22 @@ class TestFunctions(unittest.TestCase):
         expected_trace = [
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
-            (5, TLine({"f": mock.ANY}, {})),
-            (7, TLine({"f": mock.ANY, "greet": mock.ANY}, {})),
-            (1, TCall({"f": mock.ANY, "greet": mock.ANY}, {"name": "Mike"}, "f")),
-            (2, TLine({"f": mock.ANY, "greet": mock.ANY}, {"name": "Mike"})),
+            (5, TLine({}, {})),
+            (7, TLine({}, {})),
+            (1, TCall({}, {"name": "Mike"}, "f")),
+            (2, TLine({}, {"name": "Mike"})),
             (2, TOutput("Hello Mike\n")),
             (
                 2,
-                TReturn({"f": mock.ANY, "greet": mock.ANY}, {"name": "Mike"}, None),
+                TReturn({}, {"name": "Mike"}, None),
             ),
-            (7, TReturn({"f": mock.ANY, "greet": mock.ANY}, {}, None)),
+            (7, TReturn({}, {}, None)),
         ]
         self.assertEqual(expected_trace, self.trace)
 
         expected_history = [
             (1, Line()),
-            (1, LineEffects({Var("<module>", "f"): mock.ANY}, None)),
             (5, Line()),
-            (5, LineEffects({Var("<module>", "greet"): mock.ANY}, None)),
             (7, Line()),
             (1, Call("f", {Var("f", "name"): "Mike"})),
             (2, Line()),
@@ -334,18 +323,17 @@ class TestFunctions(unittest.TestCase):
         expected_trace = [
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
-            (2, TLine({"add": mock.ANY}, {})),
-            (1, TCall({"add": mock.ANY}, {"x": 5, "y": 3}, mock.ANY)),
-            (1, TLine({"add": mock.ANY}, {"x": 5, "y": 3})),
-            (1, TReturn({"add": mock.ANY}, {"x": 5, "y": 3}, 8)),
+            (2, TLine({}, {})),
+            (1, TCall({}, {"x": 5, "y": 3}, mock.ANY)),
+            (1, TLine({}, {"x": 5, "y": 3})),
+            (1, TReturn({}, {"x": 5, "y": 3}, 8)),
             (2, TOutput("8\n")),
-            (2, TReturn({"add": mock.ANY}, {}, None)),
+            (2, TReturn({}, {}, None)),
         ]
         self.assertEqual(expected_trace, self.trace)
 
         expected_history = [
             (1, Line()),
-            (1, LineEffects({Var("<module>", "add"): mock.ANY}, None)),
             (2, Line()),
             (1, Call("<lambda>", {Var("<lambda>", "x"): 5, Var("<lambda>", "y"): 3})),
             (1, Line()),
@@ -361,35 +349,34 @@ class TestFunctions(unittest.TestCase):
         expected_trace = [
             (0, TCall({}, {}, "<module>")),
             (1, TLine({}, {})),
-            (7, TLine({"countdown": mock.ANY}, {})),
-            (1, TCall({"countdown": mock.ANY}, {"n": 1}, "countdown")),
-            (2, TLine({"countdown": mock.ANY}, {"n": 1})),
-            (3, TLine({"countdown": mock.ANY}, {"n": 1})),
-            (3, TReturn({"countdown": mock.ANY}, {"n": 1}, 1)),
-            (8, TLine({"countdown": mock.ANY, "num": 1}, {})),
+            (7, TLine({}, {})),
+            (1, TCall({}, {"n": 1}, "countdown")),
+            (2, TLine({}, {"n": 1})),
+            (3, TLine({}, {"n": 1})),
+            (3, TReturn({}, {"n": 1}, 1)),
+            (8, TLine({"num": 1}, {})),
             (8, TOutput(text="1\n")),
-            (7, TLine({"countdown": mock.ANY, "num": 1}, {})),
+            (7, TLine({"num": 1}, {})),
             (
                 3,
                 TCall(
-                    {"countdown": mock.ANY, "num": 1},
+                    {"num": 1},
                     {"n": 1},
                     "countdown",
                 ),
             ),
-            (4, TLine({"countdown": mock.ANY, "num": 1}, {"n": 1})),
-            (2, TLine({"countdown": mock.ANY, "num": 1}, {"n": 0})),
+            (4, TLine({"num": 1}, {"n": 1})),
+            (2, TLine({"num": 1}, {"n": 0})),
             (
                 2,
-                TReturn({"countdown": mock.ANY, "num": 1}, {"n": 0}, None),
+                TReturn({"num": 1}, {"n": 0}, None),
             ),
-            (7, TReturn({"countdown": mock.ANY, "num": 1}, {}, None)),
+            (7, TReturn({"num": 1}, {}, None)),
         ]
         self.assertEqual(expected_trace, self.trace)
 
         expected_history = [
             (1, Line()),
-            (1, LineEffects({Var("<module>", "countdown"): mock.ANY}, None)),
             (7, Line()),
             (1, Call("countdown", {Var("countdown", "n"): 1})),
             (2, Line()),
@@ -25,6 +25,9 @@ def capture_report(table: Table) -> str:
     return capture.get()
 
 
+x = Var("<module>", "x")
+
+
 class TestReporter(unittest.TestCase):
     def test_assign_none_unassign(self):
         history: History = [
@@ -88,6 +91,34 @@ class TestReporter(unittest.TestCase):
         )
         self.assertEqual(expected_table_data, history_to_table_data(history))
 
+    def test_recursion(self):
+        n = Var("down", "n")
+        history: History = [
+            (1, Line()),
+            (1, LineEffects({Var("<module>", "down"): lambda: None}, None)),
+            (5, Line()),
+            (1, Call("down", {n: 1})),
+            (2, Line()),
+            (3, Line()),
+            (1, Call("down", {n: 0})),
+            (2, Line()),
+            (2, Return(0)),
+            (3, Line()),
+            (3, Return(1)),
+            (5, LineEffects({Var("<module>", "r"): 1}, None)),
+        ]
+        expected_table_data = (
+            ["line", LeftAligned("down"), "(down) n", "r"],
+            [
+                ["1", "down(1)", "1", ""],
+                ["1", "│  down(0)", "0", ""],
+                ["2", "│  └─ 0", "", ""],
+                ["3", "└─ 1", "", ""],
+                ["5", "", "", "1"],
+            ],
+        )
+        self.assertEqual(expected_table_data, history_to_table_data(history))
+
     def test_function_print_before_call(self):
         """This verifies that events happening after we initiated a call get
         assigned to the line we get to after the return"""
@@ -198,3 +229,45 @@ class TestReporter(unittest.TestCase):
         self.assertEqual(
             textwrap.dedent(expected_result), capture_report(history_to_table(history))
         )
+
+    def test_fold_repeated_rows(self):
+        history: History = [(1, Line()), (1, LineEffects({x: 0}, None))]
+        for i in range(1, 31):
+            history += [
+                (2, Line()),
+                (3, Line()),
+                (3, LineEffects({x: i}, None)),
+                (4, Line()),
+                (4, LineEffects({}, "tick\n")),
+            ]
+        expected_table_data = (
+            ["line", "x", "output"],
+            [
+                ["1", "0", ""],
+                ["3", "1", ""],
+                ["4", "", "tick"],
+                ["⋮ 3–4 ×28", "2 → 29", "tick"],
+                ["3", "30", ""],
+                ["4", "", "tick"],
+            ],
+        )
+        self.assertEqual(expected_table_data, history_to_table_data(history, fold=True))
+        # Only on demand
+        _, rows = history_to_table_data(history)
+        self.assertEqual(61, len(rows))
+
+    def test_fold_long_iterations(self):
+        history: History = []
+        for i in range(30):
+            for line in range(1, 16):
+                history += [(line, Line()), (line, LineEffects({x: i}, None))]
+        _, rows = history_to_table_data(history, fold=True)
+        self.assertEqual(15 + 1 + 15, len(rows))
+        self.assertEqual(["⋮ 1–15 ×28", "1 → 28"], rows[15])
+
+    def test_short_repetitions_are_not_folded(self):
+        history: History = []
+        for i in range(10):
+            history += [(1, Line()), (1, LineEffects({x: i}, None))]
+        _, rows = history_to_table_data(history, fold=True)
+        self.assertEqual(10, len(rows))
@@ -0,0 +1,323 @@
+import math
+import multiprocessing
+import sys
+import threading
+import time
+import unittest
+
+from atrace.interpreter import UNASSIGN, Fingerprints, Var, diff
+from atrace.snapshot import (
+    MAX_REPR_LENGTH,
+    SKIP,
+    Changes,
+    Limits,
+    Memo,
+    Repr,
+    Summary,
+    Symbols,
+    capped,
+    copy_repr,
+    copy_value,
+    exceeds,
+    fingerprint,
+    register_copier,
+    same_value,
+    snapshot,
+    snapshot_changes,
+)
+
+
+class Point:
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_immutables_are_referenced(self):
+        values = {"i": 10**20, "s": "hello", "t": (1, ("a", None)), "f": frozenset({1})}
+        result = snapshot(values)
+        self.assertEqual(values, result)
+        for name, value in values.items():
+            self.assertIs(value, result[name])
+
+    def test_flat_containers_are_copied(self):
+        values: Symbols = {"l": [1, "a", (2, 3)], "d": {"k": 1}, "s": {1, 2}}
+        result = snapshot(values)
+        self.assertEqual(values, result)
+        for name, value in values.items():
+            self.assertIsNot(value, result[name])
+        self.assertIs(values["l"][2], result["l"][2])
+
+    def test_nested_values_are_deep_copied(self):
+        values: Symbols = {"l": [[1, 2], [3]], "t": ([1],), "p": Point(1, 2)}
+        result = snapshot(values)
+        self.assertIsNot(values["l"][0], result["l"][0])
+        self.assertIsNot(values["t"][0], result["t"][0])
+        self.assertIsNot(values["p"], result["p"])
+        self.assertEqual(2, result["p"].y)
+
+    def test_uncopyable_values_are_referenced(self):
+        lock = threading.Lock()
+        self.assertIs(lock, snapshot({"lock": lock})["lock"])
+
+    def test_multiprocessing_values_are_referenced(self):
+        process = multiprocessing.Process(target=print)
+        self.assertIs(process, snapshot({"process": process})["process"])
+
+    def test_failed_copies_are_not_shared(self):
+        class Holder:
+            def __init__(self):
+                self.data = [1]
+                # Locks cannot be copied, the copy fails halfway
+                self.lock = threading.Lock()
+
+        holder = Holder()
+        memo: Memo = {}
+        result = snapshot({"a": holder, "b": [holder], "c": {"h": holder}}, memo)
+        self.assertIs(holder, result["a"])
+        self.assertIs(holder, result["b"][0])
+        self.assertIs(holder, result["c"]["h"])
+        self.assertNotIn(id(holder), memo)
+
+    def test_threads_are_shown(self):
+        threads = [threading.Thread(target=print) for _ in range(2)]
+        result = snapshot({"threads": threads, "thread": threads[0]})
+        # A broken copy raises in repr
+        self.assertIn("Thread", repr(result["thread"]))
+        self.assertIn("Thread", repr(result["threads"]))
+
+    def test_skipped(self):
+        values = {
+            "__name__": "x",
+            "function": snapshot,
+            "builtin": len,
+            "lambda": lambda: None,
+            "cls": Point,
+            "module": math,
+            "kept": 1,
+        }
+        self.assertEqual({"kept": 1}, snapshot(values))
+
+    def test_skipped_names_are_remembered(self):
+        skipped: dict = {}
+        values: Symbols = {"__name__": "x", "f": len, "kept": 1}
+        self.assertEqual({"kept": 1}, snapshot(values, skipped=skipped))
+        self.assertEqual({"__name__": "x", "f": len}, skipped)
+        # Bound to another value, the name gets copied again
+        values["f"] = [2]
+        self.assertEqual({"f": [2], "kept": 1}, snapshot(values, skipped=skipped))
+
+    def test_skipped_names_in_changes(self):
+        skipped: dict = {}
+        previous: Symbols = {}
+        snapshot_changes({"f": len}, previous, {}, skipped=skipped)
+        self.assertEqual(
+            Changes({"f": 1}), snapshot_changes({"f": 1}, previous, {}, skipped=skipped)
+        )
+        self.assertEqual(
+            Changes({"f": UNASSIGN}),
+            snapshot_changes({"f": len}, previous, {}, skipped=skipped),
+        )
+
+    def test_aliases_are_copied_once(self):
+        shared = [1, 2]
+        nested = {"a": [shared, [3]]}
+        memo: Memo = {}
+        globs = snapshot({"x": shared, "nested": nested}, memo)
+        locs = snapshot({"y": shared, "z": nested["a"], "p": Point(shared, 0)}, memo)
+        self.assertIsNot(shared, globs["x"])
+        self.assertIs(globs["x"], locs["y"])
+        self.assertIs(globs["x"], globs["nested"]["a"][0])
+        self.assertIs(globs["nested"]["a"], locs["z"])
+        self.assertIs(globs["x"], locs["p"].x)
+
+    def test_register_copier(self):
+        class Secret:
+            pass
+
+        register_copier(Secret, lambda value, memo: SKIP)
+        self.assertEqual({}, snapshot({"secret": Secret()}))
+
+
+class TestReprs(unittest.TestCase):
+    def test_reprs(self):
+        values = {"l": [1, "a"], "p": Point(1, 2), "f": snapshot, "m": math}
+        self.assertEqual(
+            {"l": Repr("[1, 'a']", "list"), "p": Repr(repr(values["p"]), "Point")},
+            snapshot(values, copier=copy_repr),
+        )
+
+    def test_reprs_are_bounded(self):
+        values = {"l": list(range(100_000)), "s": "a" * 1000, "i": 10**1000}
+        for value in snapshot(values, copier=copy_repr).values():
+            self.assertLessEqual(len(value.text), MAX_REPR_LENGTH)
+
+    def test_uncopyable_values(self):
+        lock = threading.Lock()
+        self.assertEqual(
+            Repr(repr(lock), "lock"), snapshot({"lock": lock}, copier=copy_repr)["lock"]
+        )
+
+    def test_same_repr_different_types(self):
+        self.assertNotEqual(copy_repr(1, {}), copy_repr(Point, {}))
+        self.assertNotEqual(copy_repr([1], {}), copy_repr(Row([1]), {}))
+
+    def test_changes(self):
+        previous: Symbols = {}
+        values: Symbols = {"a": [1], "b": 2}
+        snapshot_changes(values, previous, {}, copy_repr)
+        values["a"].append(2)
+        self.assertEqual(
+            Changes({"a": Repr("[1, 2]", "list")}),
+            snapshot_changes(values, previous, {}, copy_repr),
+        )
+
+
+class Row(list):
+    pass
+
+
+class TestLimits(unittest.TestCase):
+    def test_exceeds(self):
+        self.assertFalse(exceeds(list(range(10)), Limits(items=10)))
+        self.assertTrue(exceeds(list(range(11)), Limits(items=10)))
+        self.assertTrue(exceeds([[1] * 6, [2] * 6], Limits(items=10)))
+        self.assertFalse(exceeds([[1]], Limits(depth=2)))
+        self.assertTrue(exceeds([[[1]]], Limits(depth=2)))
+        self.assertTrue(exceeds({"p": Point([1], 0)}, Limits(depth=2)))
+        self.assertTrue(exceeds(["a" * 1000], Limits(bytes=1000)))
+        self.assertFalse(exceeds(10**1000, Limits(items=1, depth=1)))
+
+    def test_exceeds_stops_early(self):
+        big = {i: [i] for i in range(10**6)}
+        start = time.perf_counter()
+        self.assertTrue(exceeds(big, Limits(items=10)))
+        self.assertTrue(exceeds([big], Limits(items=10)))
+        self.assertTrue(exceeds([[big]], Limits(depth=2)))
+        self.assertLess(time.perf_counter() - start, 0.01)
+
+    def test_exceeds_bytes_stops_early(self):
+        big = [str(i) for i in range(10**6)]
+        start = time.perf_counter()
+        self.assertTrue(exceeds(big, Limits(bytes=sys.getsizeof(big) + 10**4)))
+        self.assertLess(time.perf_counter() - start, 0.01)
+
+    def test_flat_containers_are_not_gone_over(self):
+        flat = list(range(10**6))
+        flat_dict = dict.fromkeys(flat)
+        start = time.perf_counter()
+        self.assertFalse(exceeds(flat, Limits(depth=1)))
+        self.assertFalse(exceeds({"flat": flat}, Limits(items=10**7)))
+        self.assertFalse(exceeds(flat_dict, Limits(depth=1)))
+        self.assertLess(time.perf_counter() - start, 0.1)
+        self.assertTrue(exceeds([1, (2,)], Limits(depth=1)))
+
+    def test_summaries(self):
+        copier = capped(copy_value, Limits(items=100))
+        values = {
+            "l": list(range(10**6)),
+            "d": {i: str(i) for i in range(1000)},
+            "s": frozenset(range(200)),
+            "small": [1, 2],
+            "module": math,
+        }
+        result = snapshot(values, copier=copier)
+        self.assertEqual(
+            ["[0, 1, 2, … 999 997 more]", "{0: '0', 1: '1', 2: '2', … 997 more}"],
+            [repr(result["l"]), repr(result["d"])],
+        )
+        self.assertIsInstance(result["s"], Summary)
+        self.assertEqual([1, 2], result["small"])
+        self.assertNotIn("module", result)
+
+    def test_summaries_detect_changes(self):
+        copier = capped(copy_value, Limits(items=100))
+        values: Symbols = {"l": list(range(1000))}
+        previous: Symbols = {}
+        snapshot_changes(values, previous, {}, copier)
+        self.assertEqual({}, snapshot_changes(values, previous, {}, copier))
+        values["l"][-1] = -1
+        self.assertEqual(
+            Changes(
+                {"l": Summary("[0, 1, 2, … 997 more]", 1000, fingerprint(values["l"]))}
+            ),
+            snapshot_changes(values, previous, {}, copier),
+        )
+        values["l"] = [1]
+        self.assertEqual(
+            Changes({"l": [1]}), snapshot_changes(values, previous, {}, copier)
+        )
+
+
+class ElementWise:
+    """Compares like numpy arrays do."""
+
+    def __init__(self, values):
+        self.values = values
+
+    def __eq__(self, other):
+        return ElementWise([a == b for a, b in zip(self.values, other.values)])
+
+    def __bool__(self):
+        raise ValueError("The truth value of an array is ambiguous")
+
+    def __repr__(self):
+        return f"ElementWise({self.values})"
+
+
+class ExpensiveEq:
+    compared = 0
+
+    def __eq__(self, other):
+        ExpensiveEq.compared += 1
+        return True
+
+
+class TestChangeDetection(unittest.TestCase):
+    def test_fingerprint(self):
+        self.assertNotEqual(fingerprint(1), fingerprint(True))
+        self.assertNotEqual(fingerprint(-1), fingerprint(-2))
+        self.assertNotEqual(fingerprint([1, 2]), fingerprint([1, 2, 3]))
+        self.assertNotEqual(fingerprint((1, 2)), fingerprint([1, 2]))
+        big = list(range(100_000))
+        self.assertEqual(fingerprint(big), fingerprint(big.copy()))
+        self.assertNotEqual(fingerprint(big), fingerprint([*big[:-1], -1]))
+        self.assertEqual(fingerprint({1, 2}), fingerprint({2, 1}))
+
+    def test_same_value(self):
+        big = list(range(100_000))
+        self.assertTrue(same_value(big, big.copy()))
+        middle_changed = big.copy()
+        middle_changed[50_000] = -1
+        self.assertFalse(same_value(big, middle_changed))
+        self.assertTrue(same_value(ElementWise([1, 2]), ElementWise([1, 2])))
+        self.assertFalse(same_value(ElementWise([1, 2]), ElementWise([1, 3])))
+
+    def test_eq_only_on_same_fingerprints(self):
+        ExpensiveEq.compared = 0
+        self.assertFalse(same_value([ExpensiveEq()], [ExpensiveEq(), 1]))
+        self.assertEqual(0, ExpensiveEq.compared)
+        self.assertTrue(same_value([ExpensiveEq()], [ExpensiveEq()]))
+        self.assertEqual(1, ExpensiveEq.compared)
+
+    def test_diff(self):
+        before = {"a": ElementWise([1]), "b": [1, 2], "c": 1}
+        after = {"a": ElementWise([2]), "b": [1, 2], "d": 1}
+        self.assertEqual(
+            {
+                Var("f", "a"): after["a"],
+                Var("f", "d"): 1,
+                Var("f", "c"): UNASSIGN,
+            },
+            diff("f", before, after, Fingerprints()),
+        )
+
+    def test_replaced_values_are_forgotten(self):
+        fingerprints = Fingerprints()
+        before = {"a": [1, 2], "b": [3]}
+        after = {"a": [1, 2, 3]}
+        diff("f", {}, before, fingerprints)
+        diff("f", before, after, fingerprints)
+        self.assertEqual(
+            {id(after["a"])}, {id(value) for value, _ in fingerprints.cache.values()}
+        )
@@ -0,0 +1,127 @@
+import textwrap
+import unittest
+
+from atrace.interpreter import UNASSIGN, Assignments, Call, LineEffects, Return, Var
+from atrace.timeline import Timeline, trace_to_timeline
+
+from .helpers import history_with, snippet_sources, trace_with
+
+total = Var("<module>", "total")
+n = Var("square", "n")
+
+
+class TestTimeline(unittest.TestCase):
+    def setUp(self):
+        source = textwrap.dedent(
+            """\
+            total = 0
+            for i in range(5):
+                total += i
+            def square(n):
+                return n * n
+            result = square(total)
+            del i
+            """
+        )
+        self.timeline = trace_to_timeline(trace_with(source))
+        self.last = len(self.timeline) - 1
+
+    def test_value_at(self):
+        timeline = self.timeline
+        self.assertIs(UNASSIGN, timeline.value_at(total, -1))
+        self.assertEqual(10, timeline.value_at(total, self.last))
+        self.assertEqual(100, timeline.value_at(Var("<module>", "result"), self.last))
+        self.assertIs(UNASSIGN, timeline.value_at(Var("<module>", "i"), self.last))
+        self.assertIs(UNASSIGN, timeline.value_at(Var("<module>", "nope"), self.last))
+
+    def test_changes_between(self):
+        timeline = self.timeline
+        changes = timeline.changes_between(total, 0, len(timeline))
+        # Adding 0 changes nothing
+        self.assertEqual([0, 1, 3, 6, 10], [value for _, value in changes])
+        second, third = changes[1][0], changes[2][0]
+        self.assertEqual(changes[1:2], timeline.changes_between(total, second, third))
+        self.assertEqual(1, timeline.value_at(total, third - 1))
+        # The bindings of the calls are changes too, and so are the returns
+        [(call, value), (returned, gone)] = timeline.changes_between(
+            n, 0, len(timeline)
+        )
+        self.assertEqual(10, value)
+        self.assertIsInstance(timeline.history[call][1], Call)
+        self.assertIs(UNASSIGN, gone)
+        self.assertIsInstance(timeline.history[returned][1], Return)
+
+    def test_find(self):
+        timeline = self.timeline
+        step = timeline.find(total, lambda value: value > 3)
+        assert step is not None
+        self.assertEqual(6, timeline.value_at(total, step))
+        self.assertEqual(3, timeline.value_at(total, step - 1))
+        self.assertEqual(3, timeline.history[step][0])
+        # The value at start counts
+        self.assertEqual(
+            step + 1, timeline.find(total, lambda value: value > 3, step + 1)
+        )
+        self.assertIsNone(timeline.find(total, lambda value: value > 10))
+
+    def test_steps(self):
+        timeline = self.timeline
+        [call] = timeline.steps_of(Call)
+        self.assertEqual((4, Call("square", {n: 10})), timeline.history[call])
+        steps = timeline.steps_on_line(3)
+        self.assertEqual(
+            [3] * len(steps), [timeline.history[step][0] for step in steps]
+        )
+        self.assertIn(timeline.changes_between(total, 0, len(timeline))[-1][0], steps)
+        self.assertEqual([], timeline.steps_on_line(100))
+
+    def test_recursion(self):
+        source = textwrap.dedent(
+            """\
+            def total(n):
+                result = n
+                if n > 0:
+                    result += total(n - 1)
+                return result
+            answer = total(2)
+            """
+        )
+        timeline = trace_to_timeline(trace_with(source))
+        n, result = Var("total", "n"), Var("total", "result")
+        innermost, inner, outer = timeline.steps_of(Return)[:3]
+        # Back in the enclosing call, before it adds what the inner one returned
+        self.assertEqual(1, timeline.value_at(n, innermost))
+        self.assertEqual(1, timeline.value_at(result, innermost))
+        self.assertEqual(2, timeline.value_at(n, inner))
+        self.assertEqual(2, timeline.value_at(result, inner))
+        self.assertEqual(3, timeline.value_at(result, outer - 1))
+        self.assertEqual(
+            {Var("<module>", "answer"): 3}, timeline.state_at(len(timeline) - 1)
+        )
+
+    def test_same_state_as_replaying(self):
+        for name, source in snippet_sources():
+            with self.subTest(snippet=name):
+                history = history_with(source)
+                timeline = Timeline(history)
+                state: Assignments = {}
+                for step, (_, item) in enumerate(history):
+                    if isinstance(item, LineEffects):
+                        for var, value in item.assignments.items():
+                            if var.scope != "<module>":
+                                continue
+                            if value is UNASSIGN:
+                                state.pop(var, None)
+                            else:
+                                state[var] = value
+                    # The locals depend on the calls, see test_recursion
+                    self.assertEqual(
+                        state,
+                        {
+                            var: value
+                            for var, value in timeline.state_at(step).items()
+                            if var.scope == "<module>"
+                        },
+                    )
+                # All the calls have returned
+                self.assertEqual(state, timeline.state_at(len(timeline) - 1))
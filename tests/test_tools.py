@@ -1,12 +1,277 @@
+import io
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
 import textwrap
+import time
 import unittest
+from pathlib import Path
+from unittest.mock import patch
 
-from atrace import trace_next_loaded_module
+from atrace import Engine, default_engine, trace_next_loaded_module
+from atrace.batch import Task, find_programs, run_tasks, stdin_of
+from atrace.benchmark import compare, measure, measure_startup, stress_programs
 from atrace.interpreter import trace_to_history
 from atrace.reporter import history_to_table_data
+from atrace.server import serve
 from atrace.typst import table_data_to_typst
 
 
+class TestBenchmark(unittest.TestCase):
+    def test_measure(self):
+        for name, source in stress_programs(scale=0.01).items():
+            with self.subTest(program=name):
+                result = measure(source, default_engine(), "delta", repeat=1)
+                self.assertGreater(result["events"], 0)
+                self.assertGreater(result["slowdown"], 0)
+                self.assertGreater(result["interpret_ns"], 0)
+
+    def test_measure_exiting_programs(self):
+        source = "import sys\nfor i in range(100):\n    pass\nsys.exit(1)\n"
+        for engine in {Engine.SETTRACE, default_engine()}:
+            with self.subTest(engine=engine.name):
+                result = measure(source, engine, "delta", repeat=1)
+                self.assertGreater(result["events"], 0)
+
+    def test_startup(self):
+        startup = measure_startup(repeat=1)
+        self.assertGreater(startup["import_ns"], 0)
+        self.assertGreater(startup["tiny_program_ns"], startup["python_ns"])
+        # What is only needed to render waits until the program is done
+        self.assertEqual([], startup["rendering_modules"])
+
+    def test_compare(self):
+        def results(events_per_second: int) -> dict:
+            return {
+                "environment": {
+                    "commit": "abc123",
+                    "python": "CPython",
+                    "python_version": "3.13.0",
+                },
+                "results": [
+                    {
+                        "program": "long_loop",
+                        "configuration": "default",
+                        "events_per_second": events_per_second,
+                    }
+                ],
+            }
+
+        self.assertRegex(
+            compare(results(100), results(150)),
+            r"long_loop +default +100 -> +150 events/s \(×1.50\)",
+        )
+
+
+@unittest.skipUnless(hasattr(signal, "setitimer"), "time limits need SIGALRM")
+class TestBatch(unittest.TestCase):
+    programs = {
+        "ok.py": "name = input()\nprint('hello', name)\n",
+        "raised.py": "x = 1\nx = 1 / 0\n",
+        "loops/forever.py": "i = 0\nwhile True:\n    i += 1\n",
+        "broken.py": "x = (\n",
+    }
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = Path(directory.name)
+        for name, source in self.programs.items():
+            path = self.root / "programs" / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(source)
+
+    def task(self, name: str, timeout: float = 5.0, traces: str = "traces") -> Task:
+        return Task(
+            program=str(self.root / "programs" / name),
+            output=str(self.root / traces / Path(name).with_suffix("")),
+            stdin="Ada\n",
+            formats=["text", "json"],
+            timeout=timeout,
+        )
+
+    def test_statuses(self):
+        for engine in {Engine.SETTRACE, default_engine()}:
+            with (
+                self.subTest(engine=engine.name),
+                # The processes are forked, they get the engine too
+                patch("atrace.default_engine", return_value=engine),
+            ):
+                self.check_statuses(engine.name)
+
+    def check_statuses(self, traces: str):
+        tasks = [self.task(name, 0.3, traces) for name in self.programs]
+        results = run_tasks(tasks, jobs=2)
+        self.assertEqual(
+            {
+                "ok.py": "ok",
+                "raised.py": "raised",
+                "loops/forever.py": "timeout",
+                "broken.py": "failed",
+            },
+            {
+                Path(result.program).relative_to(self.root / "programs").as_posix(): (
+                    result.status
+                )
+                for result in results
+            },
+        )
+        self.assertEqual(
+            {
+                "headers": ["line", "name", "output"],
+                "rows": [["1", '"Ada"', ""], ["2", "", "hello Ada"]],
+            },
+            json.loads((self.root / traces / "ok.json").read_text()),
+        )
+        self.assertIn(
+            "ZeroDivisionError", (self.root / traces / "raised.txt").read_text()
+        )
+        # The trace up to the time limit
+        forever = (self.root / traces / "loops" / "forever.txt").read_text()
+        self.assertIn(" i ", forever)
+        self.assertFalse((self.root / traces / "broken.txt").exists())
+
+    def test_killed(self):
+        path = self.root / "programs" / "stubborn.py"
+        path.write_text(
+            "import signal\n"
+            "signal.signal(signal.SIGALRM, signal.SIG_IGN)\n"
+            "while True:\n"
+            "    pass\n"
+        )
+        with patch("atrace.batch.GRACE", 0.3):
+            [result] = run_tasks([self.task("stubborn.py", timeout=0.1)], jobs=1)
+        self.assertEqual("killed", result.status)
+
+    def test_find_programs(self):
+        programs = self.root / "programs"
+        self.assertEqual(
+            [programs / "ok.py", programs / "loops/forever.py"],
+            find_programs([str(programs / "o*.py"), str(programs / "loops")]),
+        )
+        self.assertEqual(
+            [
+                programs / "broken.py",
+                programs / "loops/forever.py",
+                programs / "ok.py",
+                programs / "raised.py",
+            ],
+            find_programs([str(programs)]),
+        )
+
+    def test_stdin_of(self):
+        fixtures = self.root / "fixtures"
+        (fixtures / "loops").mkdir(parents=True)
+        (fixtures / "loops" / "forever.txt").write_text("1\n")
+        program = self.root / "programs" / "loops" / "forever.py"
+        self.assertEqual("1\n", stdin_of(program, self.root / "programs", fixtures))
+        self.assertEqual(
+            "", stdin_of(self.root / "programs/ok.py", self.root / "programs", fixtures)
+        )
+        self.assertEqual(
+            "1\n",
+            stdin_of(program, self.root / "programs", fixtures / "loops/forever.txt"),
+        )
+
+
+@unittest.skipUnless(hasattr(signal, "setitimer"), "time limits need SIGALRM")
+class TestServer(unittest.TestCase):
+    def answers(self, *requests: str) -> list[dict]:
+        output = io.StringIO()
+        serve(io.StringIO("\n".join(requests) + "\n"), output)
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_answers(self):
+        answers = self.answers(
+            json.dumps(
+                {
+                    "id": "a",
+                    "source": "name = input()\nprint(name)\n",
+                    "stdin": "Ada\n",
+                    "format": "json",
+                }
+            ),
+            "",
+            "not json",
+            json.dumps({"id": 2, "source": "x = (\n"}),
+            json.dumps({"id": 3, "source": "while True:\n    pass\n", "timeout": 0.1}),
+            json.dumps({"id": 4, "source": "x = 1\n", "format": "pdf"}),
+        )
+        self.assertEqual(
+            [
+                ("a", "ok"),
+                (None, "failed"),
+                (2, "failed"),
+                (3, "timeout"),
+                (4, "failed"),
+            ],
+            [(answer["id"], answer["status"]) for answer in answers],
+        )
+        self.assertEqual(
+            {
+                "headers": ["line", "name", "output"],
+                "rows": [["1", '"Ada"', ""], ["2", "", "Ada"]],
+            },
+            answers[0]["trace"],
+        )
+        self.assertIn("SyntaxError", answers[2]["error"])
+        self.assertEqual("The format is one of text, svg, json", answers[4]["error"])
+
+    def test_timeout_keeps_the_trace(self):
+        request = {
+            "source": "i = 0\nwhile True:\n    i += 1\n",
+            "timeout": 0.2,
+            "format": "json",
+        }
+        for engine in {Engine.SETTRACE, default_engine()}:
+            with (
+                self.subTest(engine=engine.name),
+                patch("atrace.default_engine", return_value=engine),
+            ):
+                [answer] = self.answers(json.dumps(request))
+                self.assertEqual("timeout", answer["status"])
+                self.assertIn("i", answer["trace"]["headers"])
+                self.assertGreater(answer["rows"], 0)
+
+    def test_programs_are_isolated(self):
+        first, second = self.answers(
+            json.dumps({"source": "import sys\nsys.modules['os'].x = 1\n"}),
+            json.dumps({"source": "import os\nseen = hasattr(os, 'x')\n"}),
+        )
+        self.assertEqual("ok", first["status"])
+        self.assertIn("False", second["trace"])
+        self.assertFalse(hasattr(os, "x"))
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "needs Unix sockets")
+    def test_socket(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "atrace.sock")
+            server = subprocess.Popen(
+                [sys.executable, "-m", "atrace.server", "--socket", path]
+            )
+            try:
+                deadline = time.monotonic() + 10
+                while not os.path.exists(path) and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                with socket.socket(socket.AF_UNIX) as connection:
+                    connection.connect(path)
+                    with connection.makefile("rw") as stream:
+                        for source in ["x = 1\n", "x = 2\n"]:
+                            stream.write(json.dumps({"source": source}) + "\n")
+                            stream.flush()
+                            answer = json.loads(stream.readline())
+                            self.assertEqual("ok", answer["status"])
+                            self.assertIn(source[-2], answer["trace"])
+            finally:
+                server.terminate()
+                server.wait()
+            self.assertFalse(os.path.exists(path))
+
+
 class TestTypst(unittest.TestCase):
     def on_trace(self, trace):
         self.trace = trace
@@ -0,0 +1,155 @@
+import runpy
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from atrace import (
+    CaptureOptions,
+    TGap,
+    TLine,
+    TProcess,
+    Trace,
+    TraceItem,
+    TThread,
+    trace_next_loaded_module,
+)
+from atrace.interpreter import trace_to_history
+from atrace.trace_file import (
+    TraceReader,
+    TraceWriter,
+    Unpicklable,
+    is_trace_file,
+    record,
+)
+
+from .helpers import SNIPPETS_DIR, comparable_events, snippet_sources, trace_with
+
+
+class TestTraceFile(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = str(Path(directory.name) / "trace.atrace")
+
+    def recorded(self, source: str, options: CaptureOptions | None = None):
+        options = options or CaptureOptions()
+        options.record_to = self.path
+        reader = trace_with(source, options=options)
+        assert isinstance(reader, TraceReader)
+        self.addCleanup(reader.close)
+        return reader
+
+    def test_same_trace(self):
+        for name, source in snippet_sources():
+            with self.subTest(snippet=name):
+                self.assertEqual(
+                    comparable_events(trace_with(source)),
+                    comparable_events(self.recorded(source)),
+                )
+
+    def test_same_delta_history(self):
+        for name, source in snippet_sources():
+            with self.subTest(snippet=name):
+                self.assertEqual(
+                    comparable_events(trace_to_history(trace_with(source))),
+                    comparable_events(
+                        trace_to_history(
+                            self.recorded(source, CaptureOptions(delta=True))
+                        )
+                    ),
+                )
+
+    def test_source(self):
+        source = "x = 1\nprint(x)\n"
+        record(source, self.path)
+        self.assertTrue(is_trace_file(self.path))
+        reader = TraceReader(self.path)
+        self.addCleanup(reader.close)
+        self.assertEqual(source, reader.source)
+
+    def test_source_of_loaded_module(self):
+        path = SNIPPETS_DIR / "assign_then_print.py"
+        traces: list[Trace] = []
+        trace_next_loaded_module(
+            traces.append, options=CaptureOptions(record_to=self.path)
+        )
+        runpy.run_path(str(path))
+        [reader] = traces
+        assert isinstance(reader, TraceReader)
+        self.addCleanup(reader.close)
+        self.assertEqual(path.read_text(), reader.source)
+
+    def test_random_access(self):
+        trace = self.recorded("for i in range(3):\n    x = [i]\n")
+        events = list(trace)
+        self.assertEqual(len(events), len(trace))
+        self.assertEqual(events[-1], trace[-1])
+        self.assertEqual(events[2:4], trace[2:4])
+        self.assertEqual(events, list(trace))
+
+    def test_unmapped_when_not_read(self):
+        # Handed over to the callback, then closed
+        trace = self.recorded("for i in range(3):\n    x = [i]\n")
+        assert isinstance(trace, TraceReader)
+        self.assertIsNone(trace.mmap)
+        # Mapped again while iterating
+        events = iter(trace)
+        next(events)
+        self.assertIsNotNone(trace.mmap)
+        [*events]
+        self.assertIsNone(trace.mmap)
+        with TraceReader(self.path) as reader:
+            self.assertEqual(trace[-1], reader[-1])
+        self.assertIsNone(reader.mmap)
+
+    def test_threads(self):
+        events: list[TraceItem] = [
+            (4, TThread("worker")),
+            (5, TGap(3, ["<module>", "f"], [-1, 9, 5], "worker")),
+            (12, TThread(None)),
+        ]
+        writer = TraceWriter(self.path)
+        for event in events:
+            writer.append(event)
+        writer.close()
+        reader = TraceReader(self.path)
+        self.addCleanup(reader.close)
+        self.assertEqual(events, list(reader))
+
+    def test_killed_while_writing(self):
+        events: list[TraceItem] = [(0, TProcess(42)), (3, TLine({}, {"x": 1}))]
+        writer = TraceWriter(self.path)
+        for event in events:
+            writer.append(event)
+        writer.close()
+        with open(self.path, "r+b") as file:
+            file.truncate(Path(self.path).stat().st_size - 2)
+        reader = TraceReader(self.path)
+        self.addCleanup(reader.close)
+        self.assertEqual(events[:1], list(reader))
+
+    def test_values_are_stored_once(self):
+        writer = TraceWriter(self.path)
+        for _ in range(3):
+            writer.append((1, TLine({"big": list(range(1000))}, {"x": 1})))
+        writer.close()
+        self.assertEqual(2, len(writer.value_numbers))
+
+    def test_unpicklable_values(self):
+        lock = threading.Lock()
+        writer = TraceWriter(self.path)
+        writer.append((1, TLine({"lock": lock}, {})))
+        writer.close()
+        reader = TraceReader(self.path)
+        self.addCleanup(reader.close)
+        [(_, event)] = reader
+        assert isinstance(event, TLine)
+        self.assertEqual(Unpicklable(repr(lock)), event.globals["lock"])
+        self.assertEqual(repr(lock), repr(event.globals["lock"]))
+
+    def test_not_a_trace_file(self):
+        Path(self.path).write_text("x = 1\n")
+        self.assertFalse(is_trace_file(self.path))
+        with self.assertRaises(ValueError):
+            TraceReader(self.path)